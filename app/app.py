@@ -36,6 +36,8 @@ def app(http):
         web.submit(http)
     elif http.request.path.startswith("/progress"):
         web.progress(http)
+    elif http.request.path == "/workflows":
+        web.workflows(http)
     elif http.request.path.startswith("/api/"):
         app_handler(http)
     else:
@@ -1,3 +1,4 @@
+import datetime
 import os
 import urllib.parse
 
@@ -71,11 +72,22 @@ def make_handle_static(base_path):
 def submit(http):
     if http.request.method == "post":
         q = urllib.parse.parse_qs(http.request.body.decode("utf8"))
-        result = operation.submit_input(
-            {"password": q["password"][0], "id": int(q["id"][0])},
-            # Pretending we have authorized
-            security=AppSecurity(access_token="", verified_claims={}),
-        )
+        try:
+            result = operation.submit_input(
+                {"password": q["password"][0], "id": int(q["id"][0])},
+                # Pretending we have authorized
+                security=AppSecurity(access_token="", verified_claims={}),
+            )
+        except tasks.driver.QueueFull:
+            http.response.status = "503 Service Unavailable"
+            http.response.headers["retry-after"] = "10"
+            http.response.body = Base(
+                "Busy",
+                Html(
+                    "<p>Too many submissions are in progress, please try again shortly.</p>\n"
+                ),
+            )
+            return
         body = (
             Html('<p>Submission in progress ... <a href="/progress?workflow_id=')
             + urllib.parse.quote(result["workflow_id"])
@@ -121,11 +133,62 @@ def progress(http):
             status = statuses[execution_status]
     if "end" in progress_response:
         status = "SUCCEEDED"
-    if "status" in progress_response and "status" == "FAILED":
+    if progress_response.get("status") == "FAILED":
         status = "FAILED"
     http.response.body = Main("Progress", main=json.dumps((status, progress_response)))
 
 
+def workflows(http):
+    # e.g. /workflows?status=FAILED&hours=1 or /workflows?limit=10
+    q = urllib.parse.parse_qs(http.request.query)
+    status = q.get("status", ["ALL"])[0]
+    if status not in tasks.driver.index_statuses:
+        http.response.status = "400 Bad Request"
+        http.response.body = Base("Workflows", Html("<p>Unknown status.</p>\n"))
+        return
+    since = None
+    try:
+        limit = int(q.get("limit", ["20"])[0])
+        if "hours" in q:
+            hours = float(q["hours"][0])
+            if hours > 0:
+                since = datetime.datetime.now() - datetime.timedelta(hours=hours)
+        valid = limit > 0 and ("hours" not in q or since is not None)
+    except (ValueError, OverflowError):
+        valid = False
+    if not valid:
+        http.response.status = "400 Bad Request"
+        http.response.body = Base(
+            "Workflows", Html("<p>The hours and limit must be positive numbers.</p>\n")
+        )
+        return
+    limit = min(limit, 100)
+    body = Html("<p>")
+    for index_status in tasks.driver.index_statuses:
+        body += (
+            Html('<a href="/workflows?status=')
+            + index_status
+            + Html('">')
+            + index_status.title()
+            + Html("</a> ")
+        )
+    body += Html("</p>\n<table>\n<tr><th>Workflow</th><th>At</th><th>Tasks</th></tr>\n")
+    for workflow in tasks.driver.list_workflows(status, since=since, limit=limit):
+        body += (
+            Html('<tr><td><a href="/progress?workflow_id=')
+            + urllib.parse.quote(workflow["workflow_id"])
+            + Html('">')
+            + workflow["workflow_id"]
+            + Html("</a></td><td>")
+            + workflow["at"]
+            + Html("</td><td>")
+            + str(workflow["num_tasks"])
+            + Html("</td></tr>\n")
+        )
+    body += Html("</table>\n")
+    http.response.body = Main("Workflows - " + status.title(), main=body)
+
+
 def home(http):
     http.response.body = Main(
         title="Home",
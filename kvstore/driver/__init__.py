@@ -1,9 +1,79 @@
 import os
 
-if os.environ.get("KVSTORE_DYNAMODB_TABLE_NAME"):
-    from .dynamodb import delete, iterate, patch, put, NotFound, get
+if os.environ.get("KVSTORE_DRIVER") == "memory":
+    from .memory import (
+        delete,
+        delete_many,
+        iterate,
+        patch,
+        put,
+        put_many,
+        scan_pk,
+        NotFound,
+        get,
+        get_many,
+        transaction,
+        transactable,
+    )
+elif os.environ.get("KVSTORE_DYNAMODB_TABLE_NAME"):
+    from .dynamodb import (
+        delete,
+        delete_many,
+        iterate,
+        patch,
+        put,
+        put_many,
+        scan_pk,
+        NotFound,
+        get,
+        get_many,
+        transaction,
+        transactable,
+    )
 else:
-    from .sqlite import delete, iterate, patch, put, NotFound, get
-from .shared import Remove
+    from .sqlite import (
+        delete,
+        delete_many,
+        iterate,
+        patch,
+        put,
+        put_many,
+        scan_pk,
+        NotFound,
+        get,
+        get_many,
+        transaction,
+        transactable,
+    )
+from .shared import ConditionFailed, NotExists, Remove
 
-__all__ = ["delete", "put", "patch", "iterate", "NotFound", "Remove", "get"]
+if int(os.environ.get("KVSTORE_CACHE_SIZE", "0")) > 0:
+    from . import cache
+
+    get = cache.cached_get(get)
+    iterate = cache.cached_iterate(iterate)
+    scan_pk = cache.cached_scan_pk(scan_pk)
+    put = cache.invalidating_put(put)
+    patch = cache.invalidating_patch(patch)
+    delete = cache.invalidating_delete(delete)
+    put_many = cache.invalidating_put_many(put_many)
+    delete_many = cache.invalidating_delete_many(delete_many)
+    transaction = cache.invalidating_transaction(transaction)
+
+__all__ = [
+    "delete",
+    "delete_many",
+    "put",
+    "put_many",
+    "patch",
+    "iterate",
+    "scan_pk",
+    "NotFound",
+    "ConditionFailed",
+    "NotExists",
+    "Remove",
+    "get",
+    "get_many",
+    "transaction",
+    "transactable",
+]
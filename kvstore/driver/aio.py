@@ -0,0 +1,61 @@
+"""
+asyncio versions of the kvstore.driver functions, with the same arguments,
+results and exceptions, for async web front ends and task handlers:
+
+    from kvstore.driver import aio
+
+    await aio.put("tasks", pk, {"status": "running"})
+    data, ttl = await aio.get("tasks", pk)
+    async for sk, data, ttl in aio.scan_pk("tasks", pk):
+        ...
+
+With DynamoDB the requests are made by an asyncio HTTP client, so hundreds of
+calls can overlap without a thread each (see aio_dynamodb.py). With SQLite the
+blocking calls run on a dedicated thread pool (see aio_executor.py).
+"""
+
+import os
+
+if os.environ.get("KVSTORE_DRIVER") != "memory" and os.environ.get(
+    "KVSTORE_DYNAMODB_TABLE_NAME"
+):
+    from .aio_dynamodb import (
+        delete,
+        delete_many,
+        get,
+        get_many,
+        iterate,
+        patch,
+        put,
+        put_many,
+        scan_pk,
+    )
+else:
+    from .aio_executor import (
+        delete,
+        delete_many,
+        get,
+        get_many,
+        iterate,
+        patch,
+        put,
+        put_many,
+        scan_pk,
+    )
+from .shared import ConditionFailed, NotExists, NotFound, Remove
+
+__all__ = [
+    "delete",
+    "delete_many",
+    "put",
+    "put_many",
+    "patch",
+    "iterate",
+    "scan_pk",
+    "NotFound",
+    "ConditionFailed",
+    "NotExists",
+    "Remove",
+    "get",
+    "get_many",
+]
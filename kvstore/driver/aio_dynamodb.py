@@ -0,0 +1,425 @@
+"""
+The DynamoDB implementation of kvstore.driver.aio.
+
+Requests are made over HTTP/1.1 keep-alive connections with asyncio streams,
+signed with AWS Signature Version 4, so that many calls can be in flight on
+one event loop without a thread each, and without any dependencies beyond the
+standard library. The request building and response handling is shared with
+kvstore.driver.dynamodb, whose operations are written as generators of
+requests that either client can drive.
+
+The endpoint is https://dynamodb.$AWS_REGION.amazonaws.com unless
+AWS_ENDPOINT_URL_DYNAMODB (or AWS_ENDPOINT_URL) is set. Credentials come from
+AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN as they are in
+Lambda, falling back to boto3's credential chain. At most
+KVSTORE_AIO_CONNECTIONS (default 50) requests are in flight per event loop.
+The attempts and timeouts are the KVSTORE_DYNAMODB_ settings described in
+dynamodb.config(), and retries and throttles are counted in dynamodb.stats().
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import ssl
+import time
+import urllib.parse
+import weakref
+import zlib
+
+from . import dynamodb
+
+# https://docs.aws.amazon.com/sdkref/latest/guide/feature-retry-behavior.html
+_retryable_codes = {
+    "InternalServerError",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ServiceUnavailable",
+    "ThrottlingException",
+    "TransactionInProgressException",
+}
+
+
+class ClientError(Exception):
+    """Like botocore's ClientError, the error code is in response["Error"]["Code"]."""
+
+    def __init__(self, status, code, message):
+        super().__init__(f"{code}: {message}")
+        self.response = {
+            "Error": {"Code": code, "Message": message},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        }
+
+
+def sign(
+    method,
+    path,
+    query,
+    headers,
+    body,
+    region,
+    service,
+    access_key,
+    secret_key,
+    amz_date,
+):
+    """
+    Return the Authorization header value for a request, signed with AWS
+    Signature Version 4. headers must have lower case names and include every
+    header to be signed, including host and x-amz-date. query must already be
+    in canonical form.
+
+    https://docs.aws.amazon.com/IAM/latest/UserGuide/create-signed-request.html
+    """
+    names = sorted(headers)
+    canonical_headers = "".join(
+        f"{name}:{' '.join(str(headers[name]).split())}\n" for name in names
+    )
+    signed_headers = ";".join(names)
+    canonical_request = "\n".join(
+        [
+            method,
+            path,
+            query,
+            canonical_headers,
+            signed_headers,
+            hashlib.sha256(body).hexdigest(),
+        ]
+    )
+    date = amz_date[:8]
+    scope = f"{date}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode("utf8")).hexdigest(),
+        ]
+    )
+    key = ("AWS4" + secret_key).encode("utf8")
+    for part in (date, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode("utf8"), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode("utf8"), hashlib.sha256).hexdigest()
+    return f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}"
+
+
+class _Pool:
+    def __init__(self, max_connections):
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+
+class Client:
+    def __init__(
+        self,
+        region,
+        endpoint=None,
+        max_connections=50,
+        max_attempts=10,
+        connect_timeout=2,
+        read_timeout=10,
+    ):
+        self.region = region
+        url = urllib.parse.urlsplit(
+            endpoint or f"https://dynamodb.{region}.amazonaws.com"
+        )
+        self.host = url.hostname
+        self.netloc = url.netloc
+        self.ssl = None
+        if url.scheme == "https":
+            self.ssl = ssl.create_default_context()
+        self.port = url.port or (443 if self.ssl else 80)
+        self.max_connections = max_connections
+        self.max_attempts = max_attempts
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Streams belong to the event loop that opened them
+        self._pools: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._credentials = None
+
+    def _pool(self) -> _Pool:
+        loop = asyncio.get_running_loop()
+        pool = self._pools.get(loop)
+        if pool is None:
+            pool = self._pools[loop] = _Pool(self.max_connections)
+        return pool
+
+    def _get_credentials(self):
+        access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+        if access_key:
+            return (
+                access_key,
+                os.environ["AWS_SECRET_ACCESS_KEY"],
+                os.environ.get("AWS_SESSION_TOKEN"),
+            )
+        if self._credentials is None:
+            # Shared config files, container and instance roles etc.
+            import boto3
+
+            credentials = boto3.Session().get_credentials()
+            if credentials is None:
+                raise Exception(
+                    "No AWS credentials found, set AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY or configure a profile or role"
+                )
+            self._credentials = credentials
+        frozen = self._credentials.get_frozen_credentials()
+        return frozen.access_key, frozen.secret_key, frozen.token
+
+    async def call(self, operation, kwargs):
+        """
+        Call an operation named as it is on the boto3 client (e.g. get_item)
+        with the same keyword arguments, returning the same response.
+        """
+        target = "DynamoDB_20120810." + "".join(
+            part.capitalize() for part in operation.split("_")
+        )
+        body = json.dumps(kwargs).encode("utf8")
+        attempt = 0
+        throttles = 0
+        try:
+            while True:
+                error: Exception
+                try:
+                    status, response = await self._send(target, body)
+                except (OSError, asyncio.IncompleteReadError, TimeoutError) as e:
+                    error = e
+                else:
+                    if status == 200:
+                        return response
+                    code = response.get("__type", "").split("#")[-1]
+                    error = ClientError(
+                        status,
+                        code,
+                        response.get("message", response.get("Message", "")),
+                    )
+                    if code in dynamodb._throttling_codes:
+                        throttles += 1
+                    if status < 500 and code not in _retryable_codes:
+                        raise error
+                if attempt + 1 >= self.max_attempts:
+                    raise error
+                attempt += 1
+                await asyncio.sleep(random.uniform(0, min(0.025 * 2**attempt, 20)))
+        finally:
+            dynamodb._record(operation, attempt, throttles)
+
+    async def _connect(self):
+        async with asyncio.timeout(self.connect_timeout):
+            return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def _send(self, target, body):
+        pool = self._pool()
+        async with pool.semaphore:
+            reused = bool(pool.idle)
+            if reused:
+                connection = pool.idle.pop()
+            else:
+                connection = await self._connect()
+            try:
+                try:
+                    status, headers, response = await self._request(
+                        connection, target, body
+                    )
+                except (OSError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+                    # The server closed the idle connection, so the request
+                    # wasn't handled. Try again on a new one.
+                    connection[1].close()
+                    connection = await self._connect()
+                    status, headers, response = await self._request(
+                        connection, target, body
+                    )
+            except BaseException:
+                connection[1].close()
+                raise
+            if headers.get("connection", "").lower() == "close":
+                connection[1].close()
+            else:
+                pool.idle.append(connection)
+            return status, response
+
+    async def _request(self, connection, target, body):
+        reader, writer = connection
+        access_key, secret_key, token = self._get_credentials()
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        headers = {
+            "content-type": "application/x-amz-json-1.0",
+            "host": self.netloc,
+            "x-amz-date": amz_date,
+            "x-amz-target": target,
+        }
+        if token:
+            headers["x-amz-security-token"] = token
+        headers["authorization"] = sign(
+            "POST",
+            "/",
+            "",
+            headers,
+            body,
+            self.region,
+            "dynamodb",
+            access_key,
+            secret_key,
+            amz_date,
+        )
+        headers["content-length"] = str(len(body))
+        writer.write(
+            (
+                "POST / HTTP/1.1\r\n"
+                + "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+                + "\r\n"
+            ).encode("latin1")
+            + body
+        )
+        async with asyncio.timeout(self.read_timeout):
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("The connection was closed")
+            status = int(status_line.split()[1])
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin1").partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+            if response_headers.get("transfer-encoding", "").lower() == "chunked":
+                chunks = []
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    if size == 0:
+                        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                            pass
+                        break
+                    chunks.append(await reader.readexactly(size))
+                    await reader.readexactly(2)
+                data = b"".join(chunks)
+            else:
+                data = await reader.readexactly(
+                    int(response_headers.get("content-length", "0"))
+                )
+        crc32 = response_headers.get("x-amz-crc32")
+        if crc32 is not None and int(crc32) != zlib.crc32(data):
+            raise ConnectionError("The response failed its CRC32 check")
+        return status, response_headers, json.loads(data) if data else {}
+
+
+_client = None
+
+
+def client() -> Client:
+    global _client
+    if _client is None:
+        config = dynamodb.config()
+        _client = Client(
+            os.environ["AWS_REGION"],
+            endpoint=os.environ.get(
+                "AWS_ENDPOINT_URL_DYNAMODB", os.environ.get("AWS_ENDPOINT_URL")
+            ),
+            max_connections=int(os.environ.get("KVSTORE_AIO_CONNECTIONS", "50")),
+            max_attempts=config["retries"]["total_max_attempts"],
+            connect_timeout=config["connect_timeout"],
+            read_timeout=config["read_timeout"],
+        )
+    return _client
+
+
+async def _arun(steps):
+    # The asyncio equivalent of dynamodb._run()
+    response = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                operation, kwargs = steps.send(response)
+            else:
+                operation, kwargs = steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        response = None
+        error = None
+        if operation == "sleep":
+            await asyncio.sleep(kwargs)
+            continue
+        try:
+            response = await client().call(operation, kwargs)
+        except Exception as e:
+            error = e
+
+
+def _invalidate(store, pks):
+    # Keep the read cache in front of the blocking API coherent with writes
+    # made here
+    if int(os.environ.get("KVSTORE_CACHE_SIZE", "0")) > 0:
+        from . import cache
+
+        cache.invalidate(store, pks)
+
+
+async def put(store, pk, data=None, sk="/", ttl=None, condition=None):
+    try:
+        return await _arun(dynamodb._put(store, pk, data, sk, ttl, condition))
+    finally:
+        _invalidate(store, [pk])
+
+
+async def put_many(store, items):
+    items = list(items)
+    try:
+        return await _arun(dynamodb._put_many(store, items))
+    finally:
+        _invalidate(store, set(item[0] for item in items))
+
+
+async def delete(store, pk, sk="/"):
+    try:
+        return await _arun(dynamodb._delete(store, pk, sk))
+    finally:
+        _invalidate(store, [pk])
+
+
+async def delete_many(store, keys):
+    keys = list(keys)
+    try:
+        return await _arun(dynamodb._delete_many(store, keys))
+    finally:
+        _invalidate(store, set(key[0] for key in keys))
+
+
+async def patch(store, pk, data, sk="/", ttl="notchanged", condition=None):
+    try:
+        return await _arun(dynamodb._patch(store, pk, data, sk, ttl, condition))
+    finally:
+        _invalidate(store, [pk])
+
+
+async def iterate(
+    store, pk, sk_start="/", limit=None, after=False, consistent=False, attributes=None
+):
+    return await _arun(
+        dynamodb._iterate(store, pk, sk_start, limit, after, consistent, attributes)
+    )
+
+
+async def scan_pk(
+    store, pk, sk_start="/", after=False, page_size=100, consistent=False
+):
+    args = dynamodb._scan_pk_args(store, pk, sk_start, after, page_size, consistent)
+    while True:
+        items, more = await _arun(dynamodb._scan_pk_page(args))
+        for item in items:
+            yield item
+        if not more:
+            return
+
+
+async def get(store, pk, sk="/", consistent=False, attributes=None):
+    return await _arun(dynamodb._get(store, pk, sk, consistent, attributes))
+
+
+async def get_many(store, keys, consistent=False):
+    return await _arun(dynamodb._get_many(store, keys, consistent))
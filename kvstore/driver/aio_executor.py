@@ -0,0 +1,107 @@
+"""
+The SQLite and memory implementation of kvstore.driver.aio.
+
+The blocking functions from kvstore.driver (including the read cache if it is
+enabled) are run on a dedicated pool of KVSTORE_AIO_THREADS threads (default
+4), so that event loops aren't blocked by SQLite and don't compete with the
+default executor. The memory driver's functions run there too, since they wait
+for its lock while another thread is in a transaction().
+"""
+
+import asyncio
+import functools
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import kvstore.driver as driver
+
+_executor: ThreadPoolExecutor | None = None
+_lock = Lock()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get("KVSTORE_AIO_THREADS", "4")),
+                thread_name_prefix="kvstore-aio",
+            )
+        return _executor
+
+
+async def _call(function, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        _get_executor(), functools.partial(function, *args, **kwargs)
+    )
+
+
+async def put(store, pk, data=None, sk="/", ttl=None, condition=None):
+    return await _call(
+        driver.put, store, pk, data=data, sk=sk, ttl=ttl, condition=condition
+    )
+
+
+async def put_many(store, items):
+    return await _call(driver.put_many, store, list(items))
+
+
+async def delete(store, pk, sk="/"):
+    return await _call(driver.delete, store, pk, sk=sk)
+
+
+async def delete_many(store, keys):
+    return await _call(driver.delete_many, store, list(keys))
+
+
+async def patch(store, pk, data, sk="/", ttl="notchanged", condition=None):
+    return await _call(
+        driver.patch, store, pk, data, sk=sk, ttl=ttl, condition=condition
+    )
+
+
+async def iterate(
+    store, pk, sk_start="/", limit=None, after=False, consistent=False, attributes=None
+):
+    return await _call(
+        driver.iterate,
+        store,
+        pk,
+        sk_start=sk_start,
+        limit=limit,
+        after=after,
+        consistent=consistent,
+        attributes=attributes,
+    )
+
+
+async def scan_pk(
+    store, pk, sk_start="/", after=False, page_size=100, consistent=False
+):
+    items = driver.scan_pk(
+        store,
+        pk,
+        sk_start=sk_start,
+        after=after,
+        page_size=page_size,
+        consistent=consistent,
+    )
+    # Hand over a page at a time rather than an item at a time
+    while True:
+        page = await _call(lambda: list(itertools.islice(items, page_size)))
+        for item in page:
+            yield item
+        if len(page) < page_size:
+            return
+
+
+async def get(store, pk, sk="/", consistent=False, attributes=None):
+    return await _call(
+        driver.get, store, pk, sk=sk, consistent=consistent, attributes=attributes
+    )
+
+
+async def get_many(store, keys, consistent=False):
+    return await _call(driver.get_many, store, list(keys), consistent=consistent)
@@ -0,0 +1,423 @@
+# KVSTORE_DRIVER=memory PYTHONPATH=../../ python3 bench.py
+# STORE_DIR=. KVSTORE_SQLITE_POOL=true PYTHONPATH=../../ python3 bench.py --threads 8 --json sqlite.json
+# PYTHONPATH=../../ python3 bench.py --fake-dynamodb --workloads point_get,mixed
+# PYTHONPATH=../../ python3 bench.py --fake-dynamodb --fake-latency-ms 5 --fake-throttle-rate 0.05 --threads 8
+# PYTHONPATH=../../ python3 bench.py --workloads= --codecs
+# KVSTORE_DRIVER=memory PYTHONPATH=../../ python3 bench.py --workloads= --dynamodb-codec
+#
+# Runs workloads shaped like the task engine's use of the store against
+# whichever driver the environment selects (or against the in-process
+# DynamoDB stand-in with --fake-dynamodb), and reports throughput and latency
+# percentiles. With --json the results are also written in a machine readable
+# form so that runs can be compared between releases.
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import uuid
+
+store = "bench"
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_threads(threads, ops, op):
+    """
+    Call op(thread_number, i) ops times spread across threads, returning the
+    wall clock time taken and the latency of each call in ms.
+    """
+    latencies: list[float] = []
+    errors: list[BaseException] = []
+    lock = threading.Lock()
+
+    def worker(thread_number, count):
+        local = []
+        try:
+            for i in range(count):
+                start = time.perf_counter()
+                op(thread_number, i)
+                local.append((time.perf_counter() - start) * 1000)
+        except BaseException as e:
+            errors.append(e)
+        with lock:
+            latencies.extend(local)
+
+    counts = [ops // threads + (1 if t < ops % threads else 0) for t in range(threads)]
+    workers = [
+        threading.Thread(target=worker, args=(t, counts[t])) for t in range(threads)
+    ]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return elapsed, latencies
+
+
+def summarise(name, elapsed, latencies, **extra):
+    latencies = sorted(latencies)
+    result = {
+        "workload": name,
+        "ops": len(latencies),
+        "seconds": elapsed,
+        "ops_per_sec": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1] if latencies else None,
+    }
+    result.update(extra)
+    return result
+
+
+def dynamodb_stats():
+    # Retries and throttled responses since the last call, if the DynamoDB
+    # driver is in use
+    dynamodb = sys.modules.get("kvstore.driver.dynamodb")
+    if dynamodb is None:
+        return {}
+    counts = dynamodb.stats(reset=True).values()
+    return {
+        "retries": sum(c["retries"] for c in counts),
+        "throttles": sum(c["throttles"] for c in counts),
+    }
+
+
+def task_data(i, size):
+    return {
+        "begin": "2023-11-18T20:52:41.123456",
+        "begin_uid": str(uuid.uuid4()),
+        "correctly_escaped_html_status_message": "x" * size,
+        "task": i,
+    }
+
+
+def point_get(driver, args):
+    pk = f"point_get/{uuid.uuid4()}"
+    keys = [f"/{i:08d}" for i in range(args.partition_size)]
+    driver.put_many(
+        store,
+        [(pk, sk, task_data(i, args.value_size), None) for i, sk in enumerate(keys)],
+    )
+
+    def op(thread_number, i):
+        driver.get(store, pk, sk=random.choice(keys))
+
+    return run_threads(args.threads, args.ops, op)
+
+
+def range_iterate(driver, args):
+    pk = f"range_iterate/{uuid.uuid4()}"
+    driver.put_many(
+        store,
+        [
+            (pk, f"/{i:08d}", task_data(i, args.value_size), None)
+            for i in range(args.partition_size)
+        ],
+    )
+    counts = []
+
+    def op(thread_number, i):
+        count = 0
+        for item in driver.scan_pk(store, pk, page_size=args.page_size):
+            count += 1
+        counts.append(count)
+
+    # Each op walks the whole partition, so run fewer of them
+    elapsed, latencies = run_threads(
+        args.threads, max(1, args.ops // args.partition_size * 10), op
+    )
+    assert set(counts) == {args.partition_size}, set(counts)
+    return elapsed, latencies
+
+
+def patch_storm(driver, args):
+    # Many workers patching the same small set of task records, like end_task()
+    pk = f"patch_storm/{uuid.uuid4()}"
+    keys = [f"/task/{i:04d}" for i in range(10)]
+    driver.put_many(
+        store, [(pk, sk, task_data(0, args.value_size), None) for sk in keys]
+    )
+
+    def op(thread_number, i):
+        driver.patch(
+            store,
+            pk,
+            sk=keys[i % len(keys)],
+            data={"end": time.time(), "end_uid": f"{thread_number}/{i}"},
+        )
+
+    return run_threads(args.threads, args.ops, op)
+
+
+def ttl_writes(driver, args):
+    # Writes of items that expire almost immediately, so that expired data
+    # builds up. Each thread writes to its own pk, like separate workflows.
+    pk = f"ttl_writes/{uuid.uuid4()}"
+
+    def op(thread_number, i):
+        driver.put(
+            store,
+            f"{pk}/{thread_number}",
+            sk=f"/{i:08d}",
+            data=task_data(i, args.value_size),
+            ttl=time.time() + 0.01,
+        )
+
+    return run_threads(args.threads, args.ops, op)
+
+
+def mixed(driver, args):
+    # Mostly progress polling with some task updates mixed in
+    pk = f"mixed/{uuid.uuid4()}"
+    keys = [f"/task/{i:08d}" for i in range(args.partition_size)]
+    driver.put_many(
+        store,
+        [(pk, sk, task_data(i, args.value_size), None) for i, sk in enumerate(keys)],
+    )
+
+    def op(thread_number, i):
+        r = random.random()
+        if r < args.write_ratio:
+            driver.patch(store, pk, sk=random.choice(keys), data={"end": time.time()})
+        elif r < 0.5 + args.write_ratio / 2:
+            driver.get(store, pk, sk=random.choice(keys))
+        else:
+            driver.iterate(store, pk, limit=40)
+
+    return run_threads(args.threads, args.ops, op)
+
+
+def codecs(args):
+    """
+    Compare the SQLite driver's value codecs on the same task data: the mean
+    time to encode and decode an item, the mean encoded size, and the size of
+    a database file holding partition_size items.
+    """
+    import sqlite3
+    import tempfile
+
+    from kvstore.driver import codec
+
+    items = [task_data(i, args.value_size) for i in range(args.partition_size)]
+    results = []
+    for name, encode in codec.encoders.items():
+        start = time.perf_counter()
+        encoded = [encode(item) for item in items]
+        encode_us = (time.perf_counter() - start) / len(items) * 1000000
+        start = time.perf_counter()
+        for value in encoded:
+            codec.decode(value)
+        decode_us = (time.perf_counter() - start) / len(items) * 1000000
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "codec.db")
+            conn = sqlite3.connect(path)
+            conn.execute(
+                "create table store (store text, pk text, sk text, ttl real, data text NOT NULL, PRIMARY KEY (store, pk, sk));"
+            )
+            conn.executemany(
+                "INSERT INTO store (store, pk, sk, ttl, data) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (store, "codecs", f"/{i:08d}", None, value)
+                    for i, value in enumerate(encoded)
+                ],
+            )
+            conn.commit()
+            conn.execute("VACUUM")
+            conn.close()
+            file_bytes = os.path.getsize(path)
+        results.append(
+            {
+                "codec": name,
+                "items": len(items),
+                "encode_us": encode_us,
+                "decode_us": decode_us,
+                "mean_bytes": sum(len(value) for value in encoded) / len(encoded),
+                "file_bytes": file_bytes,
+            }
+        )
+    return results
+
+
+def dynamodb_codec_pages(args, repeat=20):
+    """
+    Time the DynamoDB driver's attribute codec on full 1 MB Query pages of
+    task data, the most a single iterate() or scan_pk() call has to decode:
+    parsing the response JSON (which the asyncio client does itself), decoding
+    the page, and encoding the same items for writing.
+    """
+    from kvstore.driver import dynamodb_codec
+
+    page: list[dict] = []
+    page_bytes = 0
+    while page_bytes < 1024 * 1024:
+        i = len(page)
+        item = {
+            "pk": {"S": f"{store}/dynamodb_codec"},
+            "sk": {"S": f"/{i:08d}"},
+            "ttl": {"N": str(time.time() + 3600)},
+        }
+        item.update(dynamodb_codec.encode(task_data(i, args.value_size)))
+        page.append(item)
+        page_bytes += len(json.dumps(item))
+    body = json.dumps({"Items": page, "Count": len(page)})
+    data = [task_data(i, args.value_size) for i in range(len(page))]
+
+    def per_page_ms(function):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    return {
+        "items": len(page),
+        "page_bytes": len(body),
+        "json_ms": per_page_ms(lambda: json.loads(body)),
+        "decode_ms": per_page_ms(lambda: dynamodb_codec.decode_page(page)),
+        "encode_ms": per_page_ms(
+            lambda: [dynamodb_codec.encode(item) for item in data]
+        ),
+    }
+
+
+workloads = {
+    "point_get": point_get,
+    "range_iterate": range_iterate,
+    "patch_storm": patch_storm,
+    "ttl_writes": ttl_writes,
+    "mixed": mixed,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the kvstore driver selected by the environment"
+    )
+    parser.add_argument(
+        "--workloads",
+        default=",".join(workloads),
+        help="Comma separated workloads to run. Choose from: " + ", ".join(workloads),
+    )
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--partition-size", type=int, default=1000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument(
+        "--fake-dynamodb",
+        action="store_true",
+        help="Run the DynamoDB driver against the in-process stand-in in fake_dynamodb.py",
+    )
+    parser.add_argument(
+        "--fake-latency-ms",
+        type=float,
+        default=0.0,
+        help="Delay each request to the stand-in by about this long",
+    )
+    parser.add_argument(
+        "--fake-throttle-rate",
+        type=float,
+        default=0.0,
+        help="Throttle this fraction of the requests to the stand-in",
+    )
+    parser.add_argument(
+        "--codecs",
+        action="store_true",
+        help="Also compare the encode and decode cost and on-disk size of the SQLite value codecs",
+    )
+    parser.add_argument(
+        "--dynamodb-codec",
+        action="store_true",
+        help="Also time decoding and encoding 1 MB DynamoDB Query pages",
+    )
+    parser.add_argument("--json", help="Also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    if args.fake_dynamodb:
+        os.environ.setdefault("KVSTORE_DYNAMODB_TABLE_NAME", "bench")
+        os.environ.setdefault("AWS_REGION", "local")
+        from kvstore.driver import fake_dynamodb
+
+        fake_dynamodb.install(
+            latency=args.fake_latency_ms / 1000, throttle_rate=args.fake_throttle_rate
+        )
+
+    import kvstore.driver as driver
+
+    names = [name for name in args.workloads.split(",") if name]
+    for name in names:
+        assert name in workloads, f"Unknown workload {repr(name)}"
+    results = []
+    for name in names:
+        dynamodb_stats()
+        elapsed, latencies = workloads[name](driver, args)
+        result = summarise(name, elapsed, latencies, **dynamodb_stats())
+        results.append(result)
+        print(
+            f"{name:>14}: {result['ops']:>7} ops {result['ops_per_sec']:>10.1f} ops/s "
+            f"p50 {result['p50_ms']:.3f} ms p95 {result['p95_ms']:.3f} ms p99 {result['p99_ms']:.3f} ms"
+            + (
+                f" {result['retries']} retries {result['throttles']} throttles"
+                if "retries" in result
+                else ""
+            )
+        )
+        sys.stdout.flush()
+
+    codec_results = []
+    if args.codecs:
+        codec_results = codecs(args)
+        for result in codec_results:
+            print(
+                f"{result['codec']:>14}: encode {result['encode_us']:.2f} us decode {result['decode_us']:.2f} us "
+                f"{result['mean_bytes']:.0f} bytes per item, {result['file_bytes']} byte file for {result['items']} items"
+            )
+
+    dynamodb_codec_result = None
+    if args.dynamodb_codec:
+        dynamodb_codec_result = dynamodb_codec_pages(args)
+        result = dynamodb_codec_result
+        print(
+            f"{'dynamodb_codec':>14}: {result['items']} items in a {result['page_bytes']} byte page, "
+            f"json {result['json_ms']:.2f} ms decode {result['decode_ms']:.2f} ms encode {result['encode_ms']:.2f} ms per page"
+        )
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(
+                {
+                    "driver": driver.put.__module__,
+                    "fake_dynamodb": args.fake_dynamodb,
+                    "environment": {
+                        k: v for k, v in os.environ.items() if k.startswith("KVSTORE_")
+                    },
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "time": time.time(),
+                    "args": vars(args),
+                    "results": results,
+                    "codecs": codec_results,
+                    "dynamodb_codec": dynamodb_codec_result,
+                },
+                fp,
+                indent=2,
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""
+An in-process, read-through LRU cache that kvstore.driver puts in front of the
+selected driver when KVSTORE_CACHE_SIZE is set to the maximum number of
+entries to hold.
+
+Results of get(), iterate() and scan_pk() are cached for KVSTORE_CACHE_TTL
+seconds (default 1), or for the number of seconds given for their store in
+KVSTORE_CACHE_TTLS (e.g. "tasks:0.5,config:60", where 0 disables caching for
+that store), and never beyond the item's own ttl. Reads with consistent=True
+always bypass the cache. Writes made through this process invalidate every
+entry for the pk they change, but writes made by other processes are only
+seen once the entry expires, so the TTLs bound how stale a result can be.
+Writes in a transaction() invalidate their pks again once it finishes, since
+the driver may not make them until then.
+
+Counts of hits, misses, evictions and invalidations are kept in stats.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, local
+
+_lock = Lock()
+# key -> (expires, value), in least to most recently used order
+_entries: OrderedDict = OrderedDict()
+# (store, pk) -> set of keys, so that a write can invalidate all of them
+_keys_by_pk: dict[tuple[str, str], set] = {}
+# Incremented on every invalidation. A read only caches its result if no
+# invalidation happened while it was talking to the driver, otherwise it might
+# cache a value that a concurrent write has just replaced.
+_generation = 0
+_miss = object()
+# (store, pk) pairs written in this thread's open transaction, if any
+_transaction = local()
+
+stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+
+def _cache_ttl(store) -> float:
+    for pair in os.environ.get("KVSTORE_CACHE_TTLS", "").split(","):
+        if pair:
+            store_, ttl = pair.split(":")
+            if store_ == store:
+                return float(ttl)
+    return float(os.environ.get("KVSTORE_CACHE_TTL", "1"))
+
+
+def _lookup(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            stats["misses"] += 1
+            return _miss
+        _entries.move_to_end(key)
+        stats["hits"] += 1
+        return entry[1]
+
+
+def _copy(items):
+    # Item data only holds str, int and float values, so copying each dict is
+    # enough to stop callers changing what is cached
+    return [(sk, dict(data), ttl) for sk, data, ttl in items]
+
+
+def _store(key, generation, expires, value):
+    max_size = int(os.environ.get("KVSTORE_CACHE_SIZE", "0"))
+    with _lock:
+        if generation != _generation or expires <= time.time():
+            return
+        _entries[key] = (expires, value)
+        _entries.move_to_end(key)
+        _keys_by_pk.setdefault((key[1], key[2]), set()).add(key)
+        while len(_entries) > max_size:
+            evicted, _ = _entries.popitem(last=False)
+            _forget(evicted)
+            stats["evictions"] += 1
+
+
+def _forget(key):
+    keys = _keys_by_pk.get((key[1], key[2]))
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del _keys_by_pk[(key[1], key[2])]
+
+
+def invalidate(store, pks):
+    global _generation
+    written = getattr(_transaction, "written", None)
+    if written is not None:
+        written.update((store, pk) for pk in pks)
+    with _lock:
+        _generation += 1
+        for pk in pks:
+            for key in _keys_by_pk.pop((store, pk), ()):
+                del _entries[key]
+                stats["invalidations"] += 1
+
+
+def clear():
+    global _generation
+    with _lock:
+        _generation += 1
+        _entries.clear()
+        _keys_by_pk.clear()
+
+
+def _expires(store, ttls):
+    expires = time.time() + _cache_ttl(store)
+    for ttl in ttls:
+        if ttl is not None and ttl < expires:
+            expires = ttl
+    return expires
+
+
+def cached_get(get):
+    def cached(store, pk, sk="/", consistent=False, attributes=None):
+        if attributes is not None:
+            attributes = tuple(attributes)
+        if consistent or _cache_ttl(store) <= 0:
+            return get(store, pk, sk=sk, consistent=consistent, attributes=attributes)
+        key = ("get", store, pk, sk, attributes)
+        cached = _lookup(key)
+        if cached is not _miss:
+            return dict(cached[0]), cached[1]
+        generation = _generation
+        result = get(store, pk, sk=sk, consistent=consistent, attributes=attributes)
+        expires = _expires(store, [result[1]])
+        _store(key, generation, expires, (dict(result[0]), result[1]))
+        return result
+
+    return cached
+
+
+def cached_iterate(iterate):
+    def cached(
+        store,
+        pk,
+        sk_start="/",
+        limit=None,
+        after=False,
+        consistent=False,
+        attributes=None,
+    ):
+        if attributes is not None:
+            attributes = tuple(attributes)
+        if consistent or _cache_ttl(store) <= 0:
+            return iterate(
+                store,
+                pk,
+                sk_start=sk_start,
+                limit=limit,
+                after=after,
+                consistent=consistent,
+                attributes=attributes,
+            )
+        key = ("iterate", store, pk, sk_start, limit, after, attributes)
+        cached = _lookup(key)
+        if cached is not _miss:
+            return _copy(cached[0]), cached[1]
+        generation = _generation
+        result = iterate(
+            store,
+            pk,
+            sk_start=sk_start,
+            limit=limit,
+            after=after,
+            consistent=consistent,
+            attributes=attributes,
+        )
+        expires = _expires(store, [ttl for sk, data, ttl in result[0]])
+        _store(key, generation, expires, (_copy(result[0]), result[1]))
+        return result
+
+    return cached
+
+
+def cached_scan_pk(scan_pk):
+    def cached(store, pk, sk_start="/", after=False, page_size=100, consistent=False):
+        if consistent or _cache_ttl(store) <= 0:
+            yield from scan_pk(
+                store,
+                pk,
+                sk_start=sk_start,
+                after=after,
+                page_size=page_size,
+                consistent=consistent,
+            )
+            return
+        # The items the caller actually consumed are cached, so a later scan
+        # yields those and only goes to the driver for anything beyond them
+        key = ("scan_pk", store, pk, sk_start, after)
+        generation = _generation
+        cached = _lookup(key)
+        if cached is _miss:
+            items, exhausted, expires = [], False, _expires(store, [])
+        else:
+            items, exhausted, expires = list(cached[0]), cached[1], cached[2]
+        # Each item is only copied once the caller gets to it
+        for sk, data, ttl in items:
+            yield sk, dict(data), ttl
+        if exhausted:
+            return
+        if items:
+            sk_start = items[-1][0]
+            after = True
+        try:
+            for item in scan_pk(
+                store,
+                pk,
+                sk_start=sk_start,
+                after=after,
+                page_size=page_size,
+                consistent=consistent,
+            ):
+                items.append((item[0], dict(item[1]), item[2]))
+                if item[2] is not None and item[2] < expires:
+                    expires = item[2]
+                yield item
+            exhausted = True
+        finally:
+            _store(key, generation, expires, (items, exhausted, expires))
+
+    return cached
+
+
+def invalidating_put(put):
+    def invalidating(store, pk, data=None, sk="/", ttl=None, condition=None):
+        try:
+            return put(store, pk, data=data, sk=sk, ttl=ttl, condition=condition)
+        finally:
+            invalidate(store, [pk])
+
+    return invalidating
+
+
+def invalidating_patch(patch):
+    def invalidating(store, pk, data, sk="/", ttl="notchanged", condition=None):
+        try:
+            return patch(store, pk, data=data, sk=sk, ttl=ttl, condition=condition)
+        finally:
+            invalidate(store, [pk])
+
+    return invalidating
+
+
+def invalidating_delete(delete):
+    def invalidating(store, pk, sk="/"):
+        try:
+            return delete(store, pk, sk=sk)
+        finally:
+            invalidate(store, [pk])
+
+    return invalidating
+
+
+def invalidating_put_many(put_many):
+    def invalidating(store, items):
+        items = list(items)
+        try:
+            return put_many(store, items)
+        finally:
+            invalidate(store, set(item[0] for item in items))
+
+    return invalidating
+
+
+def invalidating_delete_many(delete_many):
+    def invalidating(store, keys):
+        keys = list(keys)
+        try:
+            return delete_many(store, keys)
+        finally:
+            invalidate(store, set(key[0] for key in keys))
+
+    return invalidating
+
+
+def invalidating_transaction(transaction):
+    @contextmanager
+    def invalidating():
+        # An enclosing transaction's pks are restored afterwards, and gain
+        # this one's when they are invalidated below
+        outer = getattr(_transaction, "written", None)
+        written = _transaction.written = set()
+        try:
+            with transaction():
+                yield
+        finally:
+            _transaction.written = outer
+            for store, pk in written:
+                invalidate(store, [pk])
+
+    return invalidating
@@ -0,0 +1,68 @@
+"""
+Encodings for the data column of the SQLite driver.
+
+Items written by older versions of the driver are JSON text. New items are
+written with the codec named in KVSTORE_SQLITE_CODEC:
+
+* "marshal" (the default) stores a one byte tag followed by the dictionary in
+  Python's marshal format, as a BLOB. It round-trips float, int and str values
+  exactly, and typically encodes in a third and decodes in half the time of
+  JSON (see bench.py --codecs)
+* "json" stores JSON text exactly as before, for databases that need to be
+  read by other tools or by older versions of the driver
+
+decode() chooses the decoder from the stored value itself, so rows written
+with either codec can be mixed in the same database, and migrate() in the
+driver converts existing rows from one to the other.
+"""
+
+import json
+import marshal
+import os
+
+# Stored as the first byte of every marshal encoded value, so that the format
+# can be changed later without having to guess what a BLOB contains
+_MARSHAL_TAG = 1
+# Version 4 has been the default since Python 3.4 and marshal.loads() reads
+# every earlier version, so values written now stay readable on later Pythons
+_MARSHAL_VERSION = 4
+
+
+def encode_json(data) -> str:
+    return json.dumps(data)
+
+
+def encode_marshal(data) -> bytes:
+    return bytes([_MARSHAL_TAG]) + marshal.dumps(data, _MARSHAL_VERSION)
+
+
+encoders = {
+    "json": encode_json,
+    "marshal": encode_marshal,
+}
+
+
+def name():
+    codec = os.environ.get("KVSTORE_SQLITE_CODEC", "marshal")
+    assert codec in encoders, f"Unknown KVSTORE_SQLITE_CODEC {repr(codec)}"
+    return codec
+
+
+def encode(data):
+    return encoders[name()](data)
+
+
+def encoded_with(value) -> str:
+    if isinstance(value, str):
+        return "json"
+    if value[0] == _MARSHAL_TAG:
+        return "marshal"
+    raise Exception(f"Unknown codec tag {value[0]}")
+
+
+def decode(value):
+    if isinstance(value, str):
+        return json.loads(value)
+    if value[0] == _MARSHAL_TAG:
+        return marshal.loads(memoryview(value)[1:])
+    raise Exception(f"Unknown codec tag {value[0]}")
@@ -1,15 +1,182 @@
 import os
+import random
 import time
+from contextlib import contextmanager
+from threading import Lock, local
 from typing import Any
 
-import boto3
+from . import dynamodb_codec
+from .shared import (
+    ConditionFailed,
+    NotExists,
+    NotFound,
+    Remove,
+    Transaction,
+    check_attributes,
+    check_condition,
+)
 
-from .shared import NotFound, Remove
+# boto3 takes a noticeable part of a Lambda cold start to import, so the client
+# is only created on first use, and then kept for the life of the container
+dynamodb: Any = None
+_lock = Lock()
 
-dynamodb = boto3.client(service_name="dynamodb", region_name=os.environ["AWS_REGION"])
+# Responses with these codes mean requests are being throttled
+_throttling_codes = {
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ThrottlingException",
+}
+_retry_modes = ("legacy", "standard", "adaptive")
 
 
-def put(store, pk, data=None, sk="/", ttl=None):
+def config():
+    """
+    The client settings, from environment variables read when the client is
+    created. These are the botocore.config.Config arguments, and the asyncio
+    client in aio_dynamodb.py uses the same ones.
+
+    KVSTORE_DYNAMODB_MAX_POOL_CONNECTIONS  kept-alive connections (default 50)
+    KVSTORE_DYNAMODB_TCP_KEEPALIVE         TCP keep-alive probes (default true)
+    KVSTORE_DYNAMODB_RETRY_MODE            legacy, standard or adaptive
+                                           (default adaptive)
+    KVSTORE_DYNAMODB_MAX_ATTEMPTS          attempts per call, including the
+                                           first (default 10)
+    KVSTORE_DYNAMODB_CONNECT_TIMEOUT       seconds (default 2)
+    KVSTORE_DYNAMODB_READ_TIMEOUT          seconds (default 10)
+    """
+    mode = os.environ.get("KVSTORE_DYNAMODB_RETRY_MODE", "adaptive")
+    assert (
+        mode in _retry_modes
+    ), f"KVSTORE_DYNAMODB_RETRY_MODE must be one of {_retry_modes}"
+    max_attempts = int(os.environ.get("KVSTORE_DYNAMODB_MAX_ATTEMPTS", "10"))
+    assert max_attempts > 0, "KVSTORE_DYNAMODB_MAX_ATTEMPTS must be at least 1"
+    return dict(
+        max_pool_connections=int(
+            os.environ.get("KVSTORE_DYNAMODB_MAX_POOL_CONNECTIONS", "50")
+        ),
+        tcp_keepalive=os.environ.get("KVSTORE_DYNAMODB_TCP_KEEPALIVE", "true").lower()
+        == "true",
+        connect_timeout=float(os.environ.get("KVSTORE_DYNAMODB_CONNECT_TIMEOUT", "2")),
+        read_timeout=float(os.environ.get("KVSTORE_DYNAMODB_READ_TIMEOUT", "10")),
+        retries={"mode": mode, "total_max_attempts": max_attempts},
+    )
+
+
+def _client():
+    global dynamodb
+    if dynamodb is None:
+        with _lock:
+            if dynamodb is None:
+                import boto3
+                from botocore.config import Config
+
+                client = boto3.client(
+                    service_name="dynamodb",
+                    region_name=os.environ["AWS_REGION"],
+                    config=Config(**config()),
+                )
+                # Called after every attempt, including ones that are retried
+                client.meta.events.register("needs-retry.dynamodb", _count_throttle)
+                dynamodb = client
+    return dynamodb
+
+
+# Retries and throttles are counted per operation, and for the most recent
+# call on each thread
+_stats: dict[str, dict[str, int]] = {}
+_stats_lock = Lock()
+_last = local()
+
+
+def _count_throttle(response=None, **kwargs):
+    # response is (http_response, parsed) or None if there was no response
+    if response is not None:
+        code = response[1].get("Error", {}).get("Code")
+        if code in _throttling_codes:
+            _last.throttles = getattr(_last, "throttles", 0) + 1
+
+
+def _record(operation, retries, throttles):
+    with _stats_lock:
+        counts = _stats.setdefault(
+            operation, {"calls": 0, "retries": 0, "throttles": 0}
+        )
+        counts["calls"] += 1
+        counts["retries"] += retries
+        counts["throttles"] += throttles
+    _last.call = {"operation": operation, "retries": retries, "throttles": throttles}
+
+
+def stats(reset=False):
+    """
+    Return the number of calls, retries and throttled responses so far for
+    each low-level operation, e.g.
+    {"get_item": {"calls": 10, "retries": 1, "throttles": 1}}
+    """
+    with _stats_lock:
+        result = {operation: dict(counts) for operation, counts in _stats.items()}
+        if reset:
+            _stats.clear()
+    return result
+
+
+def last_call():
+    """
+    Return the operation, retries and throttles of the most recent low-level
+    call made by this thread, or None.
+    """
+    return getattr(_last, "call", None)
+
+
+# Each operation is written as a generator that yields (operation, kwargs)
+# requests for the low-level client and is sent back each response (or has the
+# client's exception thrown into it), returning its result when it finishes.
+# ("sleep", seconds) asks for a pause, e.g. before retrying unprocessed items.
+# _run() drives them with the boto3 client here, and kvstore.driver.aio drives
+# the same generators with an asyncio HTTP client.
+def _run(steps):
+    response = None
+    error = None
+    while True:
+        try:
+            if error is None:
+                operation, kwargs = steps.send(response)
+            else:
+                operation, kwargs = steps.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        response = None
+        error = None
+        if operation == "sleep":
+            time.sleep(kwargs)
+            continue
+        _last.throttles = 0
+        try:
+            response = getattr(_client(), operation)(**kwargs)
+        except Exception as e:
+            error = e
+        # botocore reports the attempts it retried in the response metadata
+        metadata = response if error is None else getattr(error, "response", None)
+        if not isinstance(metadata, dict):
+            metadata = {}
+        _record(
+            operation,
+            metadata.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+            _last.throttles,
+        )
+
+
+def _error_code(e):
+    # botocore's ClientError, and the errors raised by the asyncio client and
+    # the fake, carry the service's error code in the same place
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code")
+    return None
+
+
+def _item(store, pk, data, sk, ttl):
     if data is None:
         data = {}
     assert "/" not in store
@@ -23,11 +190,226 @@ def put(store, pk, data=None, sk="/", ttl=None):
     }
     if ttl:
         item["ttl"] = {"N": str(ttl)}
-    item.update(_data_to_dynamo_format(data))
-    dynamodb.put_item(
+    item.update(dynamodb_codec.encode(data))
+    return item
+
+
+def put(store, pk, data=None, sk="/", ttl=None, condition=None):
+    return _write(store, pk, sk, _put(store, pk, data, sk, ttl, condition))
+
+
+def _put(store, pk, data, sk, ttl, condition):
+    args = dict(
         TableName=os.environ["KVSTORE_DYNAMODB_TABLE_NAME"],
-        Item=item,
+        Item=_item(store, pk, data, sk, ttl),
     )
+    _add_condition(args, condition)
+    try:
+        yield "put_item", args
+    except Exception as e:
+        if _error_code(e) != "ConditionalCheckFailedException":
+            raise
+        raise ConditionFailed(
+            f"Condition {repr(condition)} failed for pk '{pk}' and sk '{sk}' in the '{store}' store"
+        )
+
+
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.ConditionExpressions.html
+def _add_condition(args, condition):
+    check_condition(condition)
+    if condition is None:
+        return
+    names = {"#pk": "pk", "#ttl": "ttl"}
+    values = {":_now": {"N": str(time.time())}}
+    # Items that have expired but that DynamoDB hasn't deleted yet don't count as existing
+    if condition is NotExists:
+        expression = "attribute_not_exists(#pk) OR #ttl <= :_now"
+    else:
+        parts = [
+            "attribute_exists(#pk)",
+            "(attribute_not_exists(#ttl) OR #ttl > :_now)",
+        ]
+        for i, (k, v) in enumerate(condition.items()):
+            names[f"#_cond{i}"] = k
+            if v is NotExists:
+                parts.append(f"attribute_not_exists(#_cond{i})")
+            else:
+                values[f":_cond{i}"] = dynamodb_codec.encode_value(k, v)
+                parts.append(f"#_cond{i} = :_cond{i}")
+        expression = " AND ".join(parts)
+    args["ConditionExpression"] = expression
+    args.setdefault("ExpressionAttributeNames", {}).update(names)
+    args.setdefault("ExpressionAttributeValues", {}).update(values)
+
+
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/batch-operation-document-path.html
+BATCH_WRITE_SIZE = 25
+BATCH_MAX_ATTEMPTS = 8
+
+
+def _batch_write(requests):
+    table_name = os.environ["KVSTORE_DYNAMODB_TABLE_NAME"]
+    for i in range(0, len(requests), BATCH_WRITE_SIZE):
+        request_items = {table_name: requests[i : i + BATCH_WRITE_SIZE]}
+        attempt = 0
+        while request_items:
+            r = yield "batch_write_item", dict(RequestItems=request_items)
+            request_items = r.get("UnprocessedItems") or {}
+            if request_items:
+                attempt += 1
+                if attempt >= BATCH_MAX_ATTEMPTS:
+                    raise Exception(
+                        f"Gave up writing {len(request_items[table_name])} unprocessed items after {attempt} attempts"
+                    )
+                # Unprocessed items usually mean the table is being throttled, so back off with jitter
+                yield "sleep", random.uniform(0, min(0.05 * 2**attempt, 2))
+
+
+def put_many(store, items):
+    """
+    Put (pk, sk, data, ttl) items using BatchWriteItem. Each batch is applied
+    item by item, so unlike the SQLite driver the items are not written
+    atomically, unless this is in a transaction().
+    """
+    if getattr(_transactions, "transaction", None) is not None:
+        for pk, sk, data, ttl in items:
+            _write(store, pk, sk, _put(store, pk, data, sk, ttl, None))
+        return
+    return _run(_put_many(store, items))
+
+
+def _put_many(store, items):
+    # A batch can't contain the same key twice, the last item for a key wins
+    requests = {}
+    for pk, sk, data, ttl in items:
+        requests[(pk, sk)] = {"PutRequest": {"Item": _item(store, pk, data, sk, ttl)}}
+    return (yield from _batch_write(list(requests.values())))
+
+
+def delete_many(store, keys):
+    """Delete (pk, sk) keys using BatchWriteItem, or in a transaction()."""
+    if getattr(_transactions, "transaction", None) is not None:
+        for pk, sk in keys:
+            _write(store, pk, sk, _delete(store, pk, sk))
+        return
+    return _run(_delete_many(store, keys))
+
+
+def _delete_many(store, keys):
+    assert "/" not in store
+    requests = {}
+    for pk, sk in keys:
+        assert sk[0] == "/"
+        requests[(pk, sk)] = {
+            "DeleteRequest": {
+                "Key": {
+                    "pk": {"S": f"{store}/{pk}"},
+                    "sk": {"S": sk},
+                }
+            }
+        }
+    return (yield from _batch_write(list(requests.values())))
+
+
+# The open transaction() in this thread, if any
+_transactions = local()
+_transact_types = {"put_item": "Put", "update_item": "Update", "delete_item": "Delete"}
+# https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_TransactWriteItems.html
+_retryable_cancellations = {
+    "None",
+    "ProvisionedThroughputExceeded",
+    "ThrottlingError",
+    "TransactionConflict",
+}
+
+
+class _Transaction(Transaction):
+    def __init__(self):
+        super().__init__()
+        # (steps, operation, args) for each write, where steps is the write's
+        # generator, paused at its request
+        self.writes = []
+
+
+class _CheckFailed(Exception):
+    # Thrown into a write whose condition cancelled the transaction, which
+    # then raises ConditionFailed just as it would on its own
+    response = {"Error": {"Code": "ConditionalCheckFailedException"}}
+
+
+def _write(store, pk, sk, steps):
+    # Make a write now, or add it to the open transaction
+    transaction = getattr(_transactions, "transaction", None)
+    if transaction is None:
+        return _run(steps)
+    transaction.add(store, pk, sk)
+    operation, args = next(steps)
+    transaction.writes.append((steps, operation, args))
+
+
+@contextmanager
+def transaction():
+    """
+    Collect the writes in the body and make them in one TransactWriteItems
+    call once it finishes, so that either all of them succeed or none do. If
+    the body raises, none of them are made.
+
+    Conditions are only checked when the writes are made, so a ConditionFailed
+    is raised at the end of the body rather than by the write, and reads in
+    the body don't see its writes.
+    """
+    assert (
+        getattr(_transactions, "transaction", None) is None
+    ), "Transactions can't be nested"
+    transaction = _transactions.transaction = _Transaction()
+    try:
+        yield
+    finally:
+        _transactions.transaction = None
+    if transaction.writes:
+        _run(_transact(transaction.writes))
+
+
+def transactable(store, pks):
+    """
+    Whether writes to all of pks in store can be made in one transaction(),
+    which they always can, up to its limit on the number of writes.
+    """
+    return True
+
+
+def _transact(writes):
+    items = [{_transact_types[operation]: args} for steps, operation, args in writes]
+    attempt = 0
+    while True:
+        try:
+            yield "transact_write_items", dict(TransactItems=items)
+            break
+        except Exception as e:
+            if _error_code(e) != "TransactionCanceledException":
+                raise
+            # Like _error_code(), the reasons are in the same place for each
+            # client
+            response = getattr(e, "response", {})
+            reasons = [
+                reason.get("Code", "None")
+                for reason in response.get("CancellationReasons", [])
+            ]
+            for (steps, operation, args), code in zip(writes, reasons):
+                if code == "ConditionalCheckFailed":
+                    steps.throw(_CheckFailed())
+            attempt += 1
+            if not set(reasons) <= _retryable_cancellations or (
+                attempt >= BATCH_MAX_ATTEMPTS
+            ):
+                raise
+            # Conflicts with other writes to the same items, or throttling
+            yield "sleep", random.uniform(0, min(0.05 * 2**attempt, 2))
+    for steps, operation, args in writes:
+        try:
+            steps.send(None)
+        except StopIteration:
+            pass
 
 
 # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.UpdateExpressions.html#Expressions.UpdateExpressions.Multiple
@@ -44,15 +426,7 @@ def _data_to_dynamo_update_format(data, ttl):
         if v is Remove:
             to_remove.append(k)
         else:
-            if isinstance(v, (int, float)):
-                value = {"N": str(v)}
-            elif isinstance(data[k], str):
-                value = {"S": v}
-            else:
-                raise Exception(
-                    f"Value {repr(data[k])} for key '{k}' is not a string or number"
-                )
-            to_update[k] = value
+            to_update[k] = dynamodb_codec.encode_value(k, v)
     if ttl is None:
         to_remove.append("ttl")
     elif ttl != "notchanged":
@@ -74,9 +448,16 @@ def _data_to_dynamo_update_format(data, ttl):
     return update_expression, expression_attribute_values, expression_attribute_names
 
 
-def patch(store, pk, data, sk="/", ttl="notchanged"):
+def patch(store, pk, data, sk="/", ttl="notchanged", condition=None):
+    return _write(store, pk, sk, _patch(store, pk, data, sk, ttl, condition))
+
+
+def _patch(store, pk, data, sk, ttl, condition):
     assert "/" not in store
     assert sk[0] == "/"
+    assert (
+        condition is not NotExists
+    ), "patch() only changes existing items, use put() with condition=NotExists to create one"
     if ttl not in [None, "notchanged"]:
         assert isinstance(ttl, (int, float)), ttl
     actual_pk = f"{store}/{pk}"
@@ -97,14 +478,26 @@ def patch(store, pk, data, sk="/", ttl="notchanged"):
         args["ExpressionAttributeValues"] = expression_attribute_values
     if expression_attribute_names:
         args["ExpressionAttributeNames"] = expression_attribute_names
-    dynamodb.update_item(**args)
+    _add_condition(args, condition)
+    try:
+        yield "update_item", args
+    except Exception as e:
+        if _error_code(e) != "ConditionalCheckFailedException":
+            raise
+        raise ConditionFailed(
+            f"Condition {repr(condition)} failed for pk '{pk}' and sk '{sk}' in the '{store}' store"
+        )
 
 
 def delete(store, pk, sk="/"):
+    return _write(store, pk, sk, _delete(store, pk, sk))
+
+
+def _delete(store, pk, sk):
     assert "/" not in store
     assert sk[0] == "/"
     actual_pk = f"{store}/{pk}"
-    dynamodb.delete_item(
+    yield "delete_item", dict(
         TableName=os.environ["KVSTORE_DYNAMODB_TABLE_NAME"],
         Key={
             "pk": {"S": actual_pk},
@@ -114,7 +507,7 @@ def delete(store, pk, sk="/"):
 
 
 def iterate(
-    store, pk, sk_start="/", limit=None, after=False, consistent=False
+    store, pk, sk_start="/", limit=None, after=False, consistent=False, attributes=None
 ) -> tuple[Any, str | None]:
     """
         https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.Pagination.html
@@ -137,71 +530,24 @@ def iterate(
 
     In other words, the LastEvaluatedKey from a Query response should be used as the ExclusiveStartKey for the next Query request. If there is not a LastEvaluatedKey element in a Query response, then you have retrieved the final page of results. If LastEvaluatedKey is not empty, it does not necessarily mean that there is more data in the result set. The only way to know when you have reached the end
     """
+    return _run(_iterate(store, pk, sk_start, limit, after, consistent, attributes))
+
+
+def _iterate(store, pk, sk_start, limit, after, consistent, attributes=None):
     assert "/" not in store
     assert sk_start[0] == "/"
-    actual_pk = f"{store}/{pk}"
-
-    if sk_start:
-        # Should we be using ExclusiveStartKey here?
-        # Shouldn't it be sk_start_after if a key is specified at all?
-        if after:
-            operator = ">"
-        else:
-            operator = ">="
-        args = dict(
-            TableName=os.environ["KVSTORE_DYNAMODB_TABLE_NAME"],
-            ConsistentRead=consistent,
-            KeyConditionExpression="(#pk = :pk) AND (#sk " + operator + " :sk)",
-            ExpressionAttributeNames={
-                "#pk": "pk",
-                "#sk": "sk",
-            },
-            ExpressionAttributeValues={
-                # WARNING: The values do not seem to be type checked currently.
-                ":pk": {"S": actual_pk},
-                ":sk": {"S": sk_start},
-            },
-        )
-    else:
-        args = dict(
-            TableName=os.environ["KVSTORE_DYNAMODB_TABLE_NAME"],
-            ConsistentRead=consistent,
-            KeyConditionExpression="(#pk = :pk)",
-            ExpressionAttributeNames={
-                "#pk": "pk",
-            },
-            ExpressionAttributeValues={
-                # WARNING: The value does not seem to be type checked currently.
-                ":pk": {"S": actual_pk},
-            },
-        )
+    check_attributes(attributes)
+    args = _query_args(store, pk, sk_start, after, consistent)
+    _add_projection(args, attributes)
     if limit:
-        args["Limit"] = limit
-    # Need to add a filter expression for expired items. It could take days for DynamoDB to actually get around to expiring them
-    args["FilterExpression"] = "#ttl > :ttl or attribute_not_exists(#ttl) "
-    args["ExpressionAttributeNames"]["#ttl"] = "ttl"
-    args["ExpressionAttributeValues"][":ttl"] = {"N": str(time.time())}
-    r = dynamodb.query(**args)
-    results = []
-    for item in r["Items"]:
-        parts = item["pk"]["S"].split("/")
-        store = parts[0]
-        pk = "/".join(parts[1:])
-        sk = item["sk"]["S"]
-        assert sk[0] == "/"
-        # sk = sk[1:]
-        del item["pk"]
-        del item["sk"]
-        ttl = None
-        if "ttl" in item:
-            ttl = float(item["ttl"]["N"])
-            del item["ttl"]
-        data = _data_from_dynamo_format(item)
-        results.append((sk, data, ttl))
+        # One extra item shows whether there is anything after the page
+        args["Limit"] = limit + 1
+    r = yield "query", args
+    results = dynamodb_codec.decode_page(r["Items"])
     if len(results) == 0 and not r.get("LastEvaluatedKey"):
         raise NotFound(f"No such pk '{pk}' in the '{store}' store")
-    if len(results) == limit:
-        return results, None
+    if limit and len(results) > limit:
+        return results[:limit], results[limit - 1][0]
     else:
         return (
             results,
@@ -210,13 +556,97 @@ def iterate(
         )
 
 
+def scan_pk(store, pk, sk_start="/", after=False, page_size=100, consistent=False):
+    """
+    Lazily yield every (sk, data, ttl) in the pk, in sk order, fetching up to
+    page_size items per Query and following LastEvaluatedKey with
+    ExclusiveStartKey until the partition is exhausted. Unlike iterate(), no
+    NotFound is raised for an empty pk, nothing is yielded instead.
+    """
+    args = _scan_pk_args(store, pk, sk_start, after, page_size, consistent)
+    while True:
+        items, more = _run(_scan_pk_page(args))
+        yield from items
+        if not more:
+            return
+
+
+def _scan_pk_args(store, pk, sk_start, after, page_size, consistent):
+    assert "/" not in store
+    assert sk_start[0] == "/"
+    assert page_size > 0, page_size
+    args = _query_args(store, pk, sk_start, after, consistent)
+    args["Limit"] = page_size
+    return args
+
+
+def _scan_pk_page(args):
+    # Returns the next page of (sk, data, ttl) items and whether there might be
+    # more, updating args to carry on from the end of the page
+    # Items can be expired after the filter expression was evaluated
+    args["ExpressionAttributeValues"][":ttl"] = {"N": str(time.time())}
+    r = yield "query", args
+    items = dynamodb_codec.decode_page(r["Items"])
+    if not r.get("LastEvaluatedKey"):
+        return items, False
+    args["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+    return items, True
+
+
+def _query_args(store, pk, sk_start, after, consistent):
+    if after:
+        operator = ">"
+    else:
+        operator = ">="
+    args = dict(
+        TableName=os.environ["KVSTORE_DYNAMODB_TABLE_NAME"],
+        ConsistentRead=consistent,
+        KeyConditionExpression="(#pk = :pk) AND (#sk " + operator + " :sk)",
+        ExpressionAttributeNames={
+            "#pk": "pk",
+            "#sk": "sk",
+        },
+        ExpressionAttributeValues={
+            # WARNING: The values do not seem to be type checked currently.
+            ":pk": {"S": f"{store}/{pk}"},
+            ":sk": {"S": sk_start},
+        },
+    )
+    # Need to add a filter expression for expired items. It could take days for DynamoDB to actually get around to expiring them
+    args["FilterExpression"] = "#ttl > :ttl or attribute_not_exists(#ttl) "
+    args["ExpressionAttributeNames"]["#ttl"] = "ttl"
+    args["ExpressionAttributeValues"][":ttl"] = {"N": str(time.time())}
+    return args
+
+
+def _add_projection(args, attributes):
+    # Only the named attributes are returned, which saves transferring and
+    # decoding the rest (reads are still charged for the whole item). The key
+    # and ttl are always needed to decode the item and check its expiry.
+    if attributes is None:
+        return
+    attributes = list(attributes)
+    names = args.setdefault("ExpressionAttributeNames", {})
+    names.update({"#pk": "pk", "#sk": "sk", "#ttl": "ttl"})
+    for i, k in enumerate(attributes):
+        names[f"#_attr{i}"] = k
+    args["ProjectionExpression"] = ", ".join(
+        ["#pk", "#sk", "#ttl"] + [f"#_attr{i}" for i in range(len(attributes))]
+    )
+
+
 def get(
-    store, pk, sk="/", consistent=False
+    store, pk, sk="/", consistent=False, attributes=None
 ) -> tuple[dict[str, int | float | str], float | int | None]:
+    return _run(_get(store, pk, sk, consistent, attributes))
+
+
+def _get(store, pk, sk, consistent, attributes=None):
     assert "/" not in store
     assert sk[0] == "/"
+    check_attributes(attributes)
     actual_pk = f"{store}/{pk}"
-    r = dynamodb.get_item(
+    args = dict(
         TableName=os.environ["KVSTORE_DYNAMODB_TABLE_NAME"],
         ConsistentRead=consistent,
         Key={
@@ -224,57 +654,63 @@ def get(
             "sk": {"S": sk},
         },
     )
+    _add_projection(args, attributes)
+    r = yield "get_item", args
     if "Item" not in r:
         raise NotFound(f"No such pk '{pk}' in the '{store}' store")
-    parts = r["Item"]["pk"]["S"].split("/")
-    store = parts[0]
-    pk = "/".join(parts[1:])
-    sk = r["Item"]["sk"]["S"]
-    assert sk[0] == "/"
-    del r["Item"]["pk"]
-    del r["Item"]["sk"]
-    ttl = None
-    if "ttl" in r["Item"]:
-        ttl = float(r["Item"]["ttl"]["N"])
-        del r["Item"]["ttl"]
+    pk_, sk, data, ttl = dynamodb_codec.decode(r["Item"])
     if ttl is not None and ttl < time.time():
         raise NotFound(f"No such pk '{pk}' in the '{store}' store")
-    data = _data_from_dynamo_format(r["Item"])
     return data, ttl
 
 
-def _data_to_dynamo_format(data):
-    assert "pk" not in data
-    assert "sk" not in data
-    assert "ttl" not in data
-    result = {}
-    for k in data:
-        assert isinstance(k, str)
-        if isinstance(data[k], int) or isinstance(data[k], float):
-            value = {"N": str(data[k])}
-        elif isinstance(data[k], str):
-            value = {"S": data[k]}
-        else:
-            raise Exception(
-                f"Value {repr(data[k])} for key '{k}' is not a string or number"
-            )
-        result[k] = value
-    return result
+# https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchGetItem.html
+BATCH_GET_SIZE = 100
 
 
-def _data_from_dynamo_format(data):
-    assert "pk" not in data
-    assert "sk" not in data
-    assert "ttl" not in data
-    result = {}
-    for k in data:
-        assert isinstance(k, str)
-        if "N" in data[k]:
-            result[k] = float(data[k]["N"])
-        elif "S" in data[k]:
-            result[k] = data[k]["S"]
-        else:
-            raise Exception(
-                f"Value {repr(data[k])} for key '{k}' cannot be converted to a string or number"
-            )
-    return result
+def get_many(
+    store, keys, consistent=False
+) -> tuple[
+    dict[tuple[str, str], tuple[dict[str, int | float | str], float | int | None]],
+    list[tuple[str, str]],
+]:
+    """
+    Get the (pk, sk) keys using BatchGetItem, returning a dictionary of
+    (data, ttl) results keyed by (pk, sk), and a list of the keys that were
+    not found.
+    """
+    return _run(_get_many(store, keys, consistent))
+
+
+def _get_many(store, keys, consistent):
+    assert "/" not in store
+    table_name = os.environ["KVSTORE_DYNAMODB_TABLE_NAME"]
+    # A batch can't contain the same key twice
+    unique_keys = list(dict.fromkeys((pk, sk) for pk, sk in keys))
+    found = {}
+    now = time.time()
+    for i in range(0, len(unique_keys), BATCH_GET_SIZE):
+        request_keys = []
+        for pk, sk in unique_keys[i : i + BATCH_GET_SIZE]:
+            assert sk[0] == "/"
+            request_keys.append({"pk": {"S": f"{store}/{pk}"}, "sk": {"S": sk}})
+        request_items = {
+            table_name: {"Keys": request_keys, "ConsistentRead": consistent}
+        }
+        attempt = 0
+        while request_items:
+            r = yield "batch_get_item", dict(RequestItems=request_items)
+            for item in r["Responses"].get(table_name, []):
+                pk, sk, data, ttl = dynamodb_codec.decode(item)
+                if ttl is None or ttl > now:
+                    found[(pk, sk)] = (data, ttl)
+            request_items = r.get("UnprocessedKeys") or {}
+            if request_items:
+                attempt += 1
+                if attempt >= BATCH_MAX_ATTEMPTS:
+                    raise Exception(
+                        f"Gave up reading {len(request_items[table_name]['Keys'])} unprocessed keys after {attempt} attempts"
+                    )
+                yield "sleep", random.uniform(0, min(0.05 * 2**attempt, 2))
+    missing = [key for key in unique_keys if key not in found]
+    return found, missing
@@ -0,0 +1,88 @@
+"""
+Conversion between item data and DynamoDB's attribute value format.
+
+Data values are strings, which are stored as {"S": value}, or numbers, which
+are stored as {"N": str(value)}. DynamoDB normalises numbers, so they are
+decoded as an int when the stored text has no fraction or exponent and as a
+float otherwise. Ints round trip exactly, as do floats with a fractional part,
+while a float with an integral value (e.g. 2.0) comes back as the equal int.
+
+Every item is decoded with one pass over its attributes into the data dict,
+with no intermediate dicts and without changing the response, since a whole
+Query page of up to 1 MB is decoded for every iterate() or scan_pk() call.
+See `bench.py --dynamodb-codec` for timings.
+"""
+
+_reserved = ("pk", "sk", "ttl")
+
+
+def encode_value(k, v):
+    if isinstance(v, str):
+        return {"S": v}
+    if isinstance(v, (int, float)):
+        return {"N": str(v)}
+    raise Exception(f"Value {repr(v)} for key '{k}' is not a string or number")
+
+
+def encode(data):
+    """Return the attribute values for item data."""
+    for k in _reserved:
+        assert k not in data, k
+    result = {}
+    for k, v in data.items():
+        assert isinstance(k, str)
+        # Most values are strings, so check for those first
+        if type(v) is str:
+            result[k] = {"S": v}
+        else:
+            result[k] = encode_value(k, v)
+    return result
+
+
+def _attributes(item):
+    data = {}
+    for k, value in item.items():
+        # Strings are the most common type, so check for them first
+        v = value.get("S")
+        if v is not None:
+            data[k] = v
+            continue
+        v = value.get("N")
+        if v is None:
+            raise Exception(
+                f"Value {repr(value)} for key '{k}' cannot be converted to a string or number"
+            )
+        if "." in v or "e" in v or "E" in v:
+            data[k] = float(v)
+        else:
+            data[k] = int(v)
+    return data
+
+
+def decode(item):
+    """
+    Return (pk, sk, data, ttl) for an item from a GetItem or BatchGetItem
+    response, where pk is without its store/ prefix.
+    """
+    data = _attributes(item)
+    pk = data.pop("pk").split("/", 1)[1]
+    sk = data.pop("sk")
+    assert sk[0] == "/"
+    ttl = data.pop("ttl", None)
+    return pk, sk, data, None if ttl is None else float(ttl)
+
+
+def decode_page(items):
+    """
+    Return (sk, data, ttl) for each item in a Query response page, all of
+    which have the same pk.
+    """
+    results = []
+    for item in items:
+        data = _attributes(item)
+        del data["pk"]
+        sk = data.pop("sk")
+        assert sk[0] == "/"
+        ttl = data.pop("ttl", None)
+        results.append((sk, data, None if ttl is None else float(ttl)))
+    return results
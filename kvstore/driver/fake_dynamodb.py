@@ -0,0 +1,789 @@
+"""
+An in-process stand-in for the subset of DynamoDB that
+kvstore.driver.dynamodb uses, so that the driver can be tested and
+benchmarked without AWS. Install it (with KVSTORE_DYNAMODB_TABLE_NAME and
+AWS_REGION set) with:
+
+    from kvstore.driver import fake_dynamodb
+
+    fake = fake_dynamodb.install(latency=0.005, throttle_rate=0.1)
+
+Tables are created on first use with a string pk hash key and string sk range
+key. Condition, key condition, filter, update and projection expressions are
+parsed and evaluated, Query honours Limit, ExclusiveStartKey and the 1 MB page
+size, and the batch operations enforce the service's request size limits.
+
+Each request can be delayed by a latency in seconds (uniformly jittered by
++/-50%) and throttled, with ProvisionedThroughputExceededException, at a
+throttle_rate between 0 and 1. install() takes the defaults for these from
+KVSTORE_FAKE_DYNAMODB_LATENCY_MS and KVSTORE_FAKE_DYNAMODB_THROTTLE_RATE. The
+Client that it installs in place of the boto3 client retries throttled
+requests and reports retries as botocore does, backing off for at most
+KVSTORE_FAKE_DYNAMODB_MAX_BACKOFF_MS (default 1000) between attempts. Set
+KVSTORE_FAKE_DYNAMODB_SEED to make the latency, throttling and backoff the
+same on every run.
+
+serve() makes the same fake available over DynamoDB's HTTP JSON protocol for
+clients that talk to the service directly, like kvstore.driver.aio.
+"""
+
+import asyncio
+import copy
+import functools
+import json
+import os
+import random
+import re
+import time
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal
+from threading import Lock, RLock
+from typing import Any, Callable
+
+
+class ServiceError(Exception):
+    """
+    Like botocore's ClientError, the error code is in
+    response["Error"]["Code"].
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.response = {"Error": {"Code": type(self).__name__, "Message": message}}
+
+
+class ValidationException(ServiceError):
+    pass
+
+
+class ConditionalCheckFailedException(ServiceError):
+    pass
+
+
+class ProvisionedThroughputExceededException(ServiceError):
+    pass
+
+
+class TransactionCanceledException(ServiceError):
+    def __init__(self, message, reasons):
+        super().__init__(message)
+        self.response["CancellationReasons"] = reasons
+
+
+class Exceptions:
+    ValidationException = ValidationException
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+    ProvisionedThroughputExceededException = ProvisionedThroughputExceededException
+    TransactionCanceledException = TransactionCanceledException
+
+
+_token_re = re.compile(r"\s*(?:(<>|<=|>=|=|<|>|\(|\)|,)|([#:]?[A-Za-z_][A-Za-z0-9_]*))")
+_keywords = {"AND", "OR", "NOT", "BETWEEN", "SET", "REMOVE"}
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        m = _token_re.match(expression, pos)
+        if not m:
+            raise ValidationException(
+                f"Invalid expression {repr(expression)} at {repr(expression[pos:])}"
+            )
+        token = m.group(1) or m.group(2)
+        if token.upper() in _keywords:
+            token = token.upper()
+        tokens.append(token)
+        pos = m.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, expression, names, values):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValidationException(f"Expected {expected} but got {token}")
+        self.pos += 1
+        return token
+
+    def operand(self):
+        token = self.take()
+        if token.startswith("#"):
+            if token not in self.names:
+                raise ValidationException(f"Undefined attribute name {token}")
+            return ("name", self.names[token])
+        if token.startswith(":"):
+            if token not in self.values:
+                raise ValidationException(f"Undefined attribute value {token}")
+            return ("value", self.values[token])
+        return ("name", token)
+
+    # Conditions
+    def condition(self):
+        node = self.conjunction()
+        while self.peek() == "OR":
+            self.take()
+            node = ("or", node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.peek() == "AND":
+            self.take()
+            node = ("and", node, self.negation())
+        return node
+
+    def negation(self):
+        if self.peek() == "NOT":
+            self.take()
+            return ("not", self.negation())
+        return self.primary()
+
+    def primary(self):
+        if self.peek() == "(":
+            self.take()
+            node = self.condition()
+            self.take(")")
+            return node
+        if self.peek() in ("attribute_exists", "attribute_not_exists", "begins_with"):
+            function = self.take()
+            self.take("(")
+            args = [self.operand()]
+            while self.peek() == ",":
+                self.take()
+                args.append(self.operand())
+            self.take(")")
+            return ("call", function, args)
+        left = self.operand()
+        operator = self.take()
+        if operator == "BETWEEN":
+            low = self.operand()
+            self.take("AND")
+            return ("between", left, low, self.operand())
+        if operator not in ("=", "<>", "<", "<=", ">", ">="):
+            raise ValidationException(f"Unsupported operator {operator}")
+        return ("compare", operator, left, self.operand())
+
+    def parse_condition(self):
+        node = self.condition()
+        if self.peek() is not None:
+            raise ValidationException(f"Unexpected {self.peek()}")
+        return node
+
+    # Updates
+    def parse_update(self):
+        to_set = []
+        to_remove = []
+        while self.peek() is not None:
+            section = self.take()
+            while True:
+                if section == "SET":
+                    name = self.operand()
+                    self.take("=")
+                    to_set.append((name[1], self.operand()[1]))
+                elif section == "REMOVE":
+                    to_remove.append(self.operand()[1])
+                else:
+                    raise ValidationException(f"Unsupported update section {section}")
+                if self.peek() != ",":
+                    break
+                self.take()
+        return to_set, to_remove
+
+
+def _resolve(operand, item):
+    kind, value = operand
+    if kind == "name":
+        return item.get(value)
+    return value
+
+
+def _comparable(value):
+    if value is None:
+        return None, None
+    ((type_, v),) = value.items()
+    if type_ == "N":
+        return type_, Decimal(v)
+    return type_, v
+
+
+def _evaluate(node, item):
+    kind = node[0]
+    if kind == "or":
+        return _evaluate(node[1], item) or _evaluate(node[2], item)
+    if kind == "and":
+        return _evaluate(node[1], item) and _evaluate(node[2], item)
+    if kind == "not":
+        return not _evaluate(node[1], item)
+    if kind == "call":
+        function, args = node[1], node[2]
+        if function == "attribute_exists":
+            return args[0][1] in item
+        if function == "attribute_not_exists":
+            return args[0][1] not in item
+        type_, value = _comparable(_resolve(args[0], item))
+        prefix_type, prefix = _comparable(_resolve(args[1], item))
+        return type_ == prefix_type == "S" and value.startswith(prefix)
+    if kind == "between":
+        type_, value = _comparable(_resolve(node[1], item))
+        low_type, low = _comparable(_resolve(node[2], item))
+        high_type, high = _comparable(_resolve(node[3], item))
+        if type_ is None or not (type_ == low_type == high_type):
+            return False
+        return low <= value <= high
+    operator = node[1]
+    left_type, left = _comparable(_resolve(node[2], item))
+    right_type, right = _comparable(_resolve(node[3], item))
+    if left_type is None or right_type is None:
+        return False
+    if left_type != right_type:
+        return operator == "<>"
+    return {
+        "=": left == right,
+        "<>": left != right,
+        "<": left < right,
+        "<=": left <= right,
+        ">": left > right,
+        ">=": left >= right,
+    }[operator]
+
+
+def _size(item):
+    # An approximation of https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/CapacityUnitCalculations.html
+    size = 0
+    for name, value in item.items():
+        ((type_, v),) = value.items()
+        size += len(name.encode("utf8"))
+        if type_ == "N":
+            size += len(v) // 2 + 1
+        else:
+            size += len(v.encode("utf8"))
+    return size
+
+
+def _project(item, expression, names):
+    # Only top level attribute names are supported, not document paths
+    if expression is None:
+        return item
+    projected = {}
+    for name in expression.split(","):
+        name = name.strip()
+        if name.startswith("#"):
+            if name not in (names or {}):
+                raise ValidationException(
+                    f"An expression attribute name used in the document path is not defined; attribute name: {name}"
+                )
+            name = names[name]
+        if name in item:
+            projected[name] = item[name]
+    return projected
+
+
+class FakeDynamoDB:
+    exceptions = Exceptions
+
+    # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/ServiceQuotas.html
+    MAX_ITEM_SIZE = 400 * 1024
+    MAX_PAGE_SIZE = 1024 * 1024
+    MAX_BATCH_WRITE = 25
+    MAX_BATCH_GET = 100
+    MAX_TRANSACT_WRITE = 100
+
+    operations = (
+        "put_item",
+        "update_item",
+        "delete_item",
+        "get_item",
+        "query",
+        "batch_write_item",
+        "batch_get_item",
+        "transact_write_items",
+    )
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=None):
+        assert latency >= 0, latency
+        assert 0 <= throttle_rate < 1, throttle_rate
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = RLock()
+        # table name -> pk -> (sorted sks, {sk: item})
+        self._tables = {}
+
+    def delay(self):
+        """Return how long the next request should take to arrive, in seconds."""
+        if not self.latency:
+            return 0.0
+        with self._lock:
+            return self.latency * self._random.uniform(0.5, 1.5)
+
+    def handle(self, operation, kwargs):
+        """
+        Handle a request for one of the operations, throttling it at
+        throttle_rate.
+        """
+        assert operation in self.operations, operation
+        if self.throttle_rate:
+            with self._lock:
+                throttle = self._random.random() < self.throttle_rate
+                if throttle:
+                    self.throttled += 1
+            if throttle:
+                raise ProvisionedThroughputExceededException(
+                    "The level of configured provisioned throughput for the table was exceeded"
+                )
+        return getattr(self, operation)(**kwargs)
+
+    def _partition(self, table_name, pk, create=False):
+        table = self._tables.setdefault(table_name, {})
+        partition = table.get(pk)
+        if partition is None and create:
+            partition = table[pk] = ([], {})
+        return partition
+
+    def _key(self, key):
+        if set(key) != {"pk", "sk"}:
+            raise ValidationException(
+                f"The provided key element does not match the schema: {key}"
+            )
+        return key["pk"]["S"], key["sk"]["S"]
+
+    def _get(self, table_name, key):
+        pk, sk = self._key(key)
+        partition = self._partition(table_name, pk)
+        if partition is None:
+            return None
+        return partition[1].get(sk)
+
+    def _put(self, table_name, item):
+        if _size(item) > self.MAX_ITEM_SIZE:
+            raise ValidationException("Item size has exceeded the maximum allowed size")
+        pk, sk = self._key({"pk": item["pk"], "sk": item["sk"]})
+        sks, items = self._partition(table_name, pk, create=True)
+        if sk not in items:
+            insort(sks, sk)
+        items[sk] = copy.deepcopy(item)
+
+    def _delete(self, table_name, key):
+        pk, sk = self._key(key)
+        partition = self._partition(table_name, pk)
+        if partition is not None and sk in partition[1]:
+            sks, items = partition
+            del items[sk]
+            del sks[bisect_left(sks, sk)]
+            if not items:
+                del self._tables[table_name][pk]
+
+    def _check_condition(self, existing, kwargs):
+        expression = kwargs.get("ConditionExpression")
+        if expression is None:
+            return
+        node = _Parser(
+            expression,
+            kwargs.get("ExpressionAttributeNames"),
+            kwargs.get("ExpressionAttributeValues"),
+        ).parse_condition()
+        if not _evaluate(node, existing or {}):
+            raise ConditionalCheckFailedException("The conditional request failed")
+
+    def put_item(self, TableName, Item, **kwargs):
+        with self._lock:
+            existing = self._get(TableName, {"pk": Item["pk"], "sk": Item["sk"]})
+            self._check_condition(existing, kwargs)
+            self._put(TableName, Item)
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, **kwargs):
+        with self._lock:
+            existing = self._get(TableName, Key)
+            self._check_condition(existing, kwargs)
+            to_set, to_remove = _Parser(
+                UpdateExpression,
+                kwargs.get("ExpressionAttributeNames"),
+                kwargs.get("ExpressionAttributeValues"),
+            ).parse_update()
+            item = copy.deepcopy(existing) if existing else copy.deepcopy(Key)
+            for name, value in to_set:
+                if name in ("pk", "sk"):
+                    raise ValidationException("Cannot update attribute " + name)
+                item[name] = value
+            for name in to_remove:
+                item.pop(name, None)
+            self._put(TableName, item)
+        return {}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        with self._lock:
+            self._check_condition(self._get(TableName, Key), kwargs)
+            self._delete(TableName, Key)
+        return {}
+
+    def get_item(
+        self,
+        TableName,
+        Key,
+        ConsistentRead=False,
+        ProjectionExpression=None,
+        ExpressionAttributeNames=None,
+    ):
+        with self._lock:
+            item = self._get(TableName, Key)
+            if item is None:
+                return {}
+            item = _project(item, ProjectionExpression, ExpressionAttributeNames)
+            return {"Item": copy.deepcopy(item)}
+
+    def query(
+        self,
+        TableName,
+        KeyConditionExpression,
+        ConsistentRead=False,
+        Limit=None,
+        ExclusiveStartKey=None,
+        FilterExpression=None,
+        ExpressionAttributeNames=None,
+        ExpressionAttributeValues=None,
+        ScanIndexForward=True,
+        ProjectionExpression=None,
+    ):
+        if not ScanIndexForward:
+            raise ValidationException("ScanIndexForward=False is not supported")
+        key_condition = _Parser(
+            KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues
+        ).parse_condition()
+        filter_ = None
+        if FilterExpression:
+            filter_ = _Parser(
+                FilterExpression, ExpressionAttributeNames, ExpressionAttributeValues
+            ).parse_condition()
+        pk = self._key_condition_pk(key_condition)
+        result: dict[str, Any] = {"Items": [], "Count": 0, "ScannedCount": 0}
+        with self._lock:
+            partition = self._partition(TableName, pk)
+            if partition is None:
+                return result
+            sks, items = partition
+            start = 0
+            if ExclusiveStartKey:
+                start = bisect_right(sks, self._key(ExclusiveStartKey)[1])
+            size = 0
+            for sk in sks[start:]:
+                item = items[sk]
+                if not _evaluate(key_condition, item):
+                    continue
+                result["ScannedCount"] += 1
+                # The item that takes a page over 1 MB is still returned
+                size += _size(item)
+                if filter_ is None or _evaluate(filter_, item):
+                    result["Items"].append(
+                        copy.deepcopy(
+                            _project(
+                                item, ProjectionExpression, ExpressionAttributeNames
+                            )
+                        )
+                    )
+                if (Limit and result["ScannedCount"] == Limit) or (
+                    size >= self.MAX_PAGE_SIZE
+                ):
+                    result["LastEvaluatedKey"] = {
+                        "pk": copy.deepcopy(item["pk"]),
+                        "sk": copy.deepcopy(item["sk"]),
+                    }
+                    break
+        result["Count"] = len(result["Items"])
+        return result
+
+    def _key_condition_pk(self, node):
+        if node[0] == "and":
+            for child in node[1:]:
+                try:
+                    return self._key_condition_pk(child)
+                except ValidationException:
+                    pass
+        elif node[0] == "compare" and node[1] == "=" and node[2] == ("name", "pk"):
+            return node[3][1]["S"]
+        raise ValidationException("Query condition missed key schema element: pk")
+
+    def batch_write_item(self, RequestItems):
+        count = sum(len(requests) for requests in RequestItems.values())
+        if count > self.MAX_BATCH_WRITE:
+            raise ValidationException(
+                f"Too many items requested for the BatchWriteItem call: {count}"
+            )
+        with self._lock:
+            for table_name, requests in RequestItems.items():
+                keys = set()
+                for request in requests:
+                    if "PutRequest" in request:
+                        item = request["PutRequest"]["Item"]
+                        key = self._key({"pk": item["pk"], "sk": item["sk"]})
+                    else:
+                        key = self._key(request["DeleteRequest"]["Key"])
+                    if key in keys:
+                        raise ValidationException(
+                            "Provided list of item keys contains duplicates"
+                        )
+                    keys.add(key)
+                for request in requests:
+                    if "PutRequest" in request:
+                        self._put(table_name, request["PutRequest"]["Item"])
+                    else:
+                        self._delete(table_name, request["DeleteRequest"]["Key"])
+        return {"UnprocessedItems": {}}
+
+    def batch_get_item(self, RequestItems):
+        count = sum(len(request["Keys"]) for request in RequestItems.values())
+        if count > self.MAX_BATCH_GET:
+            raise ValidationException(
+                f"Too many items requested for the BatchGetItem call: {count}"
+            )
+        responses: dict[str, list[dict]] = {}
+        with self._lock:
+            for table_name, request in RequestItems.items():
+                keys = [self._key(key) for key in request["Keys"]]
+                if len(set(keys)) != len(keys):
+                    raise ValidationException(
+                        "Provided list of item keys contains duplicates"
+                    )
+                responses[table_name] = []
+                for key in request["Keys"]:
+                    item = self._get(table_name, key)
+                    if item is not None:
+                        responses[table_name].append(copy.deepcopy(item))
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def transact_write_items(self, TransactItems, ClientRequestToken=None):
+        if len(TransactItems) > self.MAX_TRANSACT_WRITE:
+            raise ValidationException(
+                f"Too many items requested for the TransactWriteItems call: {len(TransactItems)}"
+            )
+        operations: dict[str, Callable[..., dict]] = {
+            "Put": self.put_item,
+            "Update": self.update_item,
+            "Delete": self.delete_item,
+        }
+        writes = []
+        for transact_item in TransactItems:
+            ((type_, kwargs),) = transact_item.items()
+            item = kwargs.get("Item")
+            key = kwargs["Key"] if item is None else {k: item[k] for k in ("pk", "sk")}
+            writes.append((operations[type_], kwargs, (kwargs["TableName"], key)))
+        keys = [(table_name, self._key(key)) for _, _, (table_name, key) in writes]
+        if len(set(keys)) != len(keys):
+            raise ValidationException(
+                "Transaction request cannot include multiple operations on one item"
+            )
+        with self._lock:
+            # Every condition is checked before anything is written
+            reasons = []
+            for operation, kwargs, (table_name, key) in writes:
+                try:
+                    self._check_condition(self._get(table_name, key), kwargs)
+                    reasons.append({"Code": "None"})
+                except ConditionalCheckFailedException as e:
+                    reasons.append(
+                        {"Code": "ConditionalCheckFailed", "Message": str(e)}
+                    )
+            if any(reason["Code"] != "None" for reason in reasons):
+                codes = ", ".join(reason["Code"] for reason in reasons)
+                raise TransactionCanceledException(
+                    f"Transaction cancelled, please refer cancellation reasons for specific reasons [{codes}]",
+                    reasons,
+                )
+            for operation, kwargs, key in writes:
+                kwargs = dict(kwargs)
+                kwargs.pop("ConditionExpression", None)
+                operation(**kwargs)
+        return {}
+
+
+class _Events:
+    def __init__(self):
+        self._handlers = []
+
+    def register(self, event_name, handler):
+        if event_name.startswith("needs-retry"):
+            self._handlers.append(handler)
+
+    def needs_retry(self, parsed):
+        for handler in self._handlers:
+            handler(response=(None, parsed))
+
+
+class _Meta:
+    def __init__(self):
+        self.events = _Events()
+
+
+class Client:
+    """
+    Stands in for boto3.client("dynamodb"), calling fake in the calling
+    thread after its latency, and retrying throttled requests with
+    exponential backoff and jitter like botocore's standard retry mode.
+    """
+
+    exceptions = Exceptions
+    _retryable_codes = {"ProvisionedThroughputExceededException"}
+
+    def __init__(self, fake, max_attempts=10, max_backoff=1.0, seed=None):
+        assert max_backoff >= 0, max_backoff
+        self.fake = fake
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.meta = _Meta()
+        self._random = random.Random(seed)
+        self._lock = Lock()
+
+    def __getattr__(self, operation):
+        if operation not in FakeDynamoDB.operations:
+            raise AttributeError(operation)
+        return functools.partial(self._call, operation)
+
+    def _call(self, operation, **kwargs):
+        attempt = 0
+        while True:
+            time.sleep(self.fake.delay())
+            try:
+                response = self.fake.handle(operation, kwargs)
+            except ServiceError as e:
+                self.meta.events.needs_retry(e.response)
+                code = e.response["Error"]["Code"]
+                if (
+                    code not in self._retryable_codes
+                    or attempt + 1 >= self.max_attempts
+                ):
+                    e.response["ResponseMetadata"] = {
+                        "HTTPStatusCode": 400,
+                        "RetryAttempts": attempt,
+                    }
+                    raise
+                attempt += 1
+                with self._lock:
+                    backoff = self._random.uniform(
+                        0, min(0.025 * 2**attempt, self.max_backoff)
+                    )
+                time.sleep(backoff)
+                continue
+            self.meta.events.needs_retry(response)
+            response["ResponseMetadata"] = {
+                "HTTPStatusCode": 200,
+                "RetryAttempts": attempt,
+            }
+            return response
+
+
+def install(latency=None, throttle_rate=None, seed=None, max_backoff=None):
+    """
+    Replace the DynamoDB driver's boto3 client with a Client for a new
+    FakeDynamoDB, which is returned. The default latency and throttle_rate
+    come from KVSTORE_FAKE_DYNAMODB_LATENCY_MS and
+    KVSTORE_FAKE_DYNAMODB_THROTTLE_RATE (default 0 for both), the seed from
+    KVSTORE_FAKE_DYNAMODB_SEED and max_backoff, in seconds, from
+    KVSTORE_FAKE_DYNAMODB_MAX_BACKOFF_MS (default 1000).
+    """
+    import kvstore.driver.dynamodb
+
+    if latency is None:
+        latency = float(os.environ.get("KVSTORE_FAKE_DYNAMODB_LATENCY_MS", "0")) / 1000
+    if throttle_rate is None:
+        throttle_rate = float(
+            os.environ.get("KVSTORE_FAKE_DYNAMODB_THROTTLE_RATE", "0")
+        )
+    if seed is None and os.environ.get("KVSTORE_FAKE_DYNAMODB_SEED"):
+        seed = int(os.environ["KVSTORE_FAKE_DYNAMODB_SEED"])
+    if max_backoff is None:
+        max_backoff = (
+            float(os.environ.get("KVSTORE_FAKE_DYNAMODB_MAX_BACKOFF_MS", "1000")) / 1000
+        )
+    fake = FakeDynamoDB(latency=latency, throttle_rate=throttle_rate, seed=seed)
+    client = Client(fake, max_backoff=max_backoff, seed=seed)
+    client.meta.events.register(
+        "needs-retry.dynamodb", kvstore.driver.dynamodb._count_throttle
+    )
+    kvstore.driver.dynamodb.dynamodb = client
+    return fake
+
+
+def _dispatch(fake, headers, body):
+    if not headers.get("authorization", "").startswith("AWS4-HMAC-SHA256 Credential="):
+        return "403 Forbidden", {
+            "__type": "com.amazon.coral.service#MissingAuthenticationTokenException",
+            "message": "Missing Authentication Token",
+        }
+    prefix, _, operation = headers.get("x-amz-target", "").partition(".")
+    name = re.sub(r"(?<!^)(?=[A-Z])", "_", operation).lower()
+    if prefix != "DynamoDB_20120810" or name not in fake.operations:
+        return "400 Bad Request", {
+            "__type": "com.amazon.coral.service#UnknownOperationException",
+            "message": f"Unknown operation {operation}",
+        }
+    try:
+        return "200 OK", fake.handle(name, json.loads(body))
+    except ServiceError as e:
+        error: dict[str, Any] = {
+            "__type": f"com.amazonaws.dynamodb.v20120810#{type(e).__name__}",
+            "message": str(e),
+        }
+        if "CancellationReasons" in e.response:
+            error["CancellationReasons"] = e.response["CancellationReasons"]
+        return "400 Bad Request", error
+
+
+async def serve(fake, host="127.0.0.1", port=0):
+    """
+    Serve fake over HTTP/1.1 with keep-alive, returning the asyncio Server.
+    With port=0 a free port is chosen, see server.sockets[0].getsockname().
+    Request signatures are not checked, only that there is one.
+    """
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                await asyncio.sleep(fake.delay())
+                status, response = _dispatch(fake, headers, body)
+                data = json.dumps(response).encode("utf8")
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status}\r\n"
+                        "Content-Type: application/x-amz-json-1.0\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"x-amz-crc32: {zlib.crc32(data)}\r\n"
+                        "\r\n"
+                    ).encode("latin1")
+                    + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # The server is shutting down with keep-alive connections still open
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,360 @@
+"""
+A kvstore driver that keeps everything in memory, for tests and for
+single-process deployments that don't need the data to outlive the process.
+
+Each (store, pk) partition keeps a sorted list of its sks alongside a
+dictionary of items, so get() is O(1) and iterate() and scan_pk() are
+O(log n + k) for k items. Expired items are never returned, and a few of them
+are dropped from memory on each write using a heap ordered by ttl.
+"""
+
+import heapq
+import time
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+from threading import RLock, local
+from typing import Any
+
+from .shared import (
+    ConditionFailed,
+    NotExists,
+    NotFound,
+    Remove,
+    Transaction,
+    check_attributes,
+    check_condition,
+    condition_matches,
+    project,
+)
+
+rlock = RLock()
+# (store, pk) -> (sorted sks, {sk: (data, ttl)})
+_partitions: dict[
+    tuple[str, str], tuple[list[str], dict[str, tuple[dict[str, Any], Any]]]
+] = {}
+# (ttl, store, pk, sk), possibly for items that have since been changed
+_expiries: list[tuple[float, str, str, str]] = []
+# How many expired items to try to drop on each write
+SWEEP_PER_WRITE = 10
+# The open transaction() in this thread, if any
+_local = local()
+
+
+def cleanup():
+    with rlock:
+        _partitions.clear()
+        _expiries.clear()
+
+
+def _size(store, pk, sk, ttl, data):
+    size = len(store) + 1 + len(pk) + len(sk) + len(str(ttl or ""))
+    for k, v in data.items():
+        size += len(k) + len(v if isinstance(v, str) else str(v))
+    return size
+
+
+def _check_put(store, pk, data, sk, ttl):
+    if data is None:
+        data = {}
+    assert "pk" not in data
+    assert "sk" not in data
+    assert "ttl" not in data
+    assert "/" not in store
+    if ttl is not None:
+        assert isinstance(ttl, (int, float)), ttl
+    assert sk[0] == "/"
+    for k, v in data.items():
+        assert type(k) is str, f"Expected key {repr(k)} to be a string"
+        assert isinstance(
+            v, (float, int, str)
+        ), f"Expected key {repr(k)} value to be a float, int or str. It is: {repr(v)}."
+    if _size(store, pk, sk, ttl, data) > 400 * 1024:
+        raise Exception("Item is too large")
+    return dict(data)
+
+
+def _current(store, pk, sk, now):
+    partition = _partitions.get((store, pk))
+    if partition is None:
+        return None
+    item = partition[1].get(sk)
+    if item is None or (item[1] is not None and item[1] <= now):
+        return None
+    return item
+
+
+class _Transaction(Transaction):
+    def __init__(self):
+        super().__init__()
+        # (store, pk, sk) -> (data, ttl) or None, as it was before the
+        # transaction changed it
+        self.undo = {}
+
+
+def _track(store, pk, sk):
+    transaction = getattr(_local, "transaction", None)
+    if transaction is not None:
+        transaction.add(store, pk, sk)
+
+
+def _save(store, pk, sk):
+    # Remember the item as it was before its first change in a transaction
+    transaction = getattr(_local, "transaction", None)
+    if transaction is not None and (store, pk, sk) not in transaction.undo:
+        transaction.undo[(store, pk, sk)] = _current(store, pk, sk, float("-inf"))
+
+
+@contextmanager
+def transaction():
+    """
+    Make the writes in the body together: if the body raises, the items are
+    put back as they were. The lock is held throughout, so other threads
+    can't see the writes until the body has finished.
+    """
+    assert getattr(_local, "transaction", None) is None, "Transactions can't be nested"
+    with rlock:
+        transaction = _local.transaction = _Transaction()
+        try:
+            yield
+        except BaseException:
+            _local.transaction = None
+            for (store, pk, sk), item in transaction.undo.items():
+                if item is None:
+                    _remove(store, pk, sk)
+                else:
+                    _set(store, pk, sk, item[0], item[1])
+            raise
+        finally:
+            _local.transaction = None
+
+
+def transactable(store, pks):
+    """
+    Whether writes to all of pks in store can be made in one transaction(),
+    which they always can.
+    """
+    return True
+
+
+def _set(store, pk, sk, data, ttl):
+    _save(store, pk, sk)
+    partition = _partitions.get((store, pk))
+    if partition is None:
+        partition = _partitions[(store, pk)] = ([], {})
+    sks, items = partition
+    if sk not in items:
+        insort(sks, sk)
+    items[sk] = (data, ttl)
+    if ttl is not None:
+        heapq.heappush(_expiries, (ttl, store, pk, sk))
+
+
+def _remove(store, pk, sk):
+    partition = _partitions.get((store, pk))
+    if partition is None or sk not in partition[1]:
+        return
+    _save(store, pk, sk)
+    sks, items = partition
+    del items[sk]
+    del sks[bisect_left(sks, sk)]
+    if not items:
+        del _partitions[(store, pk)]
+
+
+def _sweep(now, max_rows):
+    while max_rows and _expiries and _expiries[0][0] <= now:
+        ttl, store, pk, sk = heapq.heappop(_expiries)
+        item = _current(store, pk, sk, float("-inf"))
+        # Only remove the item if it hasn't been replaced with a new ttl
+        if item is not None and item[1] == ttl:
+            _remove(store, pk, sk)
+        max_rows -= 1
+
+
+def put(store: str, pk: str, data=None, sk="/", ttl=None, condition=None):
+    data = _check_put(store, pk, data, sk, ttl)
+    check_condition(condition)
+    with rlock:
+        _track(store, pk, sk)
+        now = time.time()
+        if condition is not None:
+            current = _current(store, pk, sk, now)
+            if not condition_matches(condition, current and current[0]):
+                raise ConditionFailed(
+                    f"Condition {repr(condition)} failed for pk '{pk}' and sk '{sk}' in the '{store}' store"
+                )
+        _set(store, pk, sk, data, ttl)
+        _sweep(now, SWEEP_PER_WRITE)
+
+
+def put_many(store: str, items):
+    checked = [
+        (pk, sk, _check_put(store, pk, data, sk, ttl), ttl)
+        for pk, sk, data, ttl in items
+    ]
+    with rlock:
+        for pk, sk, data, ttl in checked:
+            _track(store, pk, sk)
+            _set(store, pk, sk, data, ttl)
+        _sweep(time.time(), SWEEP_PER_WRITE)
+
+
+def delete(store: str, pk: str, sk="/"):
+    delete_many(store, [(pk, sk)])
+
+
+def delete_many(store: str, keys):
+    assert "/" not in store
+    keys = list(keys)
+    for pk, sk in keys:
+        assert sk[0] == "/"
+    with rlock:
+        for pk, sk in keys:
+            _track(store, pk, sk)
+            _remove(store, pk, sk)
+        _sweep(time.time(), SWEEP_PER_WRITE)
+
+
+def _range(store, pk, sk_start, after, now):
+    # Yields unexpired items from sk_start onwards. The caller must hold rlock.
+    partition = _partitions.get((store, pk))
+    if partition is None:
+        return
+    sks, items = partition
+    if after:
+        i = bisect_right(sks, sk_start)
+    else:
+        i = bisect_left(sks, sk_start)
+    while i < len(sks):
+        sk = sks[i]
+        data, ttl = items[sk]
+        if ttl is None or ttl > now:
+            yield sk, data, ttl
+        i += 1
+
+
+# consistent is ignored
+def iterate(
+    store, pk, sk_start="/", limit=None, after=False, consistent=False, attributes=None
+) -> tuple[Any, str | None]:
+    assert sk_start[0] == "/"
+    check_attributes(attributes)
+    results: list[tuple[str, dict[str, Any], Any]] = []
+    size = 0
+    last_sk = None
+    with rlock:
+        for sk, data, ttl in _range(store, pk, sk_start, after, time.time()):
+            if limit and len(results) == limit:
+                # There is more after the page
+                return results, last_sk
+            # The same page size limit as the SQLite driver
+            size += _size(store, pk, sk, ttl, data)
+            if size > int(1.5 * 1024 * 1024):
+                return results, last_sk
+            results.append((sk, project(data, attributes), ttl))
+            last_sk = sk
+    if len(results) == 0:
+        raise NotFound(f"No such pk '{pk}' in the '{store}' store")
+    return results, None
+
+
+# consistent is ignored
+def scan_pk(store, pk, sk_start="/", after=False, page_size=100, consistent=False):
+    """
+    Lazily yield every (sk, data, ttl) in the pk, in sk order, page_size items
+    at a time. Nothing is yielded for an empty pk.
+    """
+    assert "/" not in store
+    assert sk_start[0] == "/"
+    assert page_size > 0, page_size
+    while True:
+        page = []
+        with rlock:
+            for sk, data, ttl in _range(store, pk, sk_start, after, time.time()):
+                page.append((sk, dict(data), ttl))
+                if len(page) == page_size:
+                    break
+        yield from page
+        if len(page) < page_size:
+            return
+        sk_start = page[-1][0]
+        after = True
+
+
+# consistent is ignored
+def get(
+    store, pk, sk="/", consistent=False, attributes=None
+) -> tuple[dict[str, int | float | str], float | int | None]:
+    assert sk[0] == "/"
+    check_attributes(attributes)
+    with rlock:
+        item = _current(store, pk, sk, time.time())
+        if item is None:
+            raise NotFound(f"No such pk '{pk}' in the '{store}' store")
+        return project(item[0], attributes), item[1]
+
+
+# consistent is ignored
+def get_many(
+    store, keys, consistent=False
+) -> tuple[
+    dict[tuple[str, str], tuple[dict[str, int | float | str], float | int | None]],
+    list[tuple[str, str]],
+]:
+    assert "/" not in store
+    found = {}
+    missing = []
+    with rlock:
+        now = time.time()
+        for pk, sk in dict.fromkeys((pk, sk) for pk, sk in keys):
+            assert sk[0] == "/"
+            item = _current(store, pk, sk, now)
+            if item is None:
+                missing.append((pk, sk))
+            else:
+                found[(pk, sk)] = (dict(item[0]), item[1])
+    return found, missing
+
+
+def patch(store, pk, data, sk="/", ttl="notchanged", condition=None):
+    assert "pk" not in data
+    assert "sk" not in data
+    assert "ttl" not in data
+    assert "/" not in store
+    assert sk[0] == "/"
+    if ttl not in ["notchanged", None]:
+        assert isinstance(ttl, (int, float)), ttl
+    for k, v in data.items():
+        assert type(k) is str, f"Expected key {repr(k)} to be a string"
+        assert (
+            isinstance(v, (float, int, str)) or v is Remove
+        ), f"Expected key {repr(k)} value to be a float, int, str or kvstore.driver.Remove. It is: {repr(v)}."
+    check_condition(condition)
+    assert (
+        condition is not NotExists
+    ), "patch() only changes existing items, use put() with condition=NotExists to create one"
+    with rlock:
+        _track(store, pk, sk)
+        now = time.time()
+        current = _current(store, pk, sk, now)
+        if condition is not None and not condition_matches(
+            condition, current and current[0]
+        ):
+            raise ConditionFailed(
+                f"Condition {repr(condition)} failed for pk '{pk}' and sk '{sk}' in the '{store}' store"
+            )
+        if current is None:
+            raise NotFound(f"No such pk '{pk}' in the '{store}' store")
+        new_data = dict(current[0])
+        for k, v in data.items():
+            if v is Remove:
+                if k in new_data:
+                    del new_data[k]
+            else:
+                new_data[k] = v
+        if ttl == "notchanged":
+            new_ttl = current[1]
+        else:
+            new_ttl = ttl
+        _set(store, pk, sk, _check_put(store, pk, new_data, sk, new_ttl), new_ttl)
+        _sweep(now, SWEEP_PER_WRITE)
@@ -6,7 +6,103 @@ class Remove:
     pass
 
 
-from typing import Any, Protocol, runtime_checkable
+class ConditionFailed(Exception):
+    pass
+
+
+class NotExists:
+    """
+    As a put() or patch() condition, the item must not exist (or have
+    expired). As a value in a condition dictionary, the attribute must not be
+    set.
+    """
+
+    pass
+
+
+def check_condition(condition):
+    if condition is None or condition is NotExists:
+        return
+    assert isinstance(condition, dict), condition
+    assert condition, "A condition dictionary must contain at least one attribute"
+    for k, v in condition.items():
+        assert type(k) is str, f"Expected condition key {repr(k)} to be a string"
+        assert k not in ("pk", "sk", "ttl"), k
+        assert (
+            isinstance(v, (float, int, str)) or v is NotExists
+        ), f"Expected condition key {repr(k)} value to be a float, int, str or kvstore.driver.NotExists. It is: {repr(v)}."
+
+
+def condition_matches(condition, current) -> bool:
+    """
+    Check a condition against the current data of an item, or None if the
+    item doesn't exist. A condition dictionary only matches an existing item
+    where every attribute equals the given value, or isn't set for NotExists.
+    """
+    if condition is None:
+        return True
+    if condition is NotExists:
+        return current is None
+    if current is None:
+        return False
+    for k, v in condition.items():
+        if v is NotExists:
+            if k in current:
+                return False
+        elif k not in current:
+            return False
+        # Strings never equal numbers, just like in DynamoDB
+        elif isinstance(current[k], str) != isinstance(v, str) or current[k] != v:
+            return False
+    return True
+
+
+def check_attributes(attributes):
+    if attributes is None:
+        return
+    assert not isinstance(attributes, str), "attributes must be a list of names"
+    for k in attributes:
+        assert type(k) is str, f"Expected attribute {repr(k)} to be a string"
+        assert k not in ("pk", "sk", "ttl"), k
+
+
+def project(data, attributes):
+    """
+    Return a copy of data with just the attributes that are set, or all of
+    them if attributes is None.
+    """
+    if attributes is None:
+        return dict(data)
+    return {k: data[k] for k in attributes if k in data}
+
+
+class Transaction:
+    """
+    The keys written so far in a transaction() block. Every driver limits a
+    transaction to as many writes as DynamoDB accepts in one
+    TransactWriteItems call, each to a different item, so that code behaves
+    the same whichever driver it runs on.
+    """
+
+    MAX_WRITES = 100
+
+    def __init__(self):
+        self.keys = set()
+
+    def add(self, store, pk, sk):
+        key = (store, pk, sk)
+        if key in self.keys:
+            raise Exception(
+                f"pk '{pk}' and sk '{sk}' in the '{store}' store can only be written once in a transaction"
+            )
+        if len(self.keys) >= self.MAX_WRITES:
+            raise Exception(
+                f"A transaction can't contain more than {self.MAX_WRITES} writes"
+            )
+        self.keys.add(key)
+
+
+from typing import Any, ContextManager, Iterator, Protocol, runtime_checkable
 
 
 @runtime_checkable
@@ -14,21 +110,52 @@ class KvStore(Protocol):
     def render(self) -> str:
         ...
 
-    def put(store, pk, data=None, sk="/", ttl=None) -> None:
+    def put(store, pk, data=None, sk="/", ttl=None, condition=None) -> None:
         ...
 
-    def patch(store, pk, data, sk="/", ttl=None) -> None:
+    def patch(store, pk, data, sk="/", ttl=None, condition=None) -> None:
         ...
 
     def delete(store, pk, sk="/") -> None:
         ...
 
+    def put_many(store, items) -> None:
+        ...
+
+    def delete_many(store, keys) -> None:
+        ...
+
     def iterate(
-        store, pk, sk_start="/", limit=None, after=False, consistent=False
+        store,
+        pk,
+        sk_start="/",
+        limit=None,
+        after=False,
+        consistent=False,
+        attributes=None,
     ) -> tuple[Any, str | None]:
         ...
 
+    def scan_pk(
+        store, pk, sk_start="/", after=False, page_size=100, consistent=False
+    ) -> Iterator[tuple[str, dict[str, int | float | str], float | int | None]]:
+        ...
+
     def get(
-        store, pk, sk="/", consistent=False
+        store, pk, sk="/", consistent=False, attributes=None
     ) -> tuple[dict[str, int | float | str], float | int | None]:
         ...
+
+    def get_many(
+        store, keys, consistent=False
+    ) -> tuple[
+        dict[tuple[str, str], tuple[dict[str, int | float | str], float | int | None]],
+        list[tuple[str, str]],
+    ]:
+        ...
+
+    def transaction(self) -> ContextManager[None]:
+        ...
+
+    def transactable(store, pks) -> bool:
+        ...
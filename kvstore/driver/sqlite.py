@@ -1,11 +1,24 @@
-import json
 import os
+import queue
 import sqlite3
 import time
-from threading import RLock
+import zlib
+from contextlib import ExitStack, contextmanager
+from threading import Event, RLock, Thread, local
 from typing import Any
 
-from .shared import NotFound, Remove
+from . import codec
+from .shared import (
+    ConditionFailed,
+    NotExists,
+    NotFound,
+    Remove,
+    Transaction,
+    check_attributes,
+    check_condition,
+    condition_matches,
+    project,
+)
 
 config_store_dir = os.environ.get("STORE_DIR", ".")
 config_driver_key_value_store_dir = os.path.join(
@@ -17,7 +30,8 @@ config_driver_key_value_store_db_path = os.path.join(
 )
 
 
-# This might not be needed if we create a cursor within each function, but I don't know enough about the underlying implementation to be sure.
+# Guards opening and closing the shards. Each shard has its own lock for its
+# connection.
 rlock = RLock()
 
 
@@ -43,36 +57,312 @@ else:
     check_same_thread = True
 
 
-_conn = None
-_cur = None
+# Named sets of pragmas, chosen with KVSTORE_SQLITE_PROFILE. Individual
+# pragmas can be overridden with KVSTORE_SQLITE_PRAGMAS, e.g.
+# "synchronous=normal,cache_size=-20000". page_size only affects databases
+# created after it is set (or after a VACUUM).
+profiles: dict[str, dict[str, str | int]] = {
+    # SQLite's own defaults, as used by earlier versions of this driver
+    "default": {},
+    # Committed writes survive power loss as well as crashes
+    "durable": {"journal_mode": "wal", "synchronous": "full", "busy_timeout": 5000},
+    # Committed writes survive application crashes, but the most recent ones
+    # can be lost on power loss. Reads are served from a larger cache and
+    # memory mapped I/O.
+    "fast": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+    },
+    # Nothing is synced to disk, so a crash can lose or corrupt the database.
+    # Only for dev servers and throwaway test runs.
+    "unsafe": {
+        "page_size": 8192,
+        "journal_mode": "memory",
+        "synchronous": "off",
+        "temp_store": "memory",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+    },
+}
+# These apply to the database file rather than to each connection
+_database_pragmas = ("page_size", "journal_mode")
+
+
+def _pragmas(pool):
+    profile = os.environ.get("KVSTORE_SQLITE_PROFILE", "default")
+    assert profile in profiles, f"Unknown KVSTORE_SQLITE_PROFILE {repr(profile)}"
+    pragmas = dict(profiles[profile])
+    for pair in os.environ.get("KVSTORE_SQLITE_PRAGMAS", "").split(","):
+        if pair:
+            name, value = pair.split("=")
+            assert name.strip().isidentifier(), f"Invalid pragma name {repr(name)}"
+            pragmas[name.strip()] = value.strip()
+    if pool:
+        # Readers only avoid waiting for the writer with a WAL journal
+        pragmas["journal_mode"] = "wal"
+    return pragmas
+
+
+def _connect(path, pragmas, check_same_thread):
+    conn = sqlite3.connect(path, check_same_thread=check_same_thread)
+    for name, value in pragmas.items():
+        if name not in _database_pragmas:
+            conn.execute(f"pragma {name}={value};")
+    return conn
+
+
+class _Batch:
+    """Writes sharing one group commit."""
+
+    def __init__(self):
+        self.done = Event()
+        self.error: Exception | None = None
+
+
+class _Shard:
+    """
+    One database file with its own writer connection and lock.
+
+    In pool mode (KVSTORE_SQLITE_POOL) the database uses a WAL journal, conn
+    is the dedicated writer connection (still guarded by rlock) and reads are
+    served from readers, a pool of reader connections that threads check out
+    for the duration of a query so that reads don't wait for each other or
+    for the writer.
+    """
+
+    def __init__(self, path, pool, pool_size, pragmas, group_commit):
+        self.path = path
+        self.pool = pool
+        self.pragmas = pragmas
+        # Seconds to wait for other writers before committing, 0 to commit
+        # each write straight away
+        self.group_commit = group_commit
+        self.batch: _Batch | None = None
+        # This might not be needed if we create a cursor within each function, but I don't know enough about the underlying implementation to be sure.
+        self.rlock = RLock()
+        self.readers: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+        # See https://ricardoanderegg.com/posts/python-sqlite-thread-safety/
+        self.conn = _connect(path, pragmas, check_same_thread)
+        self.cur = self.conn.cursor()
+        for name in _database_pragmas:
+            if name in pragmas:
+                self.cur.execute(f"pragma {name}={pragmas[name]};")
+        self.cur.execute(
+            "create table if not exists store (store text, pk text, sk text, ttl real, data text NOT NULL, PRIMARY KEY (store, pk, sk));"
+        )
+        self.cur.execute(
+            "create index if not exists store_ttl on store (ttl) where ttl is not NULL;"
+        )
+
+    def close(self):
+        with self.rlock:
+            while True:
+                try:
+                    self.readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            self.conn.close()
+
+
+# Set from KVSTORE_SQLITE_SHARDS when the database is initialised. With one
+# shard (the default) everything is in sqlite.db as it always has been. With N
+# shards each (store, pk) partition lives in one of N files chosen by a hash,
+# so that writes to different partitions (e.g. different workflows) don't wait
+# for each other's locks or fsyncs. Changing N moves most partitions to a
+# different file, so a database has to be re-created to change it.
+_shards: list[_Shard] = []
+
+
+def _shard_paths(count):
+    if count == 1:
+        return [config_driver_key_value_store_db_path]
+    return [
+        os.path.join(config_driver_key_value_store_dir, f"sqlite-{i}-of-{count}.db")
+        for i in range(count)
+    ]
 
 
 def init():
-    global _conn
-    global _cur
+    global _shards
     with rlock:
-        if not _conn or not _cur:
-            # See https://ricardoanderegg.com/posts/python-sqlite-thread-safety/
-            _conn = sqlite3.connect(
-                config_driver_key_value_store_db_path,
-                check_same_thread=check_same_thread,
-            )
-            _cur = _conn.cursor()
-            _cur.execute(
-                "create table if not exists store (store text, pk text, sk text, ttl real, data text NOT NULL, PRIMARY KEY (store, pk, sk));"
+        if not _shards:
+            pool = os.environ.get("KVSTORE_SQLITE_POOL", "false").lower() == "true"
+            pool_size = int(os.environ.get("KVSTORE_SQLITE_POOL_SIZE", "8"))
+            count = int(os.environ.get("KVSTORE_SQLITE_SHARDS", "1"))
+            assert count > 0, count
+            pragmas = _pragmas(pool)
+            group_commit = (
+                float(os.environ.get("KVSTORE_SQLITE_GROUP_COMMIT_MS", "0")) / 1000
             )
-            _cur.execute(
-                "create index if not exists store_ttl on store (ttl) where ttl is not NULL;"
+            _shards = [
+                _Shard(path, pool, pool_size, pragmas, group_commit)
+                for path in _shard_paths(count)
+            ]
+            if float(os.environ.get("KVSTORE_SQLITE_SWEEP_INTERVAL", "60")) > 0:
+                start_sweeper()
+
+
+def _all_shards():
+    if not _shards:
+        init()
+    return _shards
+
+
+def _shard(store, pk) -> _Shard:
+    shards = _all_shards()
+    if len(shards) == 1:
+        return shards[0]
+    return shards[zlib.crc32(f"{store}/{pk}".encode("utf8")) % len(shards)]
+
+
+def _by_shard(store, rows, pk_index):
+    shards: dict[int, tuple[_Shard, list]] = {}
+    for row in rows:
+        shard = _shard(store, row[pk_index])
+        shards.setdefault(id(shard), (shard, []))[1].append(row)
+    return shards.values()
+
+
+@contextmanager
+def _reading(shard):
+    if not shard.pool:
+        with shard.rlock:
+            yield shard.cur
+        return
+    try:
+        conn = shard.readers.get_nowait()
+    except queue.Empty:
+        # Reader connections are handed from thread to thread, but only ever
+        # used by one thread at a time.
+        conn = _connect(shard.path, shard.pragmas, False)
+    try:
+        yield conn.cursor()
+    finally:
+        try:
+            shard.readers.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+# Expired items are never returned by get() or iterate(), so the space they
+# use can be reclaimed separately from writes, in bounded batches, either by
+# calling sweep() directly or by the background thread started by init().
+sweep_stats: dict[str, float | int | None] = {
+    "sweeps": 0,
+    "reclaimed": 0,
+    "last_sweep": None,
+    "last_reclaimed": 0,
+    "last_duration_ms": 0.0,
+}
+_sweeper: Thread | None = None
+_stop_sweeper = Event()
+
+
+def sweep(max_rows=500):
+    """
+    Delete at most max_rows expired items from each shard, returning how many
+    were deleted in total.
+    """
+    start = time.time()
+    reclaimed = 0
+    for shard in _all_shards():
+        with _immediate(shard) as cur:
+            cur.execute(
+                "delete from store where rowid in (select rowid from store where ttl is not NULL AND ttl <= ? LIMIT ?)",
+                (start, max_rows),
             )
+            reclaimed += cur.rowcount
+    with rlock:
+        sweep_stats["sweeps"] = int(sweep_stats["sweeps"] or 0) + 1
+        sweep_stats["reclaimed"] = int(sweep_stats["reclaimed"] or 0) + reclaimed
+        sweep_stats["last_sweep"] = start
+        sweep_stats["last_reclaimed"] = reclaimed
+        sweep_stats["last_duration_ms"] = (time.time() - start) * 1000
+    return reclaimed
+
+
+def start_sweeper(interval=None, max_rows=None):
+    global _sweeper
+    if interval is None:
+        interval = float(os.environ.get("KVSTORE_SQLITE_SWEEP_INTERVAL", "60"))
+    if max_rows is None:
+        max_rows = int(os.environ.get("KVSTORE_SQLITE_SWEEP_BATCH", "500"))
+    assert interval > 0, interval
+    assert max_rows > 0, max_rows
+
+    def run():
+        while not _stop_sweeper.wait(interval):
+            try:
+                # Keep going while there is a backlog, releasing the locks
+                # between batches so that writers can interleave
+                while sweep(max_rows) >= max_rows and not _stop_sweeper.is_set():
+                    pass
+            except Exception as e:
+                print(f"Warning: Failed to sweep expired items: {repr(e)}")
+
+    with rlock:
+        if _sweeper is None or not _sweeper.is_alive():
+            _stop_sweeper.clear()
+            _sweeper = Thread(target=run, name="kvstore-sqlite-sweeper", daemon=True)
+            _sweeper.start()
+
+
+def stop_sweeper():
+    global _sweeper
+    _stop_sweeper.set()
+    if _sweeper is not None:
+        _sweeper.join()
+    _sweeper = None
+
+
+def migrate(to=None, batch_size=500):
+    """
+    Re-encode every item that isn't already stored with the codec named by
+    to (by default the one KVSTORE_SQLITE_CODEC selects), batch_size rows per
+    transaction so that other writers can interleave, returning how many items
+    were converted. Reads work throughout because the codec of each row is
+    detected when it is decoded. Run VACUUM afterwards to return the space
+    saved to the filesystem.
+    """
+    if to is None:
+        to = codec.name()
+    encode = codec.encoders[to]
+    converted = 0
+    for shard in _all_shards():
+        last_rowid = 0
+        while True:
+            with _immediate(shard) as cur:
+                cur.execute(
+                    "select rowid, data from store where rowid > ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, batch_size),
+                )
+                rows = cur.fetchall()
+                changes = [
+                    (encode(codec.decode(data)), rowid)
+                    for rowid, data in rows
+                    if codec.encoded_with(data) != to
+                ]
+                cur.executemany("UPDATE store SET data = ? WHERE rowid = ?", changes)
+            converted += len(changes)
+            if len(rows) < batch_size:
+                break
+            last_rowid = rows[-1][0]
+    return converted
 
 
 def cleanup():
+    global _shards
+    stop_sweeper()
     with rlock:
-        if _conn:
-            _conn.close()
+        for shard in _shards:
+            shard.close()
+        _shards = []
 
 
-def put(store: str, pk: str, data=None, sk="/", ttl=None):
+def _put_values(store: str, pk: str, data, sk, ttl):
     if data is None:
         data = {}
     assert "pk" not in data
@@ -81,75 +371,229 @@ def put(store: str, pk: str, data=None, sk="/", ttl=None):
     assert "/" not in store
     if ttl is not None:
         assert isinstance(ttl, (int, float)), ttl
-    if _cur is None:
-        init()
-    assert _conn is not None, "Database not initilaized, no _conn object."
-    assert _cur is not None, "Database not initilaized, no _cur object."
     assert sk[0] == "/"
     for k, v in data.items():
         assert type(k) is str, f"Expected key {repr(k)} to be a string"
         assert isinstance(
             v, (float, int, str)
         ), f"Expected key {repr(k)} value to be a float, int or str. It is: {repr(v)}."
-    cols = ["store", "pk", "sk", "ttl", "data"]
-    values = [store, pk, sk, ttl, json.dumps(dict(data))]
+    values = [store, pk, sk, ttl, codec.encode(dict(data))]
     size = len(store) + 1 + len(pk) + len(pk) + len(str(ttl or "")) + len(values[-1])
     if size > 400 * 1024:
         raise Exception("Item is too large")
-    with rlock:
-        sql = (
-            "INSERT OR REPLACE INTO "
-            + "store"
-            + "("
-            + (", ".join(cols))
-            + ") VALUES ("
-            + (", ".join(["?" for v in values]))
-            + ")"
-        )
-        # helper_log(__file__, sql, values)
-        _cur.execute(sql, values)
-        # Since we need to make a commit anyway, cleanup exired items
-        _cur.execute(
-            "delete from store where ttl is not NULL AND ttl <= ?", (time.time(),)
+    return values
+
+
+_put_sql = (
+    "INSERT OR REPLACE INTO store (store, pk, sk, ttl, data) VALUES (?, ?, ?, ?, ?)"
+)
+_delete_sql = "DELETE FROM store WHERE store=? AND pk=? AND sk=?"
+
+
+def _write_many(shard, sql, rows):
+    with _immediate(shard) as cur:
+        # helper_log(__file__, sql, rows)
+        cur.executemany(sql, rows)
+
+
+# The open transaction() in this thread, if any
+_local = local()
+
+
+class _Transaction(Transaction):
+    def __init__(self, stack):
+        super().__init__()
+        self.stack = stack
+        self.shard = None
+
+
+def _track(store, pk, sk):
+    transaction = getattr(_local, "transaction", None)
+    if transaction is not None:
+        transaction.add(store, pk, sk)
+
+
+@contextmanager
+def transaction():
+    """
+    Make the writes in the body in one SQLite transaction, so that either all
+    of them are committed when the body finishes or, if it raises, none are.
+
+    The transaction starts with the first write and holds the shard's write
+    lock until the body finishes. All the writes have to be to the same shard,
+    which they are when they share a pk or there is only one shard.
+    """
+    assert getattr(_local, "transaction", None) is None, "Transactions can't be nested"
+    with ExitStack() as stack:
+        _local.transaction = _Transaction(stack)
+        try:
+            yield
+        finally:
+            _local.transaction = None
+
+
+def transactable(store, pks):
+    """
+    Whether writes to all of pks in store can be made in one transaction(),
+    which they can when they are all in the same shard.
+    """
+    return len({id(_shard(store, pk)) for pk in pks}) <= 1
+
+
+@contextmanager
+def _immediate(shard):
+    """
+    Run the body in a write transaction on the shard's writer connection, or
+    as part of the open transaction() if there is one.
+    """
+    transaction = getattr(_local, "transaction", None)
+    if transaction is None:
+        with _write_transaction(shard) as cur:
+            yield cur
+        return
+    if transaction.shard is None:
+        # Committed, or rolled back, when the transaction() body finishes
+        transaction.stack.enter_context(_write_transaction(shard))
+        transaction.shard = shard
+    elif transaction.shard is not shard:
+        raise Exception(
+            "A transaction can only write to one shard, so write to a single pk or use KVSTORE_SQLITE_SHARDS=1"
         )
-        _conn.commit()
+    # A failed write inside the transaction doesn't undo the earlier ones
+    shard.cur.execute("SAVEPOINT statement")
+    try:
+        yield shard.cur
+    except BaseException:
+        shard.cur.execute("ROLLBACK TO statement")
+        shard.cur.execute("RELEASE statement")
+        raise
+    shard.cur.execute("RELEASE statement")
+
+
+@contextmanager
+def _write_transaction(shard):
+    """
+    Run the body in a write transaction on the shard's writer connection,
+    committing it once the body succeeds, and rolling back its changes if it
+    raises.
+
+    With a group commit window (KVSTORE_SQLITE_GROUP_COMMIT_MS) the first
+    writer opens a transaction and commits it once the window has passed, and
+    writers that arrive in the meantime add their changes to it inside a
+    savepoint instead of committing separately. Each of them returns once the
+    shared commit has happened, so there is one fsync per window rather than
+    per write, at the cost of up to a window of extra latency. Until then, reads
+    through the same connection (i.e. outside pool mode) can see the changes.
+    """
+    if not shard.group_commit:
+        with shard.rlock:
+            # Take the database write lock before reading so that no other
+            # connection (or process) can change an item between it being read
+            # and written
+            shard.cur.execute("BEGIN IMMEDIATE")
+            try:
+                yield shard.cur
+            except BaseException:
+                shard.conn.rollback()
+                raise
+            shard.conn.commit()
+        return
+    failed = None
+    with shard.rlock:
+        batch = shard.batch
+        leader = batch is None
+        if batch is None:
+            shard.cur.execute("BEGIN IMMEDIATE")
+            batch = shard.batch = _Batch()
+        shard.cur.execute("SAVEPOINT write")
+        try:
+            yield shard.cur
+        except BaseException as e:
+            shard.cur.execute("ROLLBACK TO write")
+            # Raised once the leader has committed the other writes
+            failed = e
+        shard.cur.execute("RELEASE write")
+    if leader:
+        time.sleep(shard.group_commit)
+        with shard.rlock:
+            shard.batch = None
+            try:
+                shard.conn.commit()
+            except Exception as e:
+                shard.conn.rollback()
+                batch.error = e
+            batch.done.set()
+    if failed is not None:
+        raise failed
+    batch.done.wait()
+    if batch.error is not None:
+        raise batch.error
+
+
+def _current(cur, store, pk, sk):
+    cur.execute(
+        "select data, ttl from store where store = ? AND pk = ? AND sk = ? AND (ttl is NULL OR ttl > ?)",
+        (store, pk, sk, time.time()),
+    )
+    return cur.fetchone()
+
+
+def put(store: str, pk: str, data=None, sk="/", ttl=None, condition=None):
+    values = _put_values(store, pk, data, sk, ttl)
+    _track(store, pk, sk)
+    if condition is None:
+        _write_many(_shard(store, pk), _put_sql, [values])
+        return
+    check_condition(condition)
+    with _immediate(_shard(store, pk)) as cur:
+        row = _current(cur, store, pk, sk)
+        if not condition_matches(condition, row and codec.decode(row[0])):
+            raise ConditionFailed(
+                f"Condition {repr(condition)} failed for pk '{pk}' and sk '{sk}' in the '{store}' store"
+            )
+        cur.execute(_put_sql, values)
+
+
+def put_many(store: str, items):
+    """
+    Put (pk, sk, data, ttl) items in a single transaction, so either all of
+    them are written or none are. When the database is sharded there is one
+    transaction per shard, so this only holds for the items in each shard.
+    """
+    rows = []
+    for pk, sk, data, ttl in items:
+        rows.append(_put_values(store, pk, data, sk, ttl))
+        _track(store, pk, sk)
+    for shard, shard_rows in _by_shard(store, rows, 1):
+        _write_many(shard, _put_sql, shard_rows)
 
 
 def delete(store: str, pk: str, sk="/"):
-    assert "/" not in store
-    if _cur is None:
-        init()
-    assert _conn is not None, "Database not initilaized, no _conn object."
-    assert _cur is not None, "Database not initilaized, no _cur object."
-    assert sk[0] == "/"
+    delete_many(store, [(pk, sk)])
 
-    with rlock:
-        sql = "DELETE FROM " + "store" + " WHERE store=? AND pk=?"
-        # helper_log(__file__, sql, pk)
-        _cur.execute(
-            sql,
-            (
-                store,
-                pk,
-            ),
-        )
-        # Since we need to make a commit anyway, cleanup exired items
-        _cur.execute(
-            "delete from store where ttl is not NULL AND ttl <= ?", (time.time(),)
-        )
-        _conn.commit()
+
+def delete_many(store: str, keys):
+    """
+    Delete (pk, sk) keys in a single transaction (one per shard when the
+    database is sharded).
+    """
+    assert "/" not in store
+    rows = []
+    for pk, sk in keys:
+        assert sk[0] == "/"
+        rows.append((store, pk, sk))
+        _track(store, pk, sk)
+    for shard, shard_rows in _by_shard(store, rows, 1):
+        _write_many(shard, _delete_sql, shard_rows)
 
 
 # consistent is ignored
 def iterate(
-    store, pk, sk_start="/", limit=None, after=False, consistent=False
+    store, pk, sk_start="/", limit=None, after=False, consistent=False, attributes=None
 ) -> tuple[Any, str | None]:
-    if _cur is None:
-        init()
-    assert _conn is not None, "Database not initilaized, no _conn object."
-    assert _cur is not None, "Database not initilaized, no _cur object."
     assert sk_start[0] == "/"
-    with rlock:
+    check_attributes(attributes)
+    with _reading(_shard(store, pk)) as cur:
         # Only return unexpired items
         if after:
             operator = ">"
@@ -162,10 +606,11 @@ def iterate(
         )
         values = [store, pk, sk_start, time.time()]
         if limit:
+            # One extra row shows whether there is anything after the page
             sql += " LIMIT ?"
-            values.append(limit)
-        _cur.execute(sql, values)
-        rows = _cur.fetchall()
+            values.append(limit + 1)
+        cur.execute(sql, values)
+        rows = cur.fetchall()
         # helper_log(__file__, len(rows), rows)
         if len(rows) == 0:
             raise NotFound(f"No such pk '{pk}' in the '{store}' store")
@@ -173,7 +618,11 @@ def iterate(
         size = 0
         last_row = None
         for row in rows:
-            result = json.loads(row[0])
+            if limit and len(results) == limit:
+                return results, last_row
+            result = codec.decode(row[0])
+            if attributes is not None:
+                result = project(result, attributes)
             size += len(row[0])
             # print(size)
             # Why this value?
@@ -184,29 +633,102 @@ def iterate(
         return results, None
 
 
+# consistent is ignored
+def scan_pk(store, pk, sk_start="/", after=False, page_size=100, consistent=False):
+    """
+    Lazily yield every (sk, data, ttl) in the pk, in sk order, reading
+    page_size rows per query and carrying on after the last sk seen, so that
+    large partitions can be walked in constant memory. Unlike iterate(), no
+    NotFound is raised for an empty pk, nothing is yielded instead.
+    """
+    assert "/" not in store
+    assert sk_start[0] == "/"
+    assert page_size > 0, page_size
+    if after:
+        operator = ">"
+    else:
+        operator = ">="
+    while True:
+        # The connection (and in non-pool mode the lock) is only held while
+        # a page is read, not while the caller consumes it
+        with _reading(_shard(store, pk)) as cur:
+            cur.execute(
+                "select sk, data, ttl from store where store = ? AND pk = ? AND sk "
+                + operator
+                + " ? AND (ttl is NULL OR ttl > ?) ORDER BY sk LIMIT ?",
+                (store, pk, sk_start, time.time(), page_size),
+            )
+            rows = cur.fetchall()
+        for sk, data, ttl in rows:
+            yield sk, codec.decode(data), ttl
+        if len(rows) < page_size:
+            return
+        sk_start = rows[-1][0]
+        operator = ">"
+
+
 # consistent is ignored
 def get(
-    store, pk, sk="/", consistent=False
+    store, pk, sk="/", consistent=False, attributes=None
 ) -> tuple[dict[str, int | float | str], float | int | None]:
-    if _cur is None:
-        init()
-    assert _conn is not None, "Database not initilaized, no _conn object."
-    assert _cur is not None, "Database not initilaized, no _cur object."
     assert sk[0] == "/"
-    with rlock:
+    check_attributes(attributes)
+    with _reading(_shard(store, pk)) as cur:
         sql = "select data, ttl from store where store = ? AND pk = ? AND sk = ? AND (ttl is NULL OR ttl > ?)"
         values = [store, pk, sk, time.time()]
-        _cur.execute(sql, values)
-        rows = _cur.fetchall()
+        cur.execute(sql, values)
+        rows = cur.fetchall()
         # helper_log(__file__, len(rows), rows)
         if len(rows) == 0:
             raise NotFound(f"No such pk '{pk}' in the '{store}' store")
-        data = json.loads(rows[0][0])
+        data = codec.decode(rows[0][0])
+        if attributes is not None:
+            data = project(data, attributes)
         ttl = rows[0][1]
         return data, ttl
 
 
-def patch(store, pk, data, sk="/", ttl="notchanged"):
+# Stay well within SQLite's default limit of 999 variables per statement
+GET_MANY_CHUNK_SIZE = 400
+
+
+# consistent is ignored
+def get_many(
+    store, keys, consistent=False
+) -> tuple[
+    dict[tuple[str, str], tuple[dict[str, int | float | str], float | int | None]],
+    list[tuple[str, str]],
+]:
+    """
+    Get the (pk, sk) keys, returning a dictionary of (data, ttl) results keyed
+    by (pk, sk), and a list of the keys that were not found.
+    """
+    assert "/" not in store
+    unique_keys = list(dict.fromkeys((pk, sk) for pk, sk in keys))
+    found = {}
+    now = time.time()
+    for shard, shard_keys in _by_shard(store, unique_keys, 0):
+        with _reading(shard) as cur:
+            for i in range(0, len(shard_keys), GET_MANY_CHUNK_SIZE):
+                chunk = shard_keys[i : i + GET_MANY_CHUNK_SIZE]
+                values: list[Any] = [store]
+                for pk, sk in chunk:
+                    assert sk[0] == "/"
+                    values += [pk, sk]
+                values.append(now)
+                sql = (
+                    "select pk, sk, data, ttl from store where store = ? AND (pk, sk) IN (VALUES "
+                    + ", ".join(["(?, ?)"] * len(chunk))
+                    + ") AND (ttl is NULL OR ttl > ?)"
+                )
+                cur.execute(sql, values)
+                for pk, sk, data, ttl in cur.fetchall():
+                    found[(pk, sk)] = (codec.decode(data), ttl)
+    missing = [key for key in unique_keys if key not in found]
+    return found, missing
+
+
+def patch(store, pk, data, sk="/", ttl="notchanged", condition=None):
     assert "pk" not in data
     assert "sk" not in data
     assert "ttl" not in data
@@ -219,22 +741,34 @@ def patch(store, pk, data, sk="/", ttl="notchanged"):
         assert (
             isinstance(v, (float, int, str)) or v is Remove
         ), f"Expected key {repr(k)} value to be a float, int, str or kvstore.driver.Remove. It is: {repr(v)}."
-    # XXX This should be safe without a transaction because of the RLock? Unless the same thread makes requests concurrently.
-    current, next = iterate(store, pk, sk_start=sk, limit=1, consistent=False)
-    assert next is None, next
-    sk_, data_, ttl_ = current[0]
-    assert sk_ == sk, sk_
-    new_data = {}
-    new_data.update(data_)
-    for k, v in data.items():
-        if v is Remove:
-            if k in new_data:
-                del new_data[k]
+    check_condition(condition)
+    assert (
+        condition is not NotExists
+    ), "patch() only changes existing items, use put() with condition=NotExists to create one"
+    _track(store, pk, sk)
+    with _immediate(_shard(store, pk)) as cur:
+        row = _current(cur, store, pk, sk)
+        if condition is not None and not condition_matches(
+            condition, row and codec.decode(row[0])
+        ):
+            raise ConditionFailed(
+                f"Condition {repr(condition)} failed for pk '{pk}' and sk '{sk}' in the '{store}' store"
+            )
+        if row is None:
+            raise NotFound(f"No such pk '{pk}' in the '{store}' store")
+        new_data = codec.decode(row[0])
+        for k, v in data.items():
+            if v is Remove:
+                if k in new_data:
+                    del new_data[k]
+            else:
+                new_data[k] = v
+        if ttl == "notchanged":
+            new_ttl = row[1]
         else:
-            new_data[k] = v
-    if ttl == "notchanged":
-        new_ttl = ttl_
-    else:
-        new_ttl = ttl
-    assert new_ttl != "notchanged"
-    put(store, pk, new_data, sk, new_ttl)
+            new_ttl = ttl
+        values = _put_values(store, pk, new_data, sk, new_ttl)
+        cur.execute(
+            "UPDATE store SET ttl = ?, data = ? WHERE store = ? AND pk = ? AND sk = ?",
+            (new_ttl, values[-1], store, pk, sk),
+        )
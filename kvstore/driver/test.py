@@ -1,10 +1,45 @@
 # STORE_DIR=. PYTHONPATH=../../ python3 test.py
 # AWS_REGION=eu-west-2 KVSTORE_DYNAMODB_TABLE_NAME=Apps-TaskStack-1SHSM43C3W9G0-Tasks PYTHONPATH=../../ python3 test.py
+# KVSTORE_FAKE_DYNAMODB_THROTTLE_RATE=0.2 PYTHONPATH=../../ python3 test.py --fake-dynamodb
+#
+# With --fake-dynamodb the DynamoDB driver is tested against the in-process
+# stand-in in fake_dynamodb.py, with the latency and throttling set by
+# KVSTORE_FAKE_DYNAMODB_LATENCY_MS and KVSTORE_FAKE_DYNAMODB_THROTTLE_RATE.
+# Some checks rely on 100 ms TTLs not expiring, so when throttling keep
+# KVSTORE_FAKE_DYNAMODB_MAX_BACKOFF_MS well below that and set
+# KVSTORE_FAKE_DYNAMODB_SEED so that each run is throttled the same way.
 
 import math
+import os
+import sys
+import threading
 import time
-
-from kvstore.driver import delete, iterate, patch, put, NotFound, Remove, get
+from contextlib import contextmanager
+
+if "--fake-dynamodb" in sys.argv:
+    # Before kvstore.driver is imported, so that it chooses DynamoDB
+    os.environ["KVSTORE_DYNAMODB_TABLE_NAME"] = "test"
+    os.environ["AWS_REGION"] = "local"
+    from kvstore.driver import fake_dynamodb
+
+    fake_dynamodb.install()
+
+from kvstore.driver import (
+    delete,
+    delete_many,
+    iterate,
+    patch,
+    put,
+    put_many,
+    scan_pk,
+    NotFound,
+    ConditionFailed,
+    NotExists,
+    Remove,
+    get,
+    get_many,
+    transaction,
+)
 
 store = "test"
 
@@ -367,8 +402,9 @@ def main():
                 "Failed to get the remaining rows. First sk is: " + next_results[0][0]
             )
 
+        # Stopping at the limit with more items left still gives a cursor
         results, next_ = iterate(store=store, pk="multiple", limit=2, consistent=True)
-        assert next_ is None, (next_, results[-1][0])
+        assert next_ == "/1", (next_, results[-1][0])
         assert results == [
             ("/", {"foo": "multiple", "large_key": large_key}, None),
             ("/1", {"foo": "multiple/1", "large_key": large_key}, None),
@@ -386,11 +422,36 @@ def main():
         results, next_ = iterate(
             store=store, pk="multiple", sk_start="/1", limit=2, consistent=True
         )
-        assert next_ is None, (next_, results[-1][0])
+        assert next_ == "/2", (next_, results[-1][0])
         assert results == [
             ("/1", {"foo": "multiple/1", "large_key": large_key}, None),
             ("/2", {"foo": "multiple/2", "large_key": large_key}, None),
         ], results
+        # A page that ends exactly at the limit and the last item has no cursor
+        results, next_ = iterate(
+            store=store, pk="multiple", sk_start=next_, after=True, limit=1
+        )
+        assert next_ is None, (next_, results[-1][0])
+        assert results == [
+            ("/3", {"foo": "multiple/3", "large_key": large_key}, None),
+        ], results
+        expected = [
+            ("/", {"foo": "multiple", "large_key": large_key}, None),
+            ("/1", {"foo": "multiple/1", "large_key": large_key}, None),
+            ("/2", {"foo": "multiple/2", "large_key": large_key}, None),
+            ("/3", {"foo": "multiple/3", "large_key": large_key}, None),
+        ]
+        for page_size in [1, 3, 4, 100]:
+            results = list(
+                scan_pk(
+                    store=store, pk="multiple", page_size=page_size, consistent=True
+                )
+            )
+            assert results == expected, (page_size, [r[0] for r in results])
+        results = list(
+            scan_pk(store=store, pk="multiple", sk_start="/1", after=True, page_size=2)
+        )
+        assert results == expected[2:], [r[0] for r in results]
         delete(store=store, pk="multiple")
         delete(store=store, pk="multiple", sk="/1")
         delete(store=store, pk="multiple", sk="/2")
@@ -405,6 +466,7 @@ def main():
             raise Exception(
                 "Still got some of the multiple keys left after deleting them"
             )
+        assert list(scan_pk(store=store, pk="multiple", consistent=True)) == []
         print(
             f"Iteration with multiple and {i==0 and 'small key' or 'large key'} working correctly"
         )
@@ -423,6 +485,221 @@ def main():
     assert ttl is None
     print("put foo5 key with no data, get and iterate behave correctly")
 
+    # More than one DynamoDB batch, with a repeated key where the last one should win
+    items = [("many", f"/{i:02d}", dict(i=i), None) for i in range(40)]
+    items.append(("many", "/00", dict(i=100), None))
+    items.append(("many2", "/", dict(foo="bar"), None))
+    put_many(store=store, items=items)
+    results, next_ = iterate(store=store, pk="many", consistent=True)
+    assert next_ is None
+    assert results == [("/00", {"i": 100}, None)] + [
+        (f"/{i:02d}", {"i": i}, None) for i in range(1, 40)
+    ], results
+    assert get(store=store, pk="many2", consistent=True) == ({"foo": "bar"}, None)
+    delete_many(
+        store=store,
+        keys=[("many", f"/{i:02d}") for i in range(1, 40)] + [("many2", "/")],
+    )
+    results, next_ = iterate(store=store, pk="many", consistent=True)
+    assert results == [("/00", {"i": 100}, None)], results
+    try:
+        get(store=store, pk="many2", consistent=True)
+    except NotFound:
+        pass
+    else:
+        raise Exception("Got many2 after it was deleted by delete_many()")
+    delete(store=store, pk="many", sk="/00")
+    print("put_many and delete_many behave correctly")
+
+    # More than one DynamoDB batch, including an expired item and a repeated key
+    put_many(
+        store=store,
+        items=[("getmany", f"/{i:03d}", dict(i=i), None) for i in range(150)]
+        + [("getmany", "/expired", dict(i=-1), time.time() - 1)],
+    )
+    keys = [("getmany", f"/{i:03d}") for i in range(0, 160, 2)]
+    keys += [("getmany", "/000"), ("getmany", "/expired"), ("nosuchpk", "/")]
+    found, missing = get_many(store=store, keys=keys, consistent=True)
+    assert found == {
+        ("getmany", f"/{i:03d}"): ({"i": i}, None) for i in range(0, 150, 2)
+    }, found
+    assert missing == [("getmany", f"/{i:03d}") for i in range(150, 160, 2)] + [
+        ("getmany", "/expired"),
+        ("nosuchpk", "/"),
+    ], missing
+    delete_many(
+        store=store,
+        keys=[("getmany", f"/{i:03d}") for i in range(150)] + [("getmany", "/expired")],
+    )
+    print("get_many returns found items and reports missing ones")
+
+    def expect_condition_failed(f, **kwargs):
+        try:
+            f(store=store, pk="cond", **kwargs)
+        except ConditionFailed:
+            pass
+        else:
+            raise Exception(f"Failed to trigger ConditionFailed with {kwargs}")
+
+    expect_condition_failed(patch, data=dict(version=2), condition=dict(version=1))
+    put(store=store, pk="cond", data=dict(version=1), condition=NotExists)
+    expect_condition_failed(put, data=dict(version=1), condition=NotExists)
+    expect_condition_failed(put, data=dict(version=3), condition=dict(version=2))
+    expect_condition_failed(put, data=dict(version=3), condition=dict(version="1"))
+    expect_condition_failed(patch, data=dict(version=3), condition=dict(other=1))
+    expect_condition_failed(
+        patch, data=dict(version=3), condition=dict(version=NotExists)
+    )
+    assert get(store=store, pk="cond", consistent=True) == ({"version": 1}, None)
+    patch(store=store, pk="cond", data=dict(version=2), condition=dict(version=1))
+    put(
+        store=store,
+        pk="cond",
+        data=dict(version=3),
+        condition=dict(version=2, other=NotExists),
+    )
+    assert get(store=store, pk="cond", consistent=True) == ({"version": 3}, None)
+    # Expired items count as not existing
+    put(store=store, pk="cond", data=dict(version=4), ttl=time.time() - 1)
+    expect_condition_failed(patch, data=dict(version=5), condition=dict(version=4))
+    put(store=store, pk="cond", data=dict(version=5), condition=NotExists)
+    assert get(store=store, pk="cond", consistent=True) == ({"version": 5}, None)
+    delete(store=store, pk="cond")
+    print("put and patch with conditions behave correctly")
+
+    # Projections return just the named attributes that are set
+    item = dict(end="2023", num_tasks=3, handler="x" * 1000)
+    expires = time.time() + 1000
+    put(store=store, pk="projection", data=item, ttl=expires)
+    put(store=store, pk="projection", sk="/2", data=dict(num_tasks=4))
+    assert get(
+        store=store,
+        pk="projection",
+        attributes=["end", "num_tasks", "missing"],
+        consistent=True,
+    ) == ({"end": "2023", "num_tasks": 3}, expires)
+    assert get(store=store, pk="projection", attributes=[], consistent=True) == (
+        {},
+        expires,
+    )
+    assert iterate(
+        store=store, pk="projection", attributes=["num_tasks"], consistent=True
+    ) == ([("/", {"num_tasks": 3}, expires), ("/2", {"num_tasks": 4}, None)], None)
+    assert get(store=store, pk="projection", consistent=True) == (item, expires)
+    delete_many(store=store, keys=[("projection", "/"), ("projection", "/2")])
+    print("get and iterate return just the projected attributes")
+
+    # Transactions make all of their writes or none of them. Every key shares
+    # a pk so that a sharded SQLite database can run them.
+    put_many(
+        store=store,
+        items=[
+            ("txn", "/a", dict(n=1), None),
+            ("txn", "/b", dict(n=1), None),
+            ("txn", "/c", dict(n=1), None),
+        ],
+    )
+    with transaction():
+        put(store=store, pk="txn", sk="/a", data=dict(n=2), condition=dict(n=1))
+        patch(store=store, pk="txn", sk="/b", data=dict(n=2, m=Remove))
+        delete(store=store, pk="txn", sk="/c")
+        put_many(store=store, items=[("txn", "/d", dict(n=2), None)])
+    assert iterate(store=store, pk="txn", consistent=True) == (
+        [("/a", dict(n=2), None), ("/b", dict(n=2), None), ("/d", dict(n=2), None)],
+        None,
+    )
+    committed = iterate(store=store, pk="txn", consistent=True)
+    try:
+        with transaction():
+            put(store=store, pk="txn", sk="/a", data=dict(n=3))
+            delete_many(store=store, keys=[("txn", "/b")])
+            raise ValueError("Abandon the transaction")
+    except ValueError:
+        pass
+    assert iterate(store=store, pk="txn", consistent=True) == committed
+    try:
+        with transaction():
+            put(store=store, pk="txn", sk="/e", data=dict(n=3))
+            patch(store=store, pk="txn", sk="/b", data=dict(n=3))
+            put(store=store, pk="txn", sk="/a", data=dict(n=3), condition=NotExists)
+    except ConditionFailed:
+        pass
+    else:
+        raise Exception("Expected ConditionFailed")
+    assert iterate(store=store, pk="txn", consistent=True) == committed
+    try:
+        with transaction():
+            put(store=store, pk="txn", sk="/e", data=dict(n=3))
+            patch(store=store, pk="txn", sk="/e", data=dict(n=4))
+    except ConditionFailed:
+        raise
+    except Exception as e:
+        assert "only be written once" in str(e), e
+    else:
+        raise Exception("Expected writing an item twice to fail")
+    assert iterate(store=store, pk="txn", consistent=True) == committed
+    delete_many(store=store, keys=[("txn", "/a"), ("txn", "/b"), ("txn", "/d")])
+    print("transactions commit all of their writes or none of them")
+
+    check_threaded_reads_and_writes()
+    print("readers in other threads see each committed write")
+
+
+def check_threaded_reads_and_writes(writes=200, readers=4):
+    # Readers must see every write committed before their read started, and
+    # with SQLite, never use a connection that another thread is using
+    connections = set()
+    lock = threading.Lock()
+    if "kvstore.driver.sqlite" in sys.modules:
+        from kvstore.driver import sqlite
+
+        reading = sqlite._reading
+
+        @contextmanager
+        def checked_reading(shard):
+            with reading(shard) as cur:
+                with lock:
+                    assert (
+                        id(cur.connection) not in connections
+                    ), "A connection is being used by two threads at once"
+                    connections.add(id(cur.connection))
+                try:
+                    yield cur
+                finally:
+                    with lock:
+                        connections.discard(id(cur.connection))
+
+        sqlite._reading = checked_reading
+    committed = 0
+    done = threading.Event()
+    errors = []
+
+    def read():
+        try:
+            while not done.is_set():
+                at_least = committed
+                data, ttl = get(store=store, pk="threads", consistent=True)
+                assert int(data["n"]) >= at_least, (data, at_least)
+        except Exception as e:
+            errors.append(e)
+
+    put(store=store, pk="threads", data=dict(n=0))
+    threads = [threading.Thread(target=read) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for n in range(1, writes + 1):
+            put(store=store, pk="threads", data=dict(n=n))
+            committed = n
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+        if "kvstore.driver.sqlite" in sys.modules:
+            sqlite._reading = reading
+    assert not errors, errors
+    delete(store=store, pk="threads")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,124 @@
+# STORE_DIR=. PYTHONPATH=../../ python3 test_aio.py
+# KVSTORE_DRIVER=memory PYTHONPATH=../../ python3 test_aio.py
+# PYTHONPATH=../../ python3 test_aio.py --fake-dynamodb
+#
+# Checks that kvstore.driver.aio gives the same results as kvstore.driver, and
+# that many calls can be in flight at once. With --fake-dynamodb the asyncio
+# DynamoDB client talks HTTP to the stand-in in fake_dynamodb.py, which the
+# blocking driver shares so that each can read what the other writes.
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+store = "test_aio"
+
+
+async def check(aio, driver):
+    from kvstore.driver.aio import ConditionFailed, NotExists, NotFound, Remove
+
+    pk = f"aio/{time.time()}"
+    await aio.put(store, pk, {"hello": "world", "n": 1})
+    assert await aio.get(store, pk) == ({"hello": "world", "n": 1}, None)
+    assert driver.get(store, pk) == ({"hello": "world", "n": 1}, None)
+    assert await aio.get(store, pk, attributes=["n"]) == ({"n": 1}, None)
+
+    await aio.patch(store, pk, {"hello": Remove, "n": 2}, ttl=time.time() + 100)
+    data, ttl = await aio.get(store, pk, consistent=True)
+    assert data == {"n": 2}, data
+    assert ttl > time.time(), ttl
+
+    try:
+        await aio.put(store, pk, {"n": 3}, condition=NotExists)
+    except ConditionFailed:
+        pass
+    else:
+        raise Exception("Expected ConditionFailed")
+    await aio.patch(store, pk, {"n": 3}, condition={"n": 2})
+
+    await aio.delete(store, pk)
+    try:
+        await aio.get(store, pk)
+    except NotFound:
+        pass
+    else:
+        raise Exception("Expected NotFound")
+
+    # Batches, scans and lots of calls in flight at once
+    items = [(pk, f"/{i:03d}", {"i": i}, None) for i in range(120)]
+    await aio.put_many(store, items)
+    results = await asyncio.gather(
+        *[aio.get(store, pk, sk=f"/{i:03d}") for i in range(120)]
+    )
+    assert [data["i"] for data, ttl in results] == list(range(120)), results
+    found, missing = await aio.get_many(
+        store, [(pk, "/000"), (pk, "/119"), (pk, "/missing")]
+    )
+    assert sorted(found) == [(pk, "/000"), (pk, "/119")], found
+    assert missing == [(pk, "/missing")], missing
+    page, next_ = await aio.iterate(store, pk, limit=10)
+    assert [sk for sk, data, ttl in page] == [f"/{i:03d}" for i in range(10)]
+    scanned = [sk async for sk, data, ttl in aio.scan_pk(store, pk, page_size=7)]
+    assert scanned == [f"/{i:03d}" for i in range(120)], scanned
+    assert scanned == [sk for sk, data, ttl in driver.scan_pk(store, pk)]
+    await aio.delete_many(store, [(pk, sk) for pk, sk, data, ttl in items])
+    assert [item async for item in aio.scan_pk(store, pk)] == []
+
+
+async def check_loop_not_blocked(aio, driver):
+    # A call that waits while another thread is in a transaction() leaves the
+    # event loop free to run other tasks
+    pk = f"aio/{time.time()}"
+    entered = threading.Event()
+
+    def hold():
+        with driver.transaction():
+            driver.put(store, pk, {"n": 1})
+            entered.set()
+            time.sleep(0.2)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    entered.wait()
+    call = asyncio.ensure_future(aio.put(store, pk, {"n": 2}))
+    start = time.time()
+    await asyncio.sleep(0.01)
+    assert time.time() - start < 0.1, time.time() - start
+    await call
+    thread.join()
+    assert driver.get(store, pk) == ({"n": 2}, None)
+    await aio.delete(store, pk)
+
+
+async def main():
+    server = None
+    if "--fake-dynamodb" in sys.argv:
+        # Before kvstore.driver is imported, so that it chooses DynamoDB
+        os.environ["KVSTORE_DYNAMODB_TABLE_NAME"] = "test"
+        os.environ["AWS_REGION"] = "local"
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "fake")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "fake")
+        from kvstore.driver import fake_dynamodb
+
+        fake = fake_dynamodb.install()
+        server = await fake_dynamodb.serve(fake)
+        port = server.sockets[0].getsockname()[1]
+        os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = f"http://127.0.0.1:{port}"
+
+    import kvstore.driver as driver
+    from kvstore.driver import aio
+
+    try:
+        await check(aio, driver)
+        if server is None:
+            await check_loop_not_blocked(aio, driver)
+    finally:
+        if server is not None:
+            server.close()
+    print("Success")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
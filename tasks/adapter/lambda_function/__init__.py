@@ -1,6 +1,7 @@
 import base64
 import datetime
 import importlib
+import json
 import os
 import time
 
@@ -33,7 +34,39 @@ if encoded_environment:
 
 # Must come after the environment is set up
 import tasks.driver
-from tasks.adapter.shared import make_task, Abort, RenderableTaskAbort, OutOfTime
+from tasks.adapter.shared import (
+    make_task,
+    Abort,
+    Durations,
+    PendingEnd,
+    RenderableTaskAbort,
+)
+
+
+def log_metrics(workflow_id, **metrics):
+    # In CloudWatch's embedded metric format, so that the log line is also
+    # recorded as metrics in the Tasks namespace
+    units = {k: "Milliseconds" if k.endswith("Ms") else "Count" for k in metrics}
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": "Tasks",
+                            "Dimensions": [[]],
+                            "Metrics": [
+                                {"Name": k, "Unit": unit} for k, unit in units.items()
+                            ],
+                        }
+                    ],
+                },
+                "workflow_id": workflow_id,
+                **metrics,
+            }
+        )
+    )
 
 
 def make_lambda_handler():
@@ -45,7 +78,29 @@ def make_lambda_handler():
         safety_delay_ms = int((os.environ.get("SAFETY_DELAY_MS", "0")))
         print(event, context, uid, delay_ms, safety_multiple, safety_delay_ms)
         workflow_id = event["workflow_id"]
-        next_task, workflow_state, task_state = tasks.driver.get_next_task(workflow_id)
+        if event.get("end_workflow"):
+            # The state machine's last state, once every range has finished
+            # or one of them has failed
+            tasks.driver.end_workflow(
+                uid, workflow_id, event.get("status", "SUCCEEDED")
+            )
+            event["success"] = True
+            return event
+        # Each iteration of the state machine's Map state runs one range of
+        # tasks. Executions started without ranges run the whole workflow.
+        first = int(event.get("first", 1))
+        last = event.get("last")
+        # An invocation that ran out of time passes on where it got to, so the
+        # next one doesn't have to search the range for it
+        next_task, workflow_state, task_state = tasks.driver.get_next_task(
+            workflow_id,
+            first,
+            last,
+            next_task=event.pop("next_task", None),
+            num_tasks=event.pop("num_tasks", None),
+        )
+        if last is None:
+            last = workflow_state["num_tasks"]
 
         if "abort" in workflow_state and str(workflow_state["abort"]).lower() in [
             "1",
@@ -61,8 +116,22 @@ def make_lambda_handler():
         module, obj = workflow_state["handler"].split(":")
         m = importlib.import_module(module)
         handler_function = getattr(m, obj)
-        # This algorithm will always try and run at least one task
+        # This algorithm will always try and run at least one task, then only
+        # starts another if the remaining time covers the percentile of recent
+        # durations (times the safety multiple), so a single slow task doesn't
+        # shrink the rest of the invocation. The durations are kept per range
+        # in the workflow state so that they carry over between invocations.
+        percentile = float(os.environ.get("TASKS_DURATION_PERCENTILE", "95"))
+        durations = Durations(
+            workflow_state.get(tasks.driver.durations_key(first), ""),
+            size=int(os.environ.get("TASKS_DURATION_WINDOW", "50")),
+        )
         longest_task_ms = 0.0
+        budget_ms = None
+        resume_at = None
+        tasks_run = 0
+        overruns = 0
+        wasted_ms = 0
 
         def patch_workflow_state(data):
             # Save to store
@@ -70,64 +139,119 @@ def make_lambda_handler():
             # And update locally
             workflow_state.update(data)
 
-        for number in range(next_task, workflow_state["num_tasks"] + 1):
-            time.sleep(delay_ms / 1000.0)
-            task = make_task(
-                uid,
-                workflow_id=workflow_id,
-                workflow_state=workflow_state,
-                patch_workflow_state=patch_workflow_state,
-                number=number,
-                default_begin_ttl=None,
-            )
-
-            now = time.time()
+        # Each task's end is written along with the next task's begin
+        pending_end = PendingEnd()
 
+        def record():
+            # Write the last task's end and the durations, and log the metrics
             try:
-                handler_function(task)
-            except Abort as a:
-                if isinstance(a, RenderableTaskAbort):
-                    task.correctly_escaped_html_status_message = a.render()
-                task.end_state_patches["failed"] = 1
-                tasks.driver.end_task(
-                    uid,
+                with pending_end.flushing():
+                    if tasks_run:
+                        tasks.driver.patch_durations(
+                            workflow_id, first, durations.encode()
+                        )
+            finally:
+                log_metrics(
                     workflow_id,
-                    workflow_state["num_tasks"],
-                    number,
-                    str(task.correctly_escaped_html_status_message),
-                    task.end_state_patches,
-                    datetime.datetime.now(),
-                    ttl=task.end_ttl,
+                    TasksRun=tasks_run,
+                    Overruns=overruns,
+                    PredictedTaskMs=durations.percentile(percentile),
+                    LongestTaskMs=longest_task_ms,
+                    WastedMs=wasted_ms,
                 )
-                raise Abort(str(a))
-            else:
-                tasks.driver.end_task(
+
+        try:
+            for number in range(next_task, int(last) + 1):
+                time.sleep(delay_ms / 1000.0)
+                task = make_task(
                     uid,
-                    workflow_id,
-                    workflow_state["num_tasks"],
-                    number,
-                    str(task.correctly_escaped_html_status_message),
-                    task.end_state_patches,
-                    datetime.datetime.now(),
-                    ttl=task.end_ttl,
+                    workflow_id=workflow_id,
+                    workflow_state=workflow_state,
+                    patch_workflow_state=patch_workflow_state,
+                    number=number,
+                    default_begin_ttl=None,
+                    pending_end=pending_end,
                 )
-            if not task._begun:
-                raise Exception(
-                    f'task.begin() was not called by {repr(workflow_state["handler"])} for task number {number}.'
-                )
-            elapsed_ms: float = (time.time() - now) * 1000
-            if elapsed_ms > longest_task_ms:
-                longest_task_ms = elapsed_ms
-
-            remaining_ms = context.get_remaining_time_in_millis()
-            needed_ms = (longest_task_ms * safety_multiple) + safety_delay_ms + delay_ms
-            if remaining_ms < needed_ms:
-                raise OutOfTime(
-                    f"Out of time to run the next task. Need {needed_ms} ms but only have {remaining_ms}"
+
+                now = time.time()
+
+                try:
+                    handler_function(task)
+                except Abort as a:
+                    if isinstance(a, RenderableTaskAbort):
+                        task.correctly_escaped_html_status_message = a.render()
+                    task.end_state_patches["failed"] = 1
+                    with pending_end.flushing():
+                        tasks.driver.end_task(
+                            uid,
+                            workflow_id,
+                            workflow_state["num_tasks"],
+                            number,
+                            str(task.correctly_escaped_html_status_message),
+                            task.end_state_patches,
+                            datetime.datetime.now(),
+                            ttl=task.end_ttl,
+                            condition=task.end_condition(),
+                        )
+                    raise Abort(str(a))
+                else:
+                    pending_end.set(
+                        uid,
+                        workflow_id,
+                        workflow_state["num_tasks"],
+                        number,
+                        str(task.correctly_escaped_html_status_message),
+                        task.end_state_patches,
+                        datetime.datetime.now(),
+                        ttl=task.end_ttl,
+                        condition=task.end_condition(),
+                    )
+                if not task._begun:
+                    raise Exception(
+                        f'task.begin() was not called by {repr(workflow_state["handler"])} for task number {number}.'
+                    )
+                elapsed_ms: float = (time.time() - now) * 1000
+                if elapsed_ms > longest_task_ms:
+                    longest_task_ms = elapsed_ms
+                if budget_ms is not None and elapsed_ms + delay_ms > budget_ms:
+                    # Took longer than was allowed for, so was lucky to finish
+                    overruns += 1
+                durations.add(elapsed_ms)
+                tasks_run += 1
+                if number == int(last):
+                    break
+
+                remaining_ms = context.get_remaining_time_in_millis()
+                budget_ms = (
+                    durations.percentile(percentile) * safety_multiple
+                    + safety_delay_ms
+                    + delay_ms
                 )
+                if remaining_ms < budget_ms:
+                    wasted_ms = remaining_ms
+                    print(
+                        f"Out of time to run the next task. Need {budget_ms} ms but only have {remaining_ms}"
+                    )
+                    resume_at = number + 1
+                    break
+        except BaseException:
+            # Record what can be, without hiding why the invocation failed
+            try:
+                record()
+            except Exception as e:
+                print("Could not record the invocation:", repr(e))
+            raise
+        else:
+            record()
 
         print("Longest task (ms):", longest_task_ms)
-        tasks.driver.end_workflow(uid, workflow_id)
+        if resume_at is not None:
+            # The state machine invokes the Lambda again with this as its input
+            event["next_task"] = resume_at
+            event["num_tasks"] = workflow_state["num_tasks"]
+            return event
+        if "first" not in event:
+            tasks.driver.end_workflow(uid, workflow_id)
         # This becomes the output of the state machine
         event["success"] = True
         return event
@@ -1,22 +1,36 @@
 import datetime
 import importlib
+import multiprocessing
 import os
 import tasks.driver
+import threading
 import time
 import uuid
+from concurrent.futures import (
+    FIRST_EXCEPTION,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 
 
-from tasks.adapter.shared import make_task, Abort, RenderableTaskAbort
+from tasks.adapter.shared import make_task, Abort, PendingEnd, RenderableTaskAbort
 
 
-def run(workflow_id):
-    # Here the event is whatever you pass as the JSON when executing the stepfunctions state machine
-    uid = str(uuid.uuid4())
+def run_range(uid, workflow_id, first=1, last=None, stop=None):
+    """
+    Run the tasks from first to last (by default the rest of the workflow) in
+    order, returning how long the longest one took in ms. If stop is set by
+    another range failing, this stops before its next task.
+    """
     delay_ms = int((os.environ.get("DELAY_MS", "0")))
 
-    print(workflow_id, uid, delay_ms)
-
-    next_task, workflow_state, data = tasks.driver.get_next_task(workflow_id)
+    next_task, workflow_state, data = tasks.driver.get_next_task(
+        workflow_id, first, last
+    )
+    if last is None:
+        last = workflow_state["num_tasks"]
     module, obj = workflow_state["handler"].split(":")
     m = importlib.import_module(module)
     handler_function = getattr(m, obj)
@@ -29,58 +43,134 @@ def run(workflow_id):
         # And update locally
         workflow_state.update(data)
 
-    for number in range(next_task, workflow_state["num_tasks"] + 1):
-        time.sleep(delay_ms / 1000.0)
-        now = time.time()
-        task = make_task(
-            uid,
-            workflow_id=workflow_id,
-            workflow_state=workflow_state,
-            patch_workflow_state=patch_workflow_state,
-            number=number,
-        )
-
-        try:
-            handler_function(task)
-        except Abort as a:
-            if isinstance(a, RenderableTaskAbort):
-                task.correctly_escaped_html_status_message = a.render()
-            task.end_state_patches["failed"] = 1
-            tasks.driver.end_task(
-                uid,
-                workflow_id,
-                workflow_state["num_tasks"],
-                number,
-                task.correctly_escaped_html_status_message,
-                task.end_state_patches,
-                datetime.datetime.now(),
-            )
-            raise
-        else:
-            tasks.driver.end_task(
+    # Each task's end is written along with the next task's begin
+    pending_end = PendingEnd()
+    try:
+        for number in range(next_task, last + 1):
+            if stop is not None and stop.is_set():
+                break
+            time.sleep(delay_ms / 1000.0)
+            now = time.time()
+            task = make_task(
                 uid,
-                workflow_id,
-                workflow_state["num_tasks"],
-                number,
-                task.correctly_escaped_html_status_message,
-                task.end_state_patches,
-                datetime.datetime.now(),
+                workflow_id=workflow_id,
+                workflow_state=workflow_state,
+                patch_workflow_state=patch_workflow_state,
+                number=number,
+                pending_end=pending_end,
             )
 
-        if not task._begun:
-            raise Exception(
-                f'task.begin() was not called by {repr(workflow_state["handler"])} for task number {number}.'
-            )
+            try:
+                handler_function(task)
+            except Abort as a:
+                if isinstance(a, RenderableTaskAbort):
+                    task.correctly_escaped_html_status_message = a.render()
+                task.end_state_patches["failed"] = 1
+                with pending_end.flushing():
+                    tasks.driver.end_task(
+                        uid,
+                        workflow_id,
+                        workflow_state["num_tasks"],
+                        number,
+                        task.correctly_escaped_html_status_message,
+                        task.end_state_patches,
+                        datetime.datetime.now(),
+                        condition=task.end_condition(),
+                    )
+                raise
+            else:
+                pending_end.set(
+                    uid,
+                    workflow_id,
+                    workflow_state["num_tasks"],
+                    number,
+                    task.correctly_escaped_html_status_message,
+                    task.end_state_patches,
+                    datetime.datetime.now(),
+                    condition=task.end_condition(),
+                )
+
+            if not task._begun:
+                raise Exception(
+                    f'task.begin() was not called by {repr(workflow_state["handler"])} for task number {number}.'
+                )
+
+            elapsed_ms: float = (time.time() - now) * 1000
+            if elapsed_ms > longest_task_ms:
+                longest_task_ms = elapsed_ms
+    finally:
+        pending_end.flush()
+    return longest_task_ms
 
-        elapsed_ms: float = (time.time() - now) * 1000
-        if elapsed_ms > longest_task_ms:
-            longest_task_ms = elapsed_ms
 
+def run(workflow_id):
+    # Here the event is whatever you pass as the JSON when executing the stepfunctions state machine
+    uid = str(uuid.uuid4())
+    delay_ms = int((os.environ.get("DELAY_MS", "0")))
+
+    print(workflow_id, uid, delay_ms)
+
+    try:
+        longest_task_ms = _run_ranges(uid, workflow_id)
+    except Exception:
+        # Like the state machine, record the workflow as failed so that it
+        # moves to the FAILED index
+        tasks.driver.end_workflow(uid, workflow_id, "FAILED")
+        raise
     print("Longest task (ms):", longest_task_ms)
     tasks.driver.end_workflow(uid, workflow_id)
     return True
 
 
+def _run_ranges(uid, workflow_id):
+    next_task, workflow_state, data = tasks.driver.get_next_task(workflow_id)
+    ranges = tasks.driver.task_ranges(
+        workflow_state["num_tasks"], workflow_state.get("concurrency", 1)
+    )
+    if len(ranges) == 1:
+        return run_range(uid, workflow_id)
+    else:
+        # Each range runs in its own thread, or with TASKS_LOCAL_EXECUTOR=process
+        # its own process, which needs a store that processes share (i.e. not
+        # KVSTORE_DRIVER=memory)
+        executor: Executor
+        if os.environ.get("TASKS_LOCAL_EXECUTOR", "thread") == "process":
+            if os.environ.get("KVSTORE_DRIVER") == "memory":
+                raise Exception(
+                    "TASKS_LOCAL_EXECUTOR=process needs a store that processes share, so can't be used with KVSTORE_DRIVER=memory"
+                )
+            # Spawned rather than forked, so that the processes open their own
+            # store connections instead of sharing this one's
+            context = multiprocessing.get_context("spawn")
+            manager = context.Manager()
+            stop = manager.Event()
+            executor = ProcessPoolExecutor(max_workers=len(ranges), mp_context=context)
+        else:
+            manager = None
+            stop = threading.Event()
+            executor = ThreadPoolExecutor(
+                max_workers=len(ranges), thread_name_prefix="tasks"
+            )
+        try:
+            with executor:
+                futures = [
+                    executor.submit(run_range, uid, workflow_id, first, last, stop)
+                    for first, last in ranges
+                ]
+                done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+                # Like the sequential runner, stop at the first failure
+                stop.set()
+            # Raise the failure that stopped the other ranges, rather than
+            # whichever range happens to come first
+            for future in done:
+                if future.exception() is not None:
+                    future.result()
+            return max(future.result() for future in futures)
+        finally:
+            if manager is not None:
+                manager.shutdown()
+
+
 if __name__ == "__main__":
     import sys
 
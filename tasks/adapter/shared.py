@@ -1,5 +1,8 @@
+from collections import deque
+from contextlib import contextmanager
 from dataclasses import dataclass
 import datetime
+import math
 from typing import Any, Literal
 
 
@@ -27,6 +30,7 @@ class Task:
     get_task_state: Any
     _begun: list[bool]
     begin: Any
+    end_condition: Any
     Abort: type[Abort]
     OutOfTime: type[OutOfTime]
     end_ttl: None | int | Literal["notchanged"]
@@ -37,6 +41,76 @@ class Task:
 import tasks.driver
 
 
+class PendingEnd:
+    """
+    The end_task() write for the task that has just run, held back by the
+    runner so that it is made in the same transaction as the next task's
+    begin_task() write, saving a commit (or a round trip) per task.
+
+    It is written before the runner's own writes and reads could get ahead
+    of it: along with the next task's begin or state patch, before the next
+    task reads a task's state, along with the next task's end if that task
+    never begins, and when the runner stops for any reason. Other readers
+    can see it late, though. Until one of those happens, progress() shows the
+    task as still running, so a handler that does slow work before calling
+    begin() delays the previous task's end by as long. The only difference a
+    crash can make is that a hard kill between a task returning and the next
+    one beginning runs that task again, as a kill while it was ending
+    already could.
+    """
+
+    def __init__(self):
+        self.args = None
+
+    def set(self, *args, **kwargs):
+        """Hold back an end_task(*args, **kwargs) call."""
+        self.flush()
+        self.args = (args, kwargs)
+
+    @contextmanager
+    def flushing(self):
+        """Make the held end_task() call and the writes in the body together."""
+        if self.args is None:
+            yield
+            return
+        args, kwargs = self.args
+        self.args = None
+        with tasks.driver.transaction():
+            tasks.driver.end_task(*args, **kwargs)
+            yield
+
+    def flush(self):
+        with self.flushing():
+            pass
+
+
+class Durations:
+    """
+    A rolling window of the most recent task durations in ms, used to predict
+    how long the next task will take. It is encoded as a comma separated
+    string so that it can be kept in the workflow state between invocations.
+    """
+
+    def __init__(self, encoded="", size=50):
+        assert size > 0, size
+        self.window: deque[float] = deque(
+            (float(ms) for ms in str(encoded).split(",") if ms), maxlen=size
+        )
+
+    def add(self, ms):
+        self.window.append(ms)
+
+    def percentile(self, p):
+        """The nearest-rank percentile, or 0 if there are no durations yet."""
+        if not self.window:
+            return 0.0
+        ordered = sorted(self.window)
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    def encode(self):
+        return ",".join(f"{round(ms, 1):g}" for ms in self.window)
+
+
 def make_task(
     uid,
     workflow_id,
@@ -44,38 +118,58 @@ def make_task(
     patch_workflow_state,
     number,
     default_begin_ttl=None,
+    pending_end=None,
 ):
     begun = [False]
     begun_at = datetime.datetime.now()
+    if pending_end is None:
+        pending_end = PendingEnd()
 
     def get_task_state(number):
+        pending_end.flush()
         data, ttl = tasks.driver.get_task(
             workflow_id, int(workflow_state["num_tasks"]), number
         )
         return data
 
+    def patch_state(data):
+        # After the previous task's end, which is written along with it
+        with pending_end.flushing():
+            patch_workflow_state(data)
+
     def begin(correctly_escaped_html_status_message, task_state=None):
         begun[0] = True
-        tasks.driver.begin_task(
-            uid,
-            workflow_id,
-            workflow_state["num_tasks"],
-            number,
-            correctly_escaped_html_status_message,
-            task_state,
-            begun_at,
-            ttl=default_begin_ttl,
-        )
+        with pending_end.flushing():
+            tasks.driver.begin_task(
+                uid,
+                workflow_id,
+                workflow_state["num_tasks"],
+                number,
+                correctly_escaped_html_status_message,
+                task_state,
+                begun_at,
+                ttl=default_begin_ttl,
+            )
+
+    def end_condition():
+        # Only end the task if its record still belongs to this runner. If an
+        # overlapping retry has begun the task again, ending it here would
+        # overwrite the other runner's record, so the store raises
+        # kvstore.driver.ConditionFailed instead.
+        if begun[0]:
+            return {"begin_uid": uid}
+        return None
 
     return Task(
         number=number,
         correctly_escaped_html_status_message="",
         workflow_state=workflow_state,
-        patch_workflow_state=patch_workflow_state,
+        patch_workflow_state=patch_state,
         end_state_patches={},
         get_task_state=get_task_state,
         _begun=begun,
         begin=begin,
+        end_condition=end_condition,
         Abort=Abort,
         OutOfTime=OutOfTime,
         end_ttl="notchanged",
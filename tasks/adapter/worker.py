@@ -0,0 +1,274 @@
+"""
+A long-lived local worker service that runs workflows from a durable queue in
+the tasks store, rather than starting a subprocess per workflow.
+
+kvstore_local.begin_state_machine() calls enqueue(), which adds the workflow
+to the queue and starts a pool of TASKS_WORKERS threads (default 4) in the
+current process if one isn't running. Each thread claims the oldest unclaimed
+workflow, runs it with process.run() and then removes it from the queue, so
+the pool reuses the interpreter, the imports and the kvstore connections.
+With TASKS_WORKER=external, enqueue() leaves the queue for a pool run in its
+own process instead:
+
+    PYTHONPATH=. STORE_DIR=kvstore/driver python3 tasks/adapter/worker.py
+
+Once TASKS_WORKER_MAX_QUEUE workflows (default 100) are queued or running,
+enqueue() raises QueueFull rather than letting a burst of submissions pile up.
+The limit is approximate: the queue is counted and then added to in separate
+steps, so submissions at the same moment can take it a little past the limit.
+
+A claim is a lease of TASKS_WORKER_LEASE seconds (default 60) which the pool
+renews while the workflow runs. Once a lease has lapsed, because the pool
+that held it stopped or was killed, any pool can claim the workflow and
+resume it from its next task. Live claims are left alone, so more than one
+pool can share a store.
+
+stats() returns the depth of the queue and counts of what this process has
+done with it.
+"""
+
+import datetime
+import os
+import threading
+import time
+import uuid
+
+from typing import Any
+
+import kvstore.driver
+from tasks.adapter import process
+from tasks.driver.kvstore_local import QueueFull
+
+store = "tasks"
+queue_pk = "queue"
+
+_lock = threading.Lock()
+_threads: list[threading.Thread] = []
+_heartbeat: threading.Thread | None = None
+# Set to wake idle workers when a workflow is enqueued in this process
+_wake = threading.Event()
+_stop = threading.Event()
+# Set once the workers have finished, to stop renewing their leases
+_stopped = threading.Event()
+# workflow id -> when this process's pool started running it
+_running: dict[str, float] = {}
+# workflow id -> the worker holding its claim
+_claims: dict[str, str] = {}
+_counts = {"enqueued": 0, "rejected": 0, "succeeded": 0, "failed": 0}
+
+
+def _queue(limit=None):
+    # (workflow id, data) for each queued workflow, oldest first since
+    # workflow ids begin with the time they were begun
+    results: list[tuple[str, dict[str, Any]]] = []
+    for sk, data, ttl in kvstore.driver.scan_pk(store, queue_pk, consistent=True):
+        if limit is not None and len(results) >= limit:
+            break
+        results.append((sk[1:], data))
+    return results
+
+
+def enqueue(workflow_id):
+    """
+    Add workflow_id to the queue, raising QueueFull if it already holds
+    TASKS_WORKER_MAX_QUEUE workflows (approximately, see above), and start
+    the pool unless TASKS_WORKER=external.
+    """
+    max_queue = int(os.environ.get("TASKS_WORKER_MAX_QUEUE", "100"))
+    assert max_queue > 0, max_queue
+    if len(_queue(max_queue)) >= max_queue:
+        with _lock:
+            _counts["rejected"] += 1
+        raise QueueFull(
+            f"There are already {max_queue} workflows queued or running, try again later"
+        )
+    kvstore.driver.put(
+        store,
+        queue_pk,
+        sk="/" + workflow_id,
+        data={"enqueued": datetime.datetime.now().isoformat()},
+        condition=kvstore.driver.NotExists,
+    )
+    with _lock:
+        _counts["enqueued"] += 1
+    if os.environ.get("TASKS_WORKER", "thread") != "external":
+        start()
+    _wake.set()
+
+
+def status(workflow_id):
+    """
+    Return "PENDING" while workflow_id is waiting in the queue, "RUNNING"
+    once a worker has claimed it, and None when it isn't in the queue.
+    """
+    try:
+        data, ttl = kvstore.driver.get(
+            store, queue_pk, sk="/" + workflow_id, consistent=True
+        )
+    except kvstore.driver.NotFound:
+        return None
+    return "RUNNING" if _claimed(data) else "PENDING"
+
+
+def _lease():
+    lease = float(os.environ.get("TASKS_WORKER_LEASE", "60"))
+    assert lease > 0, lease
+    return lease
+
+
+def _claimed(data):
+    # Claimed by a pool whose lease hasn't lapsed
+    return "claimed_by" in data and data.get("lease_until", 0) > time.time()
+
+
+def _claim(worker):
+    for workflow_id, data in _queue():
+        if _claimed(data) or workflow_id in _running:
+            continue
+        if "claimed_by" in data:
+            # Left by a pool that has stopped, so the workflow is run again,
+            # unless the lease has been renewed since it was read
+            condition = {
+                "claimed_by": data["claimed_by"],
+                "lease_until": data["lease_until"],
+            }
+        else:
+            condition = {"claimed_by": kvstore.driver.NotExists}
+        try:
+            kvstore.driver.patch(
+                store,
+                queue_pk,
+                {
+                    "claimed_by": worker,
+                    "claimed_at": datetime.datetime.now().isoformat(),
+                    "lease_until": time.time() + _lease(),
+                },
+                sk="/" + workflow_id,
+                condition=condition,
+            )
+        except (kvstore.driver.ConditionFailed, kvstore.driver.NotFound):
+            # Another worker got there first
+            continue
+        return workflow_id
+    return None
+
+
+def _renew_leases():
+    # Runs until the pool has stopped and finished its workflows
+    while not _stopped.wait(_lease() / 3):
+        with _lock:
+            claims = dict(_claims)
+        for workflow_id, worker in claims.items():
+            try:
+                kvstore.driver.patch(
+                    store,
+                    queue_pk,
+                    {"lease_until": time.time() + _lease()},
+                    sk="/" + workflow_id,
+                    condition={"claimed_by": worker},
+                )
+            except (kvstore.driver.ConditionFailed, kvstore.driver.NotFound):
+                # Finished, or the lease lapsed and another pool claimed it
+                pass
+
+
+def _work(worker, poll_interval):
+    while not _stop.is_set():
+        workflow_id = _claim(worker)
+        if workflow_id is None:
+            _wake.wait(poll_interval)
+            _wake.clear()
+            continue
+        with _lock:
+            _running[workflow_id] = time.time()
+            _claims[workflow_id] = worker
+        outcome = "failed"
+        try:
+            process.run(workflow_id)
+            outcome = "succeeded"
+        except Exception as e:
+            print(f"Warning: Workflow {workflow_id} failed: {repr(e)}")
+        finally:
+            try:
+                kvstore.driver.delete(store, queue_pk, sk="/" + workflow_id)
+            finally:
+                with _lock:
+                    del _running[workflow_id]
+                    del _claims[workflow_id]
+                    _counts[outcome] += 1
+
+
+def start(workers=None, poll_interval=None):
+    """
+    Start a pool of workers threads in this process if there isn't one
+    already. Idle workers check the queue, including for claims whose lease
+    has lapsed, every poll_interval seconds, or as soon as a workflow is
+    enqueued in this process.
+    """
+    global _heartbeat
+    if workers is None:
+        workers = int(os.environ.get("TASKS_WORKERS", "4"))
+    if poll_interval is None:
+        poll_interval = float(os.environ.get("TASKS_WORKER_POLL_INTERVAL", "1"))
+    assert workers > 0, workers
+    assert poll_interval > 0, poll_interval
+    with _lock:
+        if _threads:
+            return
+        _stop.clear()
+        _stopped.clear()
+        _heartbeat = threading.Thread(
+            target=_renew_leases, name="tasks-worker-leases", daemon=True
+        )
+        _heartbeat.start()
+        worker_uid = str(uuid.uuid4())
+        for i in range(workers):
+            thread = threading.Thread(
+                target=_work,
+                args=(f"{worker_uid}/{i}", poll_interval),
+                name=f"tasks-worker-{i}",
+                daemon=True,
+            )
+            thread.start()
+            _threads.append(thread)
+
+
+def stop():
+    """Stop the pool once the workflows it is running have finished."""
+    _stop.set()
+    _wake.set()
+    with _lock:
+        threads = list(_threads)
+    for thread in threads:
+        thread.join()
+    _stopped.set()
+    if _heartbeat is not None:
+        _heartbeat.join()
+    with _lock:
+        _threads.clear()
+
+
+def stats():
+    queue = _queue()
+    with _lock:
+        result: dict[str, int | float] = dict(_counts)
+        result["workers"] = len(_threads)
+        result["busy"] = len(_running)
+        started = list(_running.values())
+    result["queued"] = sum(1 for workflow_id, data in queue if not _claimed(data))
+    result["running"] = len(queue) - result["queued"]
+    # How long the longest running workflow in this process has been going
+    result["oldest_running_s"] = time.time() - min(started) if started else 0.0
+    return result
+
+
+if __name__ == "__main__":
+    start()
+    print("Workers started", stats())
+    try:
+        while True:
+            time.sleep(float(os.environ.get("TASKS_WORKER_STATS_INTERVAL", "60")))
+            print("Worker stats", stats())
+    except KeyboardInterrupt:
+        print("Stopping once the running workflows have finished ...")
+        stop()
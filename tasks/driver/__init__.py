@@ -1,32 +1,6 @@
+import importlib
 import os
-
-if os.environ.get("TASKS_STATE_MACHINE_ARN"):
-    from .kvstore_aws_step_functions import (
-        begin_state_machine,
-        begin_task,
-        begin_workflow,
-        end_task,
-        end_workflow,
-        get_next_task,
-        progress,
-        patch_state,
-        get_execution_status,
-        get_task,
-    )
-else:
-    from .kvstore_local import (
-        begin_state_machine,
-        begin_task,
-        begin_workflow,
-        end_task,
-        end_workflow,
-        get_next_task,
-        progress,
-        patch_state,
-        get_execution_status,
-        get_task,
-    )
-
+from typing import TYPE_CHECKING
 
 __all__ = (
     "begin_workflow",
@@ -37,6 +11,49 @@ __all__ = (
     "end_workflow",
     "begin_state_machine",
     "patch_state",
+    "durations_key",
+    "patch_durations",
     "get_execution_status",
     "get_task",
+    "index_statuses",
+    "list_workflows",
+    "task_ranges",
+    "QueueFull",
+    "transaction",
 )
+
+if TYPE_CHECKING:
+    from .kvstore_local import (
+        begin_state_machine,
+        begin_task,
+        begin_workflow,
+        end_task,
+        end_workflow,
+        get_execution_status,
+        get_next_task,
+        get_task,
+        index_statuses,
+        list_workflows,
+        patch_state,
+        durations_key,
+        patch_durations,
+        progress,
+        task_ranges,
+        QueueFull,
+        transaction,
+    )
+
+
+# The implementation is only imported the first time one of its functions is
+# used, so that importing the app for a request that never touches tasks
+# doesn't pay for it in a Lambda cold start.
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if os.environ.get("TASKS_STATE_MACHINE_ARN"):
+        module = importlib.import_module(".kvstore_aws_step_functions", __name__)
+    else:
+        module = importlib.import_module(".kvstore_local", __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
@@ -1,7 +1,9 @@
 import json
 import os
+from threading import Lock
+from typing import Any
 
-import boto3
+import kvstore.driver
 
 from .kvstore_local import (
     begin_task,
@@ -12,7 +14,14 @@ from .kvstore_local import (
     progress,
     patch_state,
     _patch_state,
+    durations_key,
+    patch_durations,
     get_task,
+    index_statuses,
+    list_workflows,
+    task_ranges,
+    QueueFull,
+    transaction,
 )
 
 __all__ = [
@@ -23,25 +32,59 @@ __all__ = [
     "end_task",
     "end_workflow",
     "patch_state",
+    "durations_key",
+    "patch_durations",
     "begin_state_machine",
     "get_execution_status",
     "get_task",
+    "index_statuses",
+    "list_workflows",
+    "task_ranges",
+    "QueueFull",
+    "transaction",
 ]
 
-stepfunctions = boto3.client(
-    service_name="stepfunctions", region_name=os.environ["AWS_REGION"]
-)
+# Created on first use, so that boto3 is only imported by the requests that
+# need it
+stepfunctions: Any = None
+_lock = Lock()
 store = "tasks"
 
 
+def _client():
+    global stepfunctions
+    if stepfunctions is None:
+        with _lock:
+            if stepfunctions is None:
+                import boto3
+
+                stepfunctions = boto3.client(
+                    service_name="stepfunctions", region_name=os.environ["AWS_REGION"]
+                )
+    return stepfunctions
+
+
 def begin_state_machine(workflow_id):
-    response = stepfunctions.start_execution(
+    # The state machine's Map state runs each range in its own Lambda
+    # invocations, in parallel
+    state, ttl = kvstore.driver.get(
+        store, workflow_id, attributes=["num_tasks", "concurrency"], consistent=True
+    )
+    ranges = [
+        {"workflow_id": workflow_id, "first": first, "last": last}
+        for first, last in task_ranges(
+            int(state["num_tasks"]), int(state.get("concurrency", 1))
+        )
+    ]
+    response = _client().start_execution(
         stateMachineArn=os.environ["TASKS_STATE_MACHINE_ARN"],
-        input=json.dumps({"store": store, "workflow_id": workflow_id}),
+        input=json.dumps(
+            {"store": store, "workflow_id": workflow_id, "ranges": ranges}
+        ),
     )
     _patch_state(workflow_id, {"execution": response["executionArn"]})
     return response["executionArn"]
 
 
 def get_execution_status(executionArn):
-    return stepfunctions.describe_execution(executionArn=executionArn)["status"]
+    return _client().describe_execution(executionArn=executionArn)["status"]
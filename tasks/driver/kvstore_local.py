@@ -1,11 +1,47 @@
+import contextlib
 import datetime
+import itertools
+import os
 
 store = "tasks"
+# The statuses workflows are indexed under. ALL holds every workflow by when
+# it began, RUNNING the ones that haven't ended yet, and SUCCEEDED and FAILED
+# the ended ones by when they ended.
+index_statuses = ("ALL", "RUNNING", "SUCCEEDED", "FAILED")
+# Reverses the order ISO times sort in, so that the newest comes first
+_newest_first = str.maketrans("0123456789", "9876543210")
+# The tasks Lambda keeps each range's recent task durations in the workflow
+# state under keys starting with this, which are reserved and left out of
+# progress()
+_durations_prefix = "task_ms_"
 
 import kvstore.driver
 
 
-def begin_workflow(uid, num_tasks, handler, state=None, ttl: None | int = None):
+def _index_pk(status, at):
+    # One bucket per status per day, so that no query has to read more than
+    # the days it covers
+    return f"index/{status}/{at:%Y-%m-%d}"
+
+
+def _index_sk(at, workflow_id):
+    return (
+        "/"
+        + at.strftime("%Y-%m-%dT%H:%M:%S.%f").translate(_newest_first)
+        + "/"
+        + workflow_id
+    )
+
+
+def begin_workflow(
+    uid, num_tasks, handler, state=None, ttl: None | int = None, concurrency=1
+):
+    """
+    Store a new workflow of num_tasks tasks, returning its id. With a
+    concurrency above 1 the tasks are split into that many ranges (see
+    task_ranges()) which are run in parallel.
+    """
+    assert int(concurrency) >= 1, concurrency
     begin = datetime.datetime.now()
     begin_isoformat = begin.isoformat()
     pk = f"{begin_isoformat}/{uid}"
@@ -19,47 +55,190 @@ def begin_workflow(uid, num_tasks, handler, state=None, ttl: None | int = None):
     assert "end_uid" not in state
     assert "status" not in state
     assert "execution" not in state
+    assert "concurrency" not in state
+    assert "completed" not in state
+    assert not [k for k in state if k.startswith(_durations_prefix)]
     data = {
         "num_tasks": int(num_tasks),
         "handler": str(handler),
         "begin": begin_isoformat,
         "begin_uid": str(uid),
     }
+    if int(concurrency) > 1:
+        data["concurrency"] = int(concurrency)
     data.update(state)
-    kvstore.driver.put(store, pk, data, ttl=ttl)
+    index_data = {
+        "workflow_id": pk,
+        "at": begin_isoformat,
+        "num_tasks": int(num_tasks),
+    }
+    index_items = [
+        (_index_pk(status, begin), _index_sk(begin, pk), index_data, ttl)
+        for status in ["ALL", "RUNNING"]
+    ]
+    # So that the workflow is never missing from the RUNNING index
+    with _writes(
+        kvstore.driver.transactable(store, [pk] + [i[0] for i in index_items])
+    ):
+        kvstore.driver.put(store, pk, data, ttl=ttl)
+        kvstore.driver.put_many(store, index_items)
     return pk
 
 
-def get_next_task(workflow_id):
+def _writes(atomic):
+    # One transaction where the driver can make the writes in one, which
+    # sharded SQLite can't when the index items are in a different database
+    # from the workflow
+    if atomic:
+        return kvstore.driver.transaction()
+    return contextlib.nullcontext()
+
+
+def task_ranges(num_tasks, concurrency=1):
+    """
+    Split tasks 1 to num_tasks into at most concurrency contiguous (first,
+    last) ranges of nearly equal size. The tasks in a range are run in order,
+    so the latest task begun in each range is enough to know how far it has
+    got, however the ranges finish relative to each other.
+    """
+    count = max(1, min(int(concurrency), int(num_tasks)))
+    size, extra = divmod(int(num_tasks), count)
+    ranges = []
+    first = 1
+    for k in range(count):
+        last = first + size - 1 + (1 if k < extra else 0)
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+
+def _task_sk(num_tasks, i):
+    # Tasks sort newest first, so the latest task begun in a range is the
+    # first item from the sk of the range's last task onwards
+    pad_length = len(str(num_tasks))
+    return f"/task/{str(num_tasks-i).zfill(pad_length)}/{str(i).zfill(pad_length)}"
+
+
+def _latest_task(workflow_id, num_tasks, first, last, consistent=False):
+    for sk, task_state, ttl in itertools.islice(
+        kvstore.driver.scan_pk(
+            store,
+            workflow_id,
+            sk_start=_task_sk(num_tasks, last),
+            page_size=1,
+            consistent=consistent,
+        ),
+        1,
+    ):
+        assert sk.startswith("/task/"), sk
+        number = int(sk.split("/")[-1])
+        if number >= first:
+            return number, task_state
+    return None, None
+
+
+def _completed(first, number, task_state):
+    # Every task in a range before its latest one has ended
+    if number is None:
+        return 0
+    return number - first + (1 if task_state.get("end") else 0)
+
+
+def get_next_task(workflow_id, first=1, last=None, next_task=None, num_tasks=None):
+    """
+    Return (next_task, state, task_state) for the range of tasks from first
+    to last (by default the whole workflow), where task_state is that of the
+    latest task begun in the range, or None if none has been.
+
+    A next_task already known to the caller (e.g. passed on by the previous
+    Lambda invocation, along with the workflow's num_tasks) is checked in the
+    same call that reads the state rather than searched for. If it has begun
+    since, the range is searched as usual.
+    """
+    if next_task is not None:
+        assert num_tasks is not None
+        header = (workflow_id, "/")
+        found, missing = kvstore.driver.get_many(
+            store,
+            [header, (workflow_id, _task_sk(int(num_tasks), int(next_task)))],
+            consistent=True,
+        )
+        if header not in found:
+            raise Exception(f'No such workflow "{workflow_id}"')
+        if len(found) == 1:
+            state = found[header][0].copy()
+            state["num_tasks"] = int(state["num_tasks"])
+            return int(next_task), state, None
     results, maybe_more_sk = list(
         kvstore.driver.iterate(store, workflow_id, limit=2, consistent=True)
     )
     if len(results) == 0:
         raise Exception(f'No such workflow "{workflow_id}"')
-    elif len(results) == 1:
-        # No tasks yet
-        next_task = 1
-        task_state = None
-    else:
-        sk, task_state, ttl = results[1]
-        assert sk.startswith("/task/"), sk
-        end = task_state.get("end")
-        if end:
-            next_task = int(sk.split("/")[-1]) + 1
-        else:
-            next_task = int(sk.split("/")[-1])
     state = results[0][1].copy()
     state["num_tasks"] = int(state["num_tasks"])
+    if last is None or int(last) == state["num_tasks"]:
+        number, task_state = None, None
+        if len(results) > 1:
+            sk, task_state, ttl = results[1]
+            assert sk.startswith("/task/"), sk
+            number = int(sk.split("/")[-1])
+            if number < first:
+                number, task_state = None, None
+    else:
+        number, task_state = _latest_task(
+            workflow_id, state["num_tasks"], first, int(last), consistent=True
+        )
+    if number is None or task_state is None:
+        # No tasks yet
+        next_task = first
+    elif task_state.get("end"):
+        next_task = number + 1
+    else:
+        next_task = number
     return int(next_task), state, task_state
 
 
 def progress(workflow_id, limit=40):
-    results, maybe_more_sk = list(
-        kvstore.driver.iterate(store, workflow_id, limit=limit)
+    # Unlike iterate(), scan_pk() carries on past the iterate() size limit to
+    # really return limit items
+    results = list(
+        itertools.islice(
+            kvstore.driver.scan_pk(store, workflow_id, page_size=limit), limit
+        )
     )
+    if not results:
+        raise kvstore.driver.NotFound(f'No such workflow "{workflow_id}"')
     header = results[0][1]
     header["num_tasks"] = int(header["num_tasks"])
     del header["handler"]
+    for k in [k for k in header if k.startswith(_durations_prefix)]:
+        del header[k]
+    # How many tasks have ended, counted per range since ranges finish out of
+    # order
+    ranges = task_ranges(header["num_tasks"], header.get("concurrency", 1))
+    # The results hold every task from the lowest numbered one in them up, so
+    # only a range that could have tasks below them needs its own scan
+    scanned = {
+        int(sk.split("/")[-1]): task_state for sk, task_state, ttl in results[1:]
+    }
+    if len(results) < limit:
+        # Every task has been read
+        lowest = 1
+    elif scanned:
+        lowest = min(scanned)
+    else:
+        lowest = header["num_tasks"] + 1
+    completed = 0
+    for first, last in ranges:
+        in_range = [number for number in scanned if first <= number <= last]
+        if in_range:
+            number = max(in_range)
+            completed += _completed(first, number, scanned[number])
+        elif first < lowest:
+            completed += _completed(
+                first, *_latest_task(workflow_id, header["num_tasks"], first, last)
+            )
+    header["completed"] = completed
     task_list = []
     task_number = 0
     remaining = header["num_tasks"]
@@ -94,8 +273,7 @@ def begin_task(
         datetime.datetime.now()
     # Help the type checker
     assert begun_at
-    pad_length = len(str(num_tasks))
-    sk = f"/task/{str(num_tasks-i).zfill(pad_length)}/{str(i).zfill(pad_length)}"
+    sk = _task_sk(num_tasks, i)
     data = {
         "begin": begun_at.isoformat(),
         "begin_uid": uid,
@@ -123,8 +301,7 @@ def begin_task(
 
 
 def get_task(workflow_id, num_tasks, i):
-    sk = f"/task/{str(num_tasks-i).zfill(len(str(num_tasks)))}/{str(i).zfill(len(str(num_tasks)))}"
-    return kvstore.driver.get(store, pk=workflow_id, sk=sk)
+    return kvstore.driver.get(store, pk=workflow_id, sk=_task_sk(num_tasks, i))
 
 
 def end_task(
@@ -137,6 +314,7 @@ def end_task(
     | None = None,
     ended_at: datetime.datetime | None = None,
     ttl="notchanged",
+    condition=None,
 ):
     if ended_at is None:
         ended_at = datetime.datetime.now()
@@ -159,20 +337,105 @@ def end_task(
         data[
             "correctly_escaped_html_status_message"
         ] = correctly_escaped_html_status_message
-    pad_length = len(str(num_tasks))
-    sk = f"/task/{str(num_tasks-i).zfill(pad_length)}/{str(i).zfill(pad_length)}"
-    kvstore.driver.patch(store, workflow_id, sk=sk, data=data, ttl=ttl)
+    kvstore.driver.patch(
+        store,
+        workflow_id,
+        sk=_task_sk(num_tasks, i),
+        data=data,
+        ttl=ttl,
+        condition=condition,
+    )
+
+
+def transaction():
+    """
+    Make the writes in the body, e.g. end_task() for one task and
+    begin_task() for the next, together in one store transaction.
+    """
+    return kvstore.driver.transaction()
 
 
 def end_workflow(uid, workflow_id, status="SUCCEEDED"):
+    """
+    Record that the workflow has ended with status, moving it from the
+    RUNNING index to the index for status. Ending a workflow that has already
+    ended leaves it as it was.
+    """
     assert status in ["SUCCEEDED", "FAILED"]
     now = datetime.datetime.now()
-    kvstore.driver.patch(
-        store,
-        workflow_id,
-        sk="/",
-        data={"end": now.isoformat(), "end_uid": uid, "status": status},
+    begin = datetime.datetime.fromisoformat(workflow_id.split("/", 1)[0])
+    state, ttl = kvstore.driver.get(
+        store, workflow_id, attributes=["num_tasks"], consistent=True
     )
+    index_pk = _index_pk(status, now)
+    index_sk = _index_sk(now, workflow_id)
+    running_pk = _index_pk("RUNNING", begin)
+    running_sk = _index_sk(begin, workflow_id)
+    atomic = kvstore.driver.transactable(store, [workflow_id, index_pk, running_pk])
+    # Without a transaction the writes are made in an order that means a crash
+    # part way through can only leave a workflow listed twice, which
+    # list_workflows() allows for
+    try:
+        with _writes(atomic):
+            kvstore.driver.put(
+                store,
+                index_pk,
+                sk=index_sk,
+                data={
+                    "workflow_id": workflow_id,
+                    "at": now.isoformat(),
+                    "num_tasks": state["num_tasks"],
+                    "status": status,
+                },
+                ttl=ttl,
+            )
+            kvstore.driver.patch(
+                store,
+                workflow_id,
+                sk="/",
+                data={"end": now.isoformat(), "end_uid": uid, "status": status},
+                condition={"end": kvstore.driver.NotExists},
+            )
+            kvstore.driver.delete(store, running_pk, sk=running_sk)
+    except kvstore.driver.ConditionFailed:
+        # Already ended, e.g. by another range or a retried invocation
+        if not atomic:
+            kvstore.driver.delete(store, index_pk, sk=index_sk)
+        kvstore.driver.delete(store, running_pk, sk=running_sk)
+
+
+def list_workflows(status="ALL", since=None, limit=20):
+    """
+    Return up to limit of the workflows indexed under status (see
+    index_statuses) since the datetime since, newest first, as dicts with
+    the workflow_id, the time it was indexed at and its num_tasks. Each day
+    from now back to since (by default TASKS_INDEX_DAYS ago, default 7) is
+    one range query, and no more are made once there are limit results.
+    """
+    assert status in index_statuses, status
+    assert limit > 0, limit
+    now = datetime.datetime.now()
+    if since is None:
+        since = now - datetime.timedelta(
+            days=float(os.environ.get("TASKS_INDEX_DAYS", "7"))
+        )
+    results: list[dict] = []
+    seen = set()
+    day = now
+    while day.date() >= since.date() and len(results) < limit:
+        for sk, data, ttl in kvstore.driver.scan_pk(
+            store, _index_pk(status, day), page_size=limit
+        ):
+            if datetime.datetime.fromisoformat(data["at"]) < since:
+                break
+            if data["workflow_id"] in seen:
+                continue
+            seen.add(data["workflow_id"])
+            results.append(data)
+            if len(results) >= limit:
+                break
+        day -= datetime.timedelta(days=1)
+    return results
 
 
 def _patch_state(
@@ -186,6 +449,8 @@ def _patch_state(
     assert "end_uid" not in data
     assert "handler" not in data
     assert "status" not in data
+    assert "concurrency" not in data
+    assert "completed" not in data
     kvstore.driver.patch(
         store,
         workflow_id,
@@ -198,20 +463,40 @@ def patch_state(
     workflow_id, data: dict[str, str | int | float | kvstore.driver.Remove]
 ):
     assert "execution" not in data
+    assert not [k for k in data if k.startswith(_durations_prefix)]
     return _patch_state(workflow_id=workflow_id, data=data)
 
 
-import subprocess
-import sys
+def durations_key(first):
+    """
+    Return the workflow state key that the durations of the range of tasks
+    starting at first are kept under.
+    """
+    return f"{_durations_prefix}{int(first)}"
+
+
+def patch_durations(workflow_id, first, durations: str):
+    """
+    Save the encoded durations (see Durations in tasks/adapter/shared.py) of
+    the range of tasks starting at first.
+    """
+    return _patch_state(workflow_id, {durations_key(first): durations})
+
+
+class QueueFull(Exception):
+    """Raised by begin_state_machine() when too many workflows are waiting."""
 
 
 def begin_state_machine(workflow_id):
-    process = subprocess.Popen(
-        [sys.executable, "tasks/adapter/process.py", workflow_id]
-    )
-    _patch_state(workflow_id, {"execution": str(process.pid)})
-    return str(process.pid)
+    # Run by the local worker pool, see tasks/adapter/worker.py
+    from tasks.adapter import worker
+
+    worker.enqueue(workflow_id)
+    _patch_state(workflow_id, {"execution": workflow_id})
+    return workflow_id
+
 
+def get_execution_status(workflow_id):
+    from tasks.adapter import worker
 
-def get_execution_status(pid):
-    return "UNKNOWN"
+    return worker.status(workflow_id) or "UNKNOWN"
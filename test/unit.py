@@ -1,3 +1,4 @@
+import contextlib
 import os
 
 # Disable any environment variables to make sure we don't accidentally make AWS calls in testing
@@ -9,6 +10,8 @@ for k in os.environ:
         "TASKS_STATE_MACHINE_ARN",
     ):
         del os.environ[k]
+# Keep anything the tests do store in memory
+os.environ["KVSTORE_DRIVER"] = "memory"
 
 
 def test_template_render_home():
@@ -135,6 +138,999 @@ def test_types():
     assert s["workflow_id"]
 
 
+def test_kvstore_codec():
+    from kvstore.driver import codec
+
+    data = {
+        "int": 12,
+        "big": 2**70,
+        "float": 1700334761.123456,
+        "whole": 3.0,
+        "str": "h\u00e9llo \U0001f600",
+        "empty": "",
+    }
+    for name in codec.encoders:
+        value = codec.encoders[name](data)
+        assert codec.encoded_with(value) == name, (name, value)
+        decoded = codec.decode(value)
+        assert decoded == data, (name, decoded)
+        assert [type(v) for v in decoded.values()] == [type(v) for v in data.values()]
+
+
+@contextlib.contextmanager
+def sqlite_driver(store_dir, **environ):
+    """
+    Yield kvstore.driver.sqlite keeping its files in store_dir, with the
+    environment variables given set (and the sweeper off unless they say
+    otherwise), then close its databases and remove them again. The paths are
+    set here too since the module only reads STORE_DIR when first imported.
+    """
+    environ = {"STORE_DIR": store_dir, "KVSTORE_SQLITE_SWEEP_INTERVAL": "0", **environ}
+    os.environ.update(environ)
+    try:
+        from kvstore.driver import sqlite
+
+        sqlite.cleanup()
+        sqlite.config_driver_key_value_store_dir = store_dir
+        sqlite.config_driver_key_value_store_db_path = os.path.join(
+            store_dir, "sqlite.db"
+        )
+        try:
+            yield sqlite
+        finally:
+            sqlite.cleanup()
+    finally:
+        for k in environ:
+            del os.environ[k]
+
+
+def test_kvstore_sqlite_shards():
+    import tempfile
+
+    pks = [f"pk{i}" for i in range(20)]
+    items = [(pk, f"/{j:03d}", {"j": j}, None) for pk in pks for j in range(25)]
+    with tempfile.TemporaryDirectory() as store_dir:
+        with sqlite_driver(store_dir, KVSTORE_SQLITE_SHARDS="4") as sqlite:
+
+            def shard_numbers():
+                shards = sqlite._all_shards()
+                return {pk: shards.index(sqlite._shard("test", pk)) for pk in pks}
+
+            shards = shard_numbers()
+            assert shard_numbers() == shards
+            assert set(shards.values()) == {0, 1, 2, 3}, shards
+            sqlite.put_many("test", items)
+            # The same after the files are closed and opened again
+            sqlite.cleanup()
+            assert shard_numbers() == shards
+            # Each pk is only in its own shard's file
+            for i, shard in enumerate(sqlite._all_shards()):
+                with sqlite._reading(shard) as cur:
+                    cur.execute("select distinct pk from store")
+                    assert sorted(pk for (pk,) in cur.fetchall()) == sorted(
+                        pk for pk in pks if shards[pk] == i
+                    ), i
+            for pk in pks:
+                expected = [(f"/{j:03d}", {"j": j}, None) for j in range(25)]
+                results, next_ = sqlite.iterate("test", pk)
+                assert (results, next_) == (expected, None), pk
+                results, next_ = sqlite.iterate("test", pk, "/010", limit=5)
+                assert results == expected[10:15], results
+                scanned = list(sqlite.scan_pk("test", pk, "/005", page_size=7))
+                assert scanned == expected[5:], scanned
+            found, missing = sqlite.get_many(
+                "test", [(pk, "/003") for pk in pks] + [("pk0", "/999")]
+            )
+            assert sorted(found) == sorted((pk, "/003") for pk in pks), found
+            assert missing == [("pk0", "/999")], missing
+            sqlite.delete_many("test", [(pk, sk) for pk, sk, data, ttl in items])
+            assert all(list(sqlite.scan_pk("test", pk)) == [] for pk in pks)
+
+
+def test_kvstore_sqlite_group_commit():
+    import sqlite3
+    import tempfile
+    import threading
+    import time
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        with sqlite_driver(store_dir, KVSTORE_SQLITE_GROUP_COMMIT_MS="200") as sqlite:
+            shard = sqlite._all_shards()[0]
+            # The writer that fails is first the leader, then a follower
+            for failing in [0, 2]:
+                pk = f"batch{failing}"
+                batches = {}
+                errors = {}
+
+                def write(i):
+                    try:
+                        with sqlite._write_transaction(shard) as cur:
+                            batches[i] = shard.batch
+                            cur.execute(
+                                sqlite._put_sql,
+                                sqlite._put_values("test", pk, {"i": i}, f"/{i}", None),
+                            )
+                            if i == failing:
+                                raise ValueError(i)
+                    except Exception as e:
+                        errors[i] = e
+
+                threads = [threading.Thread(target=write, args=(i,)) for i in range(5)]
+                threads[0].start()
+                # The others join the batch the first opened
+                while shard.batch is None:
+                    time.sleep(0.001)
+                for thread in threads[1:]:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                assert len(set(map(id, batches.values()))) == 1, batches
+                assert list(errors) == [failing], errors
+                assert isinstance(errors[failing], ValueError), errors
+                # Only the failed write was rolled back, and the rest were
+                # committed, as another connection sees
+                conn = sqlite3.connect(shard.path)
+                rows = conn.execute(
+                    "select sk from store where store = 'test' AND pk = ? ORDER BY sk",
+                    (pk,),
+                ).fetchall()
+                conn.close()
+                assert rows == [(f"/{i}",) for i in range(5) if i != failing], rows
+
+
+def test_kvstore_sqlite_sweep():
+    import tempfile
+    import time
+
+    def rows(sqlite):
+        # Including expired rows, which reads leave out
+        with sqlite._reading(sqlite._all_shards()[0]) as cur:
+            cur.execute("select sk from store where store = 'test' ORDER BY sk")
+            return [sk for (sk,) in cur.fetchall()]
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        with sqlite_driver(store_dir) as sqlite:
+            now = time.time()
+            sqlite.put_many(
+                "test",
+                [("pk", f"/expired{i}", {}, now - 1) for i in range(5)]
+                + [("pk", "/live", {}, now + 60), ("pk", "/forever", {}, None)],
+            )
+            # KVSTORE_SQLITE_SWEEP_INTERVAL=0 stops init() starting the thread
+            assert sqlite._sweeper is None
+            reclaimed = sqlite.sweep_stats["reclaimed"]
+            assert sqlite.sweep(max_rows=2) == 2
+            assert sqlite.sweep_stats["last_reclaimed"] == 2, sqlite.sweep_stats
+            assert sqlite.sweep() == 3
+            assert sqlite.sweep() == 0
+            assert rows(sqlite) == ["/forever", "/live"], rows(sqlite)
+            assert sqlite.sweep_stats["reclaimed"] == reclaimed + 5, sqlite.sweep_stats
+
+        # Otherwise init() starts it, and cleanup() stops it
+        with sqlite_driver(store_dir, KVSTORE_SQLITE_SWEEP_INTERVAL="0.01") as sqlite:
+            sqlite.put("test", "pk", {}, sk="/expired", ttl=time.time() - 1)
+            sweeper = sqlite._sweeper
+            assert sweeper is not None and sweeper.is_alive()
+            for i in range(200):
+                if rows(sqlite) == ["/forever", "/live"]:
+                    break
+                time.sleep(0.01)
+            assert rows(sqlite) == ["/forever", "/live"], rows(sqlite)
+            sqlite.stop_sweeper()
+            assert sqlite._sweeper is None and not sweeper.is_alive()
+
+
+def test_kvstore_sqlite_migrate():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        with sqlite_driver(store_dir, KVSTORE_SQLITE_CODEC="json") as sqlite:
+            sqlite.put_many(
+                "test",
+                [("pk", f"/{i:03d}", {"i": i, "f": i / 3}, None) for i in range(7)],
+            )
+            os.environ["KVSTORE_SQLITE_CODEC"] = "marshal"
+            sqlite.put("test", "pk", {"i": 7, "f": 7 / 3}, sk="/007")
+            assert sqlite.migrate(batch_size=3) == 7
+            assert sqlite.migrate() == 0
+            assert sqlite.migrate(to="json", batch_size=3) == 8
+            results, _ = sqlite.iterate("test", "pk")
+            assert results == [
+                (f"/{i:03d}", {"i": i, "f": i / 3}, None) for i in range(8)
+            ], results
+
+
+def test_kvstore_cache():
+    import itertools
+    import time
+
+    from kvstore.driver import cache, memory
+
+    calls = []
+
+    def counting(function):
+        def wrapper(store, pk, *args, **kwargs):
+            calls.append((function.__name__, pk, kwargs.get("sk_start")))
+            return function(store, pk, *args, **kwargs)
+
+        return wrapper
+
+    get = cache.cached_get(counting(memory.get))
+    iterate = cache.cached_iterate(counting(memory.iterate))
+    scan_pk = cache.cached_scan_pk(counting(memory.scan_pk))
+    put = cache.invalidating_put(memory.put)
+    patch = cache.invalidating_patch(memory.patch)
+    delete = cache.invalidating_delete(memory.delete)
+    put_many = cache.invalidating_put_many(memory.put_many)
+    delete_many = cache.invalidating_delete_many(memory.delete_many)
+    transaction = cache.invalidating_transaction(contextlib.nullcontext)
+
+    def reads(function, *args, **kwargs):
+        # How many times the driver was read from
+        before = len(calls)
+        function(*args, **kwargs)
+        return len(calls) - before
+
+    os.environ["KVSTORE_CACHE_SIZE"] = "3"
+    os.environ["KVSTORE_CACHE_TTL"] = "60"
+    os.environ["KVSTORE_CACHE_TTLS"] = "nocache:0"
+    try:
+        cache.clear()
+        stats = dict(cache.stats)
+        put("cache", "a", {"n": 1})
+        assert reads(get, "cache", "a") == 1
+        assert get("cache", "a") == ({"n": 1}, None)
+        assert reads(get, "cache", "a") == 0
+        assert cache.stats["misses"] == stats["misses"] + 1, cache.stats
+        assert cache.stats["hits"] == stats["hits"] + 2, cache.stats
+        # Hits are copies, so changing one doesn't change what is cached
+        iterate("cache", "a")
+        list(scan_pk("cache", "a"))
+        get("cache", "a")[0]["n"] = 99
+        iterate("cache", "a")[0][0][1]["n"] = 99
+        for sk, data, ttl in scan_pk("cache", "a"):
+            data["n"] = 99
+        assert get("cache", "a") == ({"n": 1}, None)
+        assert iterate("cache", "a") == ([("/", {"n": 1}, None)], None)
+        assert list(scan_pk("cache", "a")) == [("/", {"n": 1}, None)]
+        # Bypassed with consistent=True, or a TTL of 0 for the store
+        assert reads(get, "cache", "a", consistent=True) == 1
+        put("nocache", "a", {"n": 1})
+        assert reads(get, "nocache", "a") == reads(get, "nocache", "a") == 1
+
+        # Each kind of write invalidates the pk
+        for write, n in [
+            (lambda: put("cache", "a", {"n": 2}), 2),
+            (lambda: patch("cache", "a", {"n": 3}), 3),
+            (lambda: put_many("cache", [("a", "/", {"n": 4}, None)]), 4),
+        ]:
+            iterate("cache", "a")
+            assert reads(get, "cache", "a") == reads(iterate, "cache", "a") == 0
+            write()
+            assert get("cache", "a") == ({"n": n}, None)
+            assert iterate("cache", "a") == ([("/", {"n": n}, None)], None)
+        for write in [
+            lambda: delete("cache", "a"),
+            lambda: delete_many("cache", [("a", "/")]),
+        ]:
+            put("cache", "a", {"n": 5})
+            assert reads(get, "cache", "a") == 1
+            write()
+            try:
+                get("cache", "a")
+            except memory.NotFound:
+                pass
+            else:
+                raise Exception("Expected NotFound")
+
+        # The item's ttl caps how long it is cached for
+        ttl = time.time() + 0.05
+        put("cache", "b", {"n": 1}, ttl=ttl)
+        get("cache", "b")
+        assert cache._entries[("get", "cache", "b", "/", None)][0] == ttl
+        assert reads(get, "cache", "b") == 0
+        time.sleep(0.06)
+        try:
+            get("cache", "b")
+        except memory.NotFound:
+            pass
+        else:
+            raise Exception("Expected NotFound")
+
+        # The least recently used entry is evicted
+        cache.clear()
+        evictions = cache.stats["evictions"]
+        for pk in "cde":
+            put("cache", pk, {})
+            get("cache", pk)
+        get("cache", "c")
+        put("cache", "f", {})
+        get("cache", "f")
+        assert cache.stats["evictions"] == evictions + 1, cache.stats
+        assert reads(get, "cache", "c") == 0
+        assert reads(get, "cache", "d") == 1
+
+        # A scan that stopped part way resumes from the driver after the
+        # items it had cached
+        cache.clear()
+        put_many("cache", [("g", f"/{i}", {}, None) for i in range(5)])
+        scan = scan_pk("cache", "g", page_size=2)
+        assert [sk for sk, data, ttl in itertools.islice(scan, 2)] == ["/0", "/1"]
+        scan.close()
+        del calls[:]
+        assert [sk for sk, data, ttl in scan_pk("cache", "g")] == [
+            f"/{i}" for i in range(5)
+        ]
+        assert calls == [("scan_pk", "g", "/1")], calls
+        assert reads(lambda: list(scan_pk("cache", "g"))) == 0
+
+        # Writes in a transaction are invalidated again when it finishes, and
+        # an inner transaction doesn't lose the outer one's
+        put("cache", "h", {"n": 1})
+        with transaction():
+            with transaction():
+                pass
+            put("cache", "h", {"n": 2})
+            get("cache", "h")
+        assert reads(get, "cache", "h") == 1
+    finally:
+        cache.clear()
+        for k in ("KVSTORE_CACHE_SIZE", "KVSTORE_CACHE_TTL", "KVSTORE_CACHE_TTLS"):
+            del os.environ[k]
+
+
+def test_kvstore_aio_sign():
+    from kvstore.driver.aio_dynamodb import sign
+
+    # The example from https://docs.aws.amazon.com/IAM/latest/UserGuide/create-signed-request.html
+    authorization = sign(
+        "GET",
+        "/",
+        "Action=ListUsers&Version=2010-05-08",
+        {
+            "content-type": "application/x-www-form-urlencoded; charset=utf-8",
+            "host": "iam.amazonaws.com",
+            "x-amz-date": "20150830T123600Z",
+        },
+        b"",
+        "us-east-1",
+        "iam",
+        "AKIDEXAMPLE",
+        "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY",
+        "20150830T123600Z",
+    )
+    assert authorization == (
+        "AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/20150830/us-east-1/iam/aws4_request, "
+        "SignedHeaders=content-type;host;x-amz-date, "
+        "Signature=5d672d79c15b13162d9279b0855cfba6789a8edb4c82c400e06b5924a6f2b5d7"
+    ), authorization
+
+
+def test_kvstore_dynamodb_codec():
+    from kvstore.driver import dynamodb_codec
+
+    data = {"name": "a/b", "count": 3, "ratio": 0.25, "big": 10**20, "small": 1e-07}
+    encoded = dynamodb_codec.encode(data)
+    assert encoded["count"] == {"N": "3"}, encoded
+    item = {"pk": {"S": "store/p/k"}, "sk": {"S": "/1"}, "ttl": {"N": "100"}}
+    item.update(encoded)
+    pk, sk, decoded, ttl = dynamodb_codec.decode(item)
+    assert (pk, sk, ttl) == ("p/k", "/1", 100.0), (pk, sk, ttl)
+    assert decoded == data, decoded
+    assert [type(decoded[k]) for k in data] == [str, int, float, int, float]
+    # The response is left as it was
+    assert "pk" in item and "ttl" in item
+    del item["ttl"]
+    assert dynamodb_codec.decode_page([item]) == [("/1", data, None)]
+    try:
+        dynamodb_codec.encode({"nested": {}})
+    except Exception as e:
+        assert "is not a string or number" in str(e), e
+    else:
+        raise Exception("Expected an exception")
+
+
+def test_kvstore_dynamodb_stats():
+    import kvstore.driver.dynamodb as dynamodb
+
+    os.environ["KVSTORE_DYNAMODB_RETRY_MODE"] = "standard"
+    try:
+        config = dynamodb.config()
+        assert config["retries"] == {"mode": "standard", "total_max_attempts": 10}
+        assert config["tcp_keepalive"] is True, config
+    finally:
+        del os.environ["KVSTORE_DYNAMODB_RETRY_MODE"]
+
+    class Client:
+        def get_item(self, **kwargs):
+            # As botocore would report a call that was throttled twice
+            dynamodb._count_throttle(
+                response=(None, {"Error": {"Code": "ThrottlingException"}})
+            )
+            dynamodb._count_throttle(
+                response=(None, {"Error": {"Code": "ThrottlingException"}})
+            )
+            return {"ResponseMetadata": {"RetryAttempts": 2}}
+
+    def steps():
+        return (yield ("get_item", {}))
+
+    previous = dynamodb.dynamodb
+    dynamodb.dynamodb = Client()
+    try:
+        dynamodb.stats(reset=True)
+        dynamodb._run(steps())
+        dynamodb._run(steps())
+    finally:
+        dynamodb.dynamodb = previous
+    assert dynamodb.last_call() == {
+        "operation": "get_item",
+        "retries": 2,
+        "throttles": 2,
+    }, dynamodb.last_call()
+    assert dynamodb.stats() == {
+        "get_item": {"calls": 2, "retries": 4, "throttles": 4}
+    }, dynamodb.stats()
+
+
+def test_tasks_parallel():
+    import random
+    import time
+    from unittest.mock import patch
+
+    import tasks.driver
+    from tasks.adapter import process
+
+    assert tasks.driver.task_ranges(10, 4) == [(1, 3), (4, 6), (7, 8), (9, 10)]
+    assert tasks.driver.task_ranges(2, 4) == [(1, 1), (2, 2)]
+    assert tasks.driver.task_ranges(5) == [(1, 5)]
+
+    workflow_id = tasks.driver.begin_workflow(
+        uid="test", num_tasks=10, handler="app.tasks:count", concurrency=4
+    )
+    # A range can run on its own, leaving the others untouched
+    with patch("app.tasks.wait"):
+        process.run_range("test", workflow_id, 4, 6)
+    assert tasks.driver.get_next_task(workflow_id, 4, 6)[0] == 7
+    assert tasks.driver.get_next_task(workflow_id, 1, 3)[0] == 1
+    assert tasks.driver.get_next_task(workflow_id, 7, 8)[0] == 7
+    header, task_list, task_number = tasks.driver.progress(workflow_id)
+    assert header["completed"] == 3, header
+    # The same however many tasks progress() reads before scanning ranges
+    for limit in [1, 2, 4]:
+        header = tasks.driver.progress(workflow_id, limit=limit)[0]
+        assert header["completed"] == 3, (limit, header)
+
+    # The rest finish in a random order
+    with patch("app.tasks.wait") as wait:
+        wait.side_effect = lambda: time.sleep(random.random() / 100)
+        process.run(workflow_id)
+    header, task_list, task_number = tasks.driver.progress(workflow_id)
+    assert header["completed"] == 10, header
+    assert header["concurrency"] == 4, header
+    assert "end" in header, header
+    assert [t["task"] for t in task_list] == list(range(10, 0, -1)), task_list
+    assert all(t["ending"] == t["task"] for t in task_list), task_list
+
+    # The range that failed first is the one whose error is raised
+    def fail(task):
+        if task.number == 1:
+            time.sleep(0.1)
+            raise ValueError("Later")
+        if task.number == 9:
+            raise KeyError("First")
+        task.begin("Running")
+
+    workflow_id = tasks.driver.begin_workflow(
+        uid="test", num_tasks=10, handler="app.tasks:count", concurrency=4
+    )
+    with patch("app.tasks.count", fail):
+        try:
+            process.run(workflow_id)
+        except KeyError:
+            pass
+        else:
+            raise Exception("Expected KeyError")
+
+
+def test_tasks_process():
+    # With TASKS_LOCAL_EXECUTOR=process every range's writes have to reach the
+    # store the workflow is in. Runs in a fresh interpreter with SQLite, since
+    # the processes are spawned and re-import the main module.
+    import subprocess
+    import sys
+    import tempfile
+
+    import tasks.driver
+    from tasks.adapter import process
+
+    os.environ["TASKS_LOCAL_EXECUTOR"] = "process"
+    try:
+        workflow_id = tasks.driver.begin_workflow(
+            uid="test", num_tasks=4, handler="app.tasks:count", concurrency=2
+        )
+        try:
+            process.run(workflow_id)
+        except Exception as e:
+            assert "KVSTORE_DRIVER=memory" in str(e), e
+        else:
+            raise Exception("Expected the memory driver to be refused")
+    finally:
+        del os.environ["TASKS_LOCAL_EXECUTOR"]
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as store_dir:
+        with open(os.path.join(store_dir, "process_tasks.py"), "w") as fp:
+            fp.write(
+                "def handler(task):\n"
+                "    task.begin('Running')\n"
+                "    task.end_state_patches['ending'] = task.number\n"
+            )
+        env = dict(os.environ)
+        for k in [
+            "KVSTORE_DRIVER",
+            "KVSTORE_DYNAMODB_TABLE_NAME",
+            "TASKS_STATE_MACHINE_ARN",
+        ]:
+            env.pop(k, None)
+        env["STORE_DIR"] = store_dir
+        env["TASKS_LOCAL_EXECUTOR"] = "process"
+        env["PYTHONPATH"] = os.pathsep.join([root, store_dir])
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import tasks.driver\n"
+                "from tasks.adapter import process\n"
+                "w = tasks.driver.begin_workflow(uid='test', num_tasks=12,"
+                " handler='process_tasks:handler', concurrency=3)\n"
+                "process.run(w)\n"
+                "header, task_list, task_number = tasks.driver.progress(w)\n"
+                "print(header['status'], header['completed'],"
+                " sorted(t['ending'] for t in task_list))\n",
+            ],
+            cwd=root,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines()[-1] == "SUCCEEDED 12 " + str(
+        list(range(1, 13))
+    ), result.stdout
+
+
+def test_tasks_pending_end():
+    from unittest.mock import patch
+
+    import kvstore.driver
+    import tasks.driver
+    from tasks.adapter import process
+
+    def handler(task):
+        if task.number == 2:
+            # Patching the workflow state writes any end held back with it
+            task.patch_workflow_state({"patched_by": 2})
+            assert tasks.driver.get_task(workflow_id, 6, 1)[0]["ending"] == 1
+        if task.number == 4:
+            # Reading a task's state writes any end held back first
+            assert task.get_task_state(3)["ending"] == 3
+        if task.number == 5:
+            raise ValueError("Crashed")
+        task.begin("Running")
+        task.end_state_patches["ending"] = task.number
+
+    transactions = []
+    transaction = kvstore.driver.transaction
+
+    def counting_transaction():
+        transactions.append(1)
+        return transaction()
+
+    workflow_id = tasks.driver.begin_workflow(
+        uid="test", num_tasks=6, handler="app.tasks:count"
+    )
+    with patch("app.tasks.count", handler), patch(
+        "kvstore.driver.transaction", counting_transaction
+    ):
+        try:
+            process.run(workflow_id)
+        except ValueError:
+            pass
+        else:
+            raise Exception("Expected ValueError")
+    # Task 1's end was written with task 2's state patch, task 3 began in the
+    # same transaction as task 2 ended, task 3's end was written before task 4
+    # read it, and task 4's when task 5 crashed before beginning, so the
+    # workflow resumes from task 5. The fifth transaction ended the workflow
+    # as failed.
+    assert len(transactions) == 5, transactions
+    assert tasks.driver.get_task(workflow_id, 6, 4)[0]["ending"] == 4
+    assert tasks.driver.get_next_task(workflow_id)[0] == 5
+
+
+def test_tasks_lambda_budget():
+    from unittest.mock import patch
+
+    import tasks.driver
+    from tasks.adapter.lambda_function import make_lambda_handler
+    from tasks.adapter.shared import Durations
+
+    durations = Durations("5,1.25,3", size=4)
+    assert durations.percentile(50) == 3 and durations.percentile(95) == 5
+    durations.add(2)
+    durations.add(4)
+    assert durations.encode() == "1.2,3,2,4", durations.encode()
+    assert Durations().percentile(95) == 0
+
+    class Clock:
+        now = 0.0
+
+        def time(self):
+            return self.now
+
+        def sleep(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+
+    class Context:
+        aws_request_id = "test"
+
+        def get_remaining_time_in_millis(self):
+            return 300 - clock.now * 1000
+
+    def handler(task):
+        task.begin("Running")
+        # Task 2 is ten times slower than the rest
+        clock.sleep(0.1 if task.number == 2 else 0.01)
+
+    workflow_id = tasks.driver.begin_workflow(
+        uid="test", num_tasks=40, handler="app.tasks:count"
+    )
+    # Durations from an earlier invocation
+    tasks.driver.patch_durations(workflow_id, 1, ",".join(["10"] * 19))
+    with patch("app.tasks.count", handler), patch(
+        "tasks.adapter.lambda_function.time", clock
+    ):
+        event = make_lambda_handler()({"workflow_id": workflow_id}, Context())
+        # Budgeting on the longest task would have stopped after 8 tasks, since
+        # 1.4 * 100 ms is more than was left from then on
+        assert event["next_task"] == 21 and event["num_tasks"] == 40, event
+        next_task, state, task_state = tasks.driver.get_next_task(workflow_id)
+        assert next_task == 21
+        assert len(state["task_ms_1"].split(",")) == 39, state
+        # The durations are kept out of the progress and can't be patched
+        assert "task_ms_1" not in tasks.driver.progress(workflow_id)[0]
+        try:
+            tasks.driver.patch_state(workflow_id, {"task_ms_1": ""})
+        except AssertionError:
+            pass
+        else:
+            raise Exception("Expected the durations key to be reserved")
+        # A next task that has begun since is searched for as usual
+        next_task = tasks.driver.get_next_task(workflow_id, next_task=5, num_tasks=40)
+        assert next_task[0] == 21, next_task
+        # The next invocation, with time for the rest, carries on from there
+        # without searching for it
+        clock.now = -10.0
+        with patch("kvstore.driver.iterate", side_effect=AssertionError), patch(
+            "kvstore.driver.scan_pk", side_effect=AssertionError
+        ):
+            event = make_lambda_handler()(event, Context())
+        assert "next_task" not in event and event["success"], event
+    assert tasks.driver.get_next_task(workflow_id)[0] == 41
+
+    # A handler's error isn't hidden by a failure to record the invocation
+    def crash(task):
+        task.begin("Running")
+        if task.number == 2:
+            raise ValueError("Crashed")
+
+    workflow_id = tasks.driver.begin_workflow(
+        uid="test", num_tasks=3, handler="app.tasks:count"
+    )
+    with patch("app.tasks.count", crash), patch(
+        "tasks.driver.patch_durations", side_effect=KeyError("Unrecorded")
+    ):
+        try:
+            make_lambda_handler()({"workflow_id": workflow_id}, Context())
+        except ValueError:
+            pass
+        else:
+            raise Exception("Expected ValueError")
+
+
+def test_tasks_worker():
+    import time
+    from unittest.mock import patch
+
+    import kvstore.driver
+    import tasks.driver
+    from tasks.adapter import worker
+
+    os.environ["TASKS_WORKER"] = "external"
+    os.environ["TASKS_WORKER_MAX_QUEUE"] = "2"
+    try:
+        workflow_ids = [
+            tasks.driver.begin_workflow(
+                uid="test", num_tasks=2, handler="app.tasks:count"
+            )
+            for i in range(3)
+        ]
+        for workflow_id in workflow_ids[:2]:
+            worker.enqueue(workflow_id)
+        try:
+            worker.enqueue(workflow_ids[2])
+        except tasks.driver.QueueFull:
+            pass
+        else:
+            raise Exception("Expected QueueFull")
+        # As if a previous pool stopped while running the first one, and
+        # another pool is running the third
+        kvstore.driver.patch(
+            "tasks",
+            "queue",
+            {"claimed_by": "gone", "lease_until": time.time() - 1},
+            sk="/" + workflow_ids[0],
+        )
+        os.environ["TASKS_WORKER_MAX_QUEUE"] = "3"
+        worker.enqueue(workflow_ids[2])
+        kvstore.driver.patch(
+            "tasks",
+            "queue",
+            {"claimed_by": "other", "lease_until": time.time() + 60},
+            sk="/" + workflow_ids[2],
+        )
+        stats = worker.stats()
+        assert (stats["queued"], stats["running"]) == (2, 1), stats
+        assert stats["rejected"] == 1, stats
+        assert worker.status(workflow_ids[0]) == "PENDING"
+        assert worker.status(workflow_ids[2]) == "RUNNING"
+        # A lease renewed after it was read as lapsed can't be taken over
+        lapsed = [(w, data) for w, data in worker._queue() if w == workflow_ids[0]]
+        kvstore.driver.patch(
+            "tasks",
+            "queue",
+            {"lease_until": time.time() + 60},
+            sk="/" + workflow_ids[0],
+        )
+        with patch("tasks.adapter.worker._queue", return_value=lapsed):
+            assert worker._claim("late") is None
+        kvstore.driver.patch(
+            "tasks",
+            "queue",
+            {"lease_until": lapsed[0][1]["lease_until"]},
+            sk="/" + workflow_ids[0],
+        )
+        with patch("tasks.adapter.worker._queue", return_value=lapsed):
+            assert worker._claim("late") == workflow_ids[0]
+        kvstore.driver.patch(
+            "tasks",
+            "queue",
+            {"claimed_by": "gone", "lease_until": time.time() - 1},
+            sk="/" + workflow_ids[0],
+        )
+
+        # Workflows take longer than the lease, which the pool renews
+        os.environ["TASKS_WORKER_LEASE"] = "0.05"
+        with patch("app.tasks.wait") as wait:
+            wait.side_effect = lambda: time.sleep(0.1)
+            worker.start(workers=2, poll_interval=0.01)
+            time.sleep(0.15)
+            for workflow_id in workflow_ids[:2]:
+                assert worker.status(workflow_id) == "RUNNING", workflow_id
+            for i in range(500):
+                stats = worker.stats()
+                if stats["queued"] + stats["running"] == 1:
+                    break
+                time.sleep(0.01)
+            worker.stop()
+        assert stats["succeeded"] == 2 and stats["workers"] == 2, stats
+        assert wait.call_count == 4, wait.call_count
+        for workflow_id in workflow_ids[:2]:
+            header, task_list, task_number = tasks.driver.progress(workflow_id)
+            assert header["completed"] == 2 and "end" in header, header
+            assert worker.status(workflow_id) is None
+        # The other pool's claim was left alone
+        assert worker.status(workflow_ids[2]) == "RUNNING"
+        kvstore.driver.delete("tasks", "queue", sk="/" + workflow_ids[2])
+    finally:
+        del os.environ["TASKS_WORKER"]
+        del os.environ["TASKS_WORKER_MAX_QUEUE"]
+        os.environ.pop("TASKS_WORKER_LEASE", None)
+
+
+def test_tasks_index():
+    import datetime
+    from unittest.mock import patch
+
+    import kvstore.driver
+    import tasks.driver
+    from tasks.adapter import process
+
+    def listed(status, **kwargs):
+        return [
+            w["workflow_id"]
+            for w in tasks.driver.list_workflows(status, since=since, **kwargs)
+        ]
+
+    since = datetime.datetime.now()
+    workflow_ids = [
+        tasks.driver.begin_workflow(uid="test", num_tasks=2, handler="app.tasks:count")
+        for i in range(3)
+    ]
+    # Newest first
+    assert listed("ALL") == workflow_ids[::-1]
+    assert listed("ALL", limit=2) == workflow_ids[:0:-1]
+    assert listed("RUNNING") == workflow_ids[::-1]
+
+    def crash(task):
+        raise ValueError("Crashed")
+
+    with patch("app.tasks.wait"):
+        process.run(workflow_ids[0])
+    with patch("app.tasks.count", crash):
+        try:
+            process.run(workflow_ids[1])
+        except ValueError:
+            pass
+        else:
+            raise Exception("Expected ValueError")
+    assert listed("RUNNING") == [workflow_ids[2]]
+    assert listed("SUCCEEDED") == [workflow_ids[0]]
+    assert listed("FAILED") == [workflow_ids[1]]
+    assert listed("ALL") == workflow_ids[::-1]
+    # Ending a workflow again leaves it as it was, with or without a
+    # transaction
+    tasks.driver.end_workflow("test", workflow_ids[1])
+    with patch("kvstore.driver.transactable", return_value=False):
+        tasks.driver.end_workflow("test", workflow_ids[1])
+    assert listed("SUCCEEDED") == [workflow_ids[0]]
+    assert listed("FAILED") == [workflow_ids[1]]
+    assert tasks.driver.progress(workflow_ids[1])[0]["status"] == "FAILED"
+    # A crash while indexing a new workflow leaves no trace of it
+    put = kvstore.driver.put
+    pks = []
+
+    def recording_put(store, pk, *args, **kwargs):
+        pks.append(pk)
+        return put(store, pk, *args, **kwargs)
+
+    with patch("kvstore.driver.put", recording_put), patch(
+        "kvstore.driver.put_many", side_effect=ValueError("Crashed")
+    ):
+        try:
+            tasks.driver.begin_workflow(
+                uid="crash", num_tasks=2, handler="app.tasks:count"
+            )
+        except ValueError:
+            pass
+        else:
+            raise Exception("Expected ValueError")
+    try:
+        kvstore.driver.get("tasks", pks[0])
+    except kvstore.driver.NotFound:
+        pass
+    else:
+        raise Exception("Expected the workflow not to have been stored")
+    assert listed("ALL") == workflow_ids[::-1]
+    # Workflows indexed before since are left out
+    assert (
+        tasks.driver.list_workflows(
+            "ALL", since=datetime.datetime.now() + datetime.timedelta(seconds=1)
+        )
+        == []
+    )
+    # A crash before the workflow is removed from RUNNING undoes the rest of
+    # ending it, so it is never listed under both
+    with patch("kvstore.driver.delete", side_effect=ValueError("Crashed")):
+        try:
+            tasks.driver.end_workflow("test", workflow_ids[2])
+        except ValueError:
+            pass
+        else:
+            raise Exception("Expected ValueError")
+    assert listed("RUNNING") == [workflow_ids[2]]
+    assert listed("SUCCEEDED") == [workflow_ids[0]]
+    assert "end" not in tasks.driver.progress(workflow_ids[2])[0]
+    tasks.driver.end_workflow("test", workflow_ids[2])
+    assert listed("RUNNING") == []
+    assert listed("SUCCEEDED") == [workflow_ids[2], workflow_ids[0]]
+
+    from app.app import app
+    from app.template import Base
+    from serve.adapter.shared import Base64, Http, Request, RespondEarly, Response
+
+    def get(query):
+        http = Http(
+            request=Request(
+                path="/workflows",
+                query=query,
+                headers={},
+                method="get",
+                body=b"",
+                verified_claims=None,
+            ),
+            response=Response(
+                status="200 OK",
+                headers={},
+                body=None,
+                RespondEarly=RespondEarly,
+                Base64=Base64,
+            ),
+            context=dict(uid="123"),
+        )
+        app(http)
+        assert isinstance(http.response.body, Base)
+        return http.response.status, http.response.body.render()
+
+    status, body = get("status=SUCCEEDED&hours=1&limit=1")
+    assert status == "200 OK" and workflow_ids[2] in body, body
+    assert workflow_ids[0] not in body, body
+    for query in [
+        "status=DONE",
+        "hours=soon",
+        "hours=0",
+        "hours=-1",
+        "hours=nan",
+        "hours=inf",
+        "hours=1e300",
+        "limit=ten",
+        "limit=0",
+        "limit=-5",
+    ]:
+        status, body = get(query)
+        assert status == "400 Bad Request", (query, status)
+
+
+def test_cold_start_imports():
+    # Importing the Lambda handlers must not import boto3 or the Step
+    # Functions driver, since many requests never need them and they add
+    # to every cold start. Runs in a fresh interpreter with the deployed
+    # settings and returns the slowest imports as a report.
+    import subprocess
+    import sys
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    del env["KVSTORE_DRIVER"]
+    env.setdefault("KVSTORE_DYNAMODB_TABLE_NAME", "tasks")
+    env.setdefault("TASKS_STATE_MACHINE_ARN", "dummyarn")
+    env.setdefault("AWS_REGION", "test")
+    env.setdefault("PASSWORD", "test")
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p]
+    )
+    unwanted = ["boto3", "botocore", "tasks.driver.kvstore_aws_step_functions"]
+    for handler in [
+        "serve.adapter.lambda_function.index",
+        "tasks.adapter.lambda_function.index",
+    ]:
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                f"import sys, {handler}; print([m for m in {unwanted!r} if m in sys.modules])",
+            ],
+            cwd=root,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.strip() == "[]", (handler, result.stdout)
+    timings = []
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                timings.append((int(cumulative), name.strip()))
+    return [f"{us / 1000:8.1f}ms  {name}" for us, name in sorted(timings)[-5:]]
+
+
 def test_api():
     from unittest.mock import patch
 
@@ -203,8 +1199,74 @@ if __name__ == "__main__":
     print(".", end="")
     sys.stdout.flush()
 
+    test_kvstore_codec()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_kvstore_sqlite_migrate()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_kvstore_sqlite_shards()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_kvstore_sqlite_group_commit()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_kvstore_sqlite_sweep()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_kvstore_cache()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_kvstore_aio_sign()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_kvstore_dynamodb_codec()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_kvstore_dynamodb_stats()
+    print(".", end="")
+    sys.stdout.flush()
+
     test_api()
     print(".", end="")
     sys.stdout.flush()
 
+    test_tasks_parallel()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_tasks_process()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_tasks_pending_end()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_tasks_lambda_budget()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_tasks_worker()
+    print(".", end="")
+    sys.stdout.flush()
+
+    test_tasks_index()
+    print(".", end="")
+    sys.stdout.flush()
+
+    report = test_cold_start_imports()
+    print(".", end="")
+    sys.stdout.flush()
+    print("\nSlowest imports for a tasks Lambda cold start:")
+    print("\n".join(report), end="")
+
     print("\nSUCCESS")